@@ -141,6 +141,8 @@ print('Privacy set to public.')
 band_ids = ['PM25']
 
 task_id = []
+# manifests of the assets to upload
+manifests = []
 # Upload processed data files to GEE
 for uri in gcs_uris:
     # generate an asset name for the current file by using the filename (minus the file type extension)
@@ -149,11 +151,12 @@ for uri in gcs_uris:
     mf_bands = [{'id': band_id, 'tileset_band_index': band_ids.index(band_id), 'tileset_id': os.path.basename(uri)[:-4],
              'pyramidingPolicy': pyramiding_policy} for band_id in band_ids]
     # create complete manifest for asset upload
-    manifest = util_cloud.gee_manifest_complete(asset_name, uri, mf_bands)
-    # upload the file from GCS to GEE
-    task = util_cloud.gee_ingest(manifest)
-    print(asset_name + ' uploaded to GEE')
-    task_id.append(task)
+    manifests.append(util_cloud.gee_manifest_complete(asset_name, uri, mf_bands))
+
+# upload the files from GCS to GEE, several at a time
+for result in util_cloud.gee_ingest_many(manifests):
+    print(result['asset'] + ' uploaded to GEE')
+    task_id.append(result['task_id'])
 
 # remove files from Google Cloud Storage
 util_cloud.gcs_remove(gcs_uris, gcs_bucket=gcsBucket)
@@ -1,4 +1,10 @@
 import os
+import sys
+utils_path = os.path.join(os.path.abspath(os.getenv('PROCESSING_DIR')),'utils')
+if utils_path not in sys.path:
+    sys.path.append(utils_path)
+import util_cloud
+import ee
 import subprocess
 import glob
 from shutil import copy
@@ -7,86 +13,63 @@ from shutil import copy
 dataset_name = 'cit_033a/'
 
 # Directory of indivual tile tiff files on local machine
-DATA_DIR = os.getenv('PROCESSING_DIR')+dataset_name 'GHS_BUILT_LDSMT_GLOBE_R2018A_3857_30_V2_0/V2-0/30x150000/'
+DATA_DIR = os.getenv('PROCESSING_DIR')+dataset_name+'GHS_BUILT_LDSMT_GLOBE_R2018A_3857_30_V2_0/V2-0/30x150000/'
 
 # Single folder to hold all individual files. Done for parallel upload to Google Cloud Bucket
-DEST_DIR = os.getenv('PROCESSING_DIR')+dataset_name 'GHS_BUILT_LDSMT_GLOBE_R2018A_3857_30_V2_0/V2-0/temp/'
+DEST_DIR = os.getenv('PROCESSING_DIR')+dataset_name+'GHS_BUILT_LDSMT_GLOBE_R2018A_3857_30_V2_0/V2-0/temp/'
 
 # Directory for Google Bucket where the individual tiff files will be stored before transferring to Google Earth Engine
 GS_BUCKET = 'gs://{}/temp/'.format(os.getenv('GEE_STAGING_BUCKET'))
 
 # Move to data directory
 os.chdir(DATA_DIR)
-# set number of assets to upload at a single time
-NUM_ASSETS_AT_ONCE = 50
-
-PAUSE_FOR_OVERLOAD = True
+# number of tiles mosaicked into each image, so that each ingestion manifest and task stays a manageable size
+TILES_PER_ASSET = 500
 
 #################################### Transfer files from Local to Bucket ######################################
 
 # Get the list of all individual tif files
 files = glob.glob(DATA_DIR + '/**/*.tif', recursive = True)
-#Create empty array for task id's
-task_ids = ['']*len(files)
-
+# names of the renamed files
+renamed_files = []
+# create the single folder if it does not exist yet
+os.makedirs(DEST_DIR, exist_ok=True)
 # Loop through all files in DEST_DIR
-for i,filey in enumerate(files):		
+for i,filey in enumerate(files):
 
     # Rename all files to include extension at the end to avoid overwritting of duplicate names
     filename = filey.split('.tif')[0]+'_{}.tif'.format(i)
-	os.rename(filey,filename)
+    os.rename(filey,filename)
+    renamed_files.append(filename)
 
     # copy all files to a single directory to use parallel upload
-	copy(filey, DEST_DIR)
-    	  
+    copy(filename, DEST_DIR)
 
-# Transfer all files to the Google Cloud Bucket
-cmd = ['gsutil','-m','cp','-r',DEST_DIR,GS_BUCKET]
-subprocess.call(cmd, shell=True)  
+# Transfer the files in DEST_DIR to the Google Cloud Bucket, directly under GS_BUCKET; gsutil expands the wildcard
+cmd = ['gsutil','-m','cp',DEST_DIR+'*.tif',GS_BUCKET]
+subprocess.call(cmd)  
 
 #################################### Transfer files from Bucket to GEE ######################################
 
-# Google Earth Engine asset to store individual tiff file
+# Google Earth Engine image collection to store the mosaics of the batches of tiles
 EE_COLLECTION = 'projects/resource-watch-gee/cit_033a_urban_built_up_area_mosaic'
 
 
-def upload_asset(full_file_path, DATA_DIR=DATA_DIR, EE_COLLECTION=EE_COLLECTION, GS_BUCKET=GS_BUCKET):
-    '''
-    Function to upload geotiffs as images
-    '''
-    
-    filename = os.path.basename(full_file_path)
-
-    #Get asset id
-    asset_id = EE_COLLECTION+'/'+filename.split('.')[0]
+# initialize ee for uploading to Google Earth Engine
+auth = ee.ServiceAccountCredentials(os.getenv('GEE_SERVICE_ACCOUNT'), os.getenv('GOOGLE_APPLICATION_CREDENTIALS'))
+ee.Initialize(auth)
 
-    #Upload GeoTIFF from google storage bucket to earth engine
-    cmd = ['earthengine','upload','image','--asset_id='+asset_id,'--force',GS_BUCKET+'/'+filename]
-
-    shell_output = subprocess.check_output(cmd, shell=True)
-    shell_output = shell_output.decode("utf-8")
-    print(shell_output)
-
-    #Get task id
-    task_id = ''
-    if 'Started upload task with ID' in shell_output:
-        task_id = shell_output.split(': ')[1]
-        task_id = task_id.strip()
-    else:
-        print('Something went wrong!')
-        task_id='ERROR'
-    return task_id
-
-# Loop through each indivual tiles to upload them to Google Earth Engine
-for i,filey in enumerate(files):
-    print(i)
+# create the image collection if it does not exist yet
+if not ee.data.getInfo(EE_COLLECTION):
+    ee.data.createAsset({'type': 'ImageCollection'}, EE_COLLECTION)
 
-    if i >=0 and i <= 5000: # repeat this process for len(files)
+# list the locations of the individual tiles in the Google Cloud Bucket, under their new names
+gcs_uris = [GS_BUCKET+os.path.basename(filename) for filename in renamed_files]
 
-        task_id = upload_asset(filey)
-        
-        if PAUSE_FOR_OVERLOAD:
-            if (i% NUM_ASSETS_AT_ONCE == 0) and (i>0):
-                #Wait for all tasks to finish
-                cmd = ['earthengine','task','wait','all']
-                subprocess.call(cmd, shell=True)
+# Ingest each batch of TILES_PER_ASSET tiles into one image of the collection; GEE mosaics the tiles of the tileset
+manifests = [util_cloud.gee_manifest_complete(EE_COLLECTION+'/mosaic_{}'.format(i // TILES_PER_ASSET), gcs_uris[i:i+TILES_PER_ASSET], None)
+             for i in range(0, len(gcs_uris), TILES_PER_ASSET)]
+task_ids = []
+for result in util_cloud.gee_ingest_many(manifests):
+    print(result['asset'], result['state'])
+    task_ids.append(result['task_id'])
@@ -113,79 +113,78 @@ def raster_template(ch, i, s, y1, y2, d):
         pfx += '-mmyr'
     return f'{pfx}-{ch}-{i}_{s}_ens_{y1}-{y2}_{d}.tif'
 
-for dataset in datasets:
-    for indicator in all_indicators:
-        image_collection = f'projects/resource-watch-gee/{dataset}/{dataset}_{indicator}'
-        # create IC
-        ee.data.createAsset({'type': 'ImageCollection'}, image_collection)
-        # set dataset privacy to public
-        acl = {"all_users_can_read": True}
-        ee.data.setAssetAcl(image_collection, acl)
-        logger.info('Privacy set to public.')
-
-        # define changes depending on type of indicator
-        if indicator in temp_indicators:
-            changes = ['abs', 'diff']
-        elif indicator in pr_indicators:
-            changes = ['abs', 'ch']
-
-        for scenario in scenarios:
-            for y in range(startyear, endyear+1, 10):
-                # define start and end years for each file
-                y1 = y - 15
-                y2 = y + 15
-                for change in changes:
-                    # get file name
-                    f = raster_template(change, indicator, scenario, y1, y2, dataset)
-                    file = os.path.join(data_dir, f)
-                    dataset_name = f'{dataset}_{scenario}_{indicator}_{change}_{y1}_{y2}'
-
-                    '''
-                    Upload processed data to Google Earth Engine
-                    '''
-                    logger.info('Uploading processed data to Google Cloud Storage.')
-
-                    # upload local files to Google Cloud Storage
-                    gs_uris = util_cloud.gcs_upload(file, os.path.join(dataset, dataset_name))
-
-                    logger.info('Uploading processed data to Google Earth Engine.')
-
-                    # set pyramiding policy for GEE upload
-                    pyramiding_policy = 'MEAN'  # check
-
-                    # name bands according to variable names in original netcdf
-                    bands = ['q25', 'q50', 'q75']
-                    # create manifests for upload to GEE
-                    band_manifest = [{'id': band, 'tileset_band_index': bands.index(band), 'tileset_id': os.path.basename(gs_uris[0]).split('.')[0],
-                                      'pyramidingPolicy': pyramiding_policy} for band in bands]
-
-                    asset_name = f'{image_collection}/{dataset_name}'
-                    manifest = util_cloud.gee_manifest_complete(asset_name, gs_uris[0], band_manifest)
-
-                    properties = {
-                        'RCP': scenario[-2] + '.' + scenario[-1],
-                        'change_vs_absolute': change
-                    }
-                    manifest['properties'] = properties
-                    # upload from GCS to GEE
-                    util_cloud.gee_ingest(manifest, public=True)
-                    # delete files from GCS
-                    util_cloud.gcs_remove(gs_uris, gcs_bucket=gcs_bucket)
-
-                    logger.info('Files deleted from Google Cloud Storage.')
-
-                    '''
-                    Upload original data and processed data to Amazon S3 storage
-                    '''
-                    # amazon storage info
-                    aws_bucket = 'wri-public-data'
-                    s3_prefix = 'resourcewatch/raster/'
-
-                    logger.info('Uploading processed data to S3.')
-
-                    # Copy the processed data into a zipped file to upload to S3
-                    processed_data_dir = os.path.join(dataset_name+'_edit.zip')
-                    with ZipFile(processed_data_dir,'w') as zip:
-                        zip.write(file, os.path.basename(file))
-                    # Upload processed data file to S3
-                    uploaded = util_cloud.aws_upload(processed_data_dir, aws_bucket, s3_prefix+os.path.basename(processed_data_dir))
\ No newline at end of file
+# set pyramiding policy for GEE upload
+pyramiding_policy = 'MEAN'  # check
+# name bands according to variable names in original netcdf
+bands = ['q25', 'q50', 'q75']
+
+# amazon storage info
+aws_bucket = 'wri-public-data'
+s3_prefix = 'resourcewatch/raster/'
+
+def asset_manifest(asset_name, scenario, change):
+    '''
+    create the function building the GEE manifest of one file once it is on Google Cloud Storage
+    INPUT   asset_name: name of the asset to create on GEE (string)
+            scenario: climate scenario of data (string)
+            change: type of change calcuation - abs, diff, ch (string)
+    RETURN  function creating the manifest from the list of GCS locations of the file (function)
+    '''
+    def manifest(gs_uris):
+        # create manifests for upload to GEE
+        band_manifest = [{'id': band, 'tileset_band_index': bands.index(band), 'tileset_id': os.path.basename(gs_uris[0]).split('.')[0],
+                          'pyramidingPolicy': pyramiding_policy} for band in bands]
+        manifest = util_cloud.gee_manifest_complete(asset_name, gs_uris[0], band_manifest)
+        manifest['properties'] = {
+            'RCP': scenario[-2] + '.' + scenario[-1],
+            'change_vs_absolute': change
+        }
+        return manifest
+    return manifest
+
+def jobs():
+    '''
+    create the image collections and list the files to upload, ingest into GEE and archive on S3
+    RETURN  generator of gee_ingest_pipeline jobs (dictionaries)
+    '''
+    for dataset in datasets:
+        for indicator in all_indicators:
+            image_collection = f'projects/resource-watch-gee/{dataset}/{dataset}_{indicator}'
+            # create IC
+            ee.data.createAsset({'type': 'ImageCollection'}, image_collection)
+            # set dataset privacy to public
+            acl = {"all_users_can_read": True}
+            ee.data.setAssetAcl(image_collection, acl)
+            logger.info('Privacy set to public.')
+
+            # define changes depending on type of indicator
+            if indicator in temp_indicators:
+                changes = ['abs', 'diff']
+            elif indicator in pr_indicators:
+                changes = ['abs', 'ch']
+
+            for scenario in scenarios:
+                for y in range(startyear, endyear+1, 10):
+                    # define start and end years for each file
+                    y1 = y - 15
+                    y2 = y + 15
+                    for change in changes:
+                        # get file name
+                        f = raster_template(change, indicator, scenario, y1, y2, dataset)
+                        file = os.path.join(data_dir, f)
+                        dataset_name = f'{dataset}_{scenario}_{indicator}_{change}_{y1}_{y2}'
+                        # Copy the processed data into a zipped file to upload to S3
+                        processed_data_dir = os.path.join(dataset_name+'_edit.zip')
+                        yield {'files': file,
+                               'prefix': os.path.join(dataset, dataset_name),
+                               'manifest': asset_manifest(f'{image_collection}/{dataset_name}', scenario, change),
+                               'archive': (processed_data_dir, aws_bucket, s3_prefix+os.path.basename(processed_data_dir))}
+
+'''
+Upload processed data to Google Earth Engine and upload processed data to Amazon S3 storage
+'''
+logger.info('Uploading processed data to Google Cloud Storage, Google Earth Engine and S3.')
+# the next files upload to Google Cloud Storage while earlier ones ingest into GEE, and are deleted from GCS once
+# ingested; the zipped files upload to S3 in the background
+for result in util_cloud.gee_ingest_pipeline(jobs(), gcs_bucket=gcs_bucket, public=True):
+    logger.info('{} {}'.format(result['asset'], result['state']))
@@ -220,6 +220,10 @@ logger.info('Uploading processed data to Google Cloud Storage.')
 gcsClient = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT"))
 gcsBucket = gcsClient.bucket(os.environ.get("GEE_STAGING_BUCKET"))
 
+# convert the processed files to Cloud-Optimized GeoTIFFs, which are smaller to upload and faster to ingest
+for file in processed_data_file:
+    util_files.cog_geotiff(file)
+
 # upload files to Google Cloud Storage
 gcs_uris= util_cloud.gcs_upload(processed_data_file, dataset_name, gcs_bucket=gcsBucket)  
 
@@ -271,21 +275,11 @@ aws_bucket = 'wri-projects'
 s3_prefix = 'resourcewatch/raster/'
 
 logger.info('Uploading original data to S3.')
-# Copy the raw data into a zipped file to upload to S3
+# Zip the raw data straight into S3, without writing the archive to disk
 raw_data_dir = os.path.join(data_dir, dataset_name+'.zip')
-with ZipFile(raw_data_dir,'w') as zipped:
-    for file in raw_data_file:
-        zipped.write(file, os.path.basename(file), compress_type=zipfile.ZIP_DEFLATED)
-
-# Upload raw data file to S3
-uploaded = util_cloud.aws_upload(raw_data_dir, aws_bucket, s3_prefix + os.path.basename(raw_data_dir))
+uploaded = util_cloud.aws_upload_zip(raw_data_file, aws_bucket, s3_prefix + os.path.basename(raw_data_dir))
 
 logger.info('Uploading processed data to S3.')
-# Copy the processed data into a zipped file to upload to S3
+# Zip the processed data straight into S3, without writing the archive to disk
 processed_data_dir = os.path.join(data_dir, dataset_name+'_edit.zip')
-with ZipFile(processed_data_dir,'w') as zipped:
-    for file in processed_data_file:
-        zipped.write(file, os.path.basename(file), compress_type=zipfile.ZIP_DEFLATED)
-
-# Upload processed data file to S3
-uploaded = util_cloud.aws_upload(processed_data_dir, aws_bucket, s3_prefix + os.path.basename(processed_data_dir))
+uploaded = util_cloud.aws_upload_zip(processed_data_file, aws_bucket, s3_prefix + os.path.basename(processed_data_dir))
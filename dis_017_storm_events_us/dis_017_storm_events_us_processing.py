@@ -12,7 +12,6 @@ from ftplib import FTP
 import urllib
 import numpy as np
 import pandas as pd 
-from zipfile import ZipFile
 
 # Set up logging
 # Get the top-level logger object
@@ -115,7 +114,8 @@ events.to_csv(processed_data_file, index=False)
 Upload processed data to Carto
 '''
 logger.info('Uploading processed data to Carto.')
-util_carto.upload_to_carto(processed_data_file, 'LINK')
+# the joined storm events are too large to import in one go, so import them in parts
+util_carto.upload_large_to_carto(processed_data_file, 'LINK')
 
 
 '''
@@ -130,9 +130,7 @@ logger.info('Uploading original data to S3.')
 
 # Copy the raw data into a zipped file to upload to S3
 raw_data_dir = os.path.join(data_dir, dataset_name+'.zip')
-with ZipFile(raw_data_dir,'w') as zipped:
-    for file in raw_data_file:
-        zipped.write(file, os.path.basename(file))
+util_files.archive_files(raw_data_file, raw_data_dir)
         
 # Upload raw data file to S3
 uploaded = util_cloud.aws_upload(raw_data_dir, aws_bucket, s3_prefix + os.path.basename(raw_data_dir))
@@ -140,8 +138,7 @@ logger.info('Uploading processed data to S3.')
 
 # Copy the processed data into a zipped file to upload to S3
 processed_data_dir = os.path.join(data_dir, dataset_name+'_edit.zip')
-with ZipFile(processed_data_dir,'w') as zip:
-    zip.write(processed_data_file, os.path.basename(processed_data_file)) 
+util_files.archive_files(processed_data_file, processed_data_dir)
         
 # Upload processed data file to S3
 uploaded = util_cloud.aws_upload(processed_data_dir, aws_bucket, s3_prefix + os.path.basename(processed_data_dir))
\ No newline at end of file
@@ -123,8 +123,7 @@ processed_data_file = [imports_processed_data_file, exports_processed_data_file]
 Upload processed data to Carto
 '''
 logger.info('Uploading processed data to Carto.')
-for file in processed_data_file:
-    util_carto.upload_to_carto(file, 'LINK', collision_strategy = 'overwrite')
+util_carto.upload_many(processed_data_file, 'LINK', collision_strategy = 'overwrite')
 '''
 Upload original data and processed data to Amazon S3 storage
 '''
@@ -136,6 +136,11 @@ logger.info('Uploading processed data to Google Cloud Storage.')
 gcsClient = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT"))
 gcsBucket = gcsClient.bucket(os.environ.get("GEE_STAGING_BUCKET"))
 
+# convert the processed files to Cloud-Optimized GeoTIFFs, which are smaller to upload and faster to ingest
+# the rasters hold suitability classes, so their overviews pick the nearest class instead of averaging classes
+for file in processed_data_file:
+    util_files.cog_geotiff(file, resampling='NEAREST')
+
 # upload files to Google Cloud Storage
 gcs_uris= util_cloud.gcs_upload(processed_data_file, dataset_name, gcs_bucket=gcsBucket)  
 
@@ -204,10 +204,8 @@ for key, val in data_dict.items():
     val['finaltifs'] = finaltifs
     alltifs.extend(finaltifs)
 
-logger.info('Merging masked, single-band GeoTIFFs into single, multiband GeoTIFF.')
-multitif = os.path.abspath(os.path.join(data_dir,dataset_name+'.tif'))
-util_files.merge_geotiffs(alltifs, multitif, ot='float32')
-processed_data_file = multitif
+# the single-band GeoTIFFs are uploaded as they are and become the bands of one asset on GEE
+processed_data_file = alltifs
 
 '''
 Upload processed data to Google Earth Engine
@@ -218,19 +216,21 @@ logger.info('Uploading processed data to Google Cloud Storage.')
 gcsClient = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT"))
 gcsBucket = gcsClient.bucket(os.environ.get("GEE_STAGING_BUCKET"))
 
-gcs_uris = util_cloud.gcs_upload(multitif, dataset_name, gcs_bucket=gcsBucket )
+gcs_uris = util_cloud.gcs_upload(alltifs, dataset_name, gcs_bucket=gcsBucket )
 
 logger.info('Uploading processed data to Google Earth Engine.')
 # initialize ee module for uploading to Google Earth Engine
 auth = ee.ServiceAccountCredentials(os.getenv('GEE_SERVICE_ACCOUNT'), os.getenv('GOOGLE_APPLICATION_CREDENTIALS'))
 ee.Initialize(auth)
 
+# each single-band file is its own tileset, providing one band of the asset
+tileset_ids = ['{}_{}'.format(dataset_name, i) for i in range(len(gcs_uris))]
 # name bands according to variable names in original netcdf
-mf_bands = util_cloud.gee_manifest_bands(data_dict, dataset_name)
+mf_bands = util_cloud.gee_manifest_bands(data_dict, dataset_name, tileset_ids=tileset_ids)
 # Upload processed data file to GEE
 asset_name = f'projects/resource-watch-gee/{dataset_name}'
 
-manifest = util_cloud.gee_manifest_complete(asset_name, gcs_uris[0], mf_bands)
+manifest = util_cloud.gee_manifest_complete(asset_name, dict(zip(tileset_ids, gcs_uris)), mf_bands)
 task_id = util_cloud.gee_ingest(manifest, public=True)
 
 util_cloud.gcs_remove(gcs_uris, gcs_bucket=gcsBucket)
@@ -258,6 +258,7 @@ logger.info('Uploading processed data to S3.')
 # Copy the processed data into a zipped file to upload to S3
 processed_data_dir = os.path.join(data_dir, dataset_name+'_edit.zip')
 with ZipFile(processed_data_dir,'w') as zip:
-    zip.write(processed_data_file, os.path.basename(processed_data_file))
+    for file in processed_data_file:
+        zip.write(file, os.path.basename(file))
 # Upload processed data file to S3
 uploaded = util_cloud.aws_upload(processed_data_dir, aws_bucket, s3_prefix+os.path.basename(processed_data_dir))
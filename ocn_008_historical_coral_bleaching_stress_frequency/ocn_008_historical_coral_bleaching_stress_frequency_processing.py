@@ -72,12 +72,8 @@ for target in tifs:
     util_files.mask_geotiff(target, mask, maskedtif, nodata=nodata)
     maskedtifs.append(maskedtif)
 
-# generate a name for processed tif
-processed_data_file = os.path.join(data_dir, dataset_name+'.tif')
-
-logger.info('Merge single-band GeoTIFFs into single, multiband GeoTIFF.')
-# merge all the sub tifs from this netcdf to create an overall tif representing all variable
-util_files.merge_geotiffs(maskedtifs, processed_data_file, ot='Float32')
+# the masked single-band tifs are uploaded as they are and become the bands of one asset on GEE
+processed_data_file = maskedtifs
 
 '''
 Upload processed data to Google Earth Engine
@@ -101,11 +97,11 @@ pyramiding_policy = 'MEAN' #check
 # Upload processed data file to GEE
 asset_name = f'projects/resource-watch-gee/{dataset_name}'
 
-# name bands according to variable names in original netcdf
-bands = [{'id': var, 'tileset_band_index': subdatasets.index(var), 'missing_data': {'values': [nodata]}, 'tileset_id': dataset_name, 'pyramidingPolicy': pyramiding_policy} for var in subdatasets]
+# name bands according to variable names in original netcdf; each band comes from its own single-band file
+bands = [{'id': var, 'tileset_band_index': 0, 'missing_data': {'values': [nodata]}, 'tileset_id': var, 'pyramidingPolicy': pyramiding_policy} for var in subdatasets]
 
-# create manifest for asset upload
-manifest = util_cloud.gee_manifest_complete(asset_name, gcs_uris[0], bands)
+# create manifest for asset upload, with one tileset per band
+manifest = util_cloud.gee_manifest_complete(asset_name, dict(zip(subdatasets, gcs_uris)), bands)
 # upload processed data file to GEE
 task_id = util_cloud.gee_ingest(manifest, public=True)
 # remove files from Google Cloud Storage
@@ -133,6 +129,7 @@ logger.info('Uploading processed data to S3.')
 # Copy the processed data into a zipped file to upload to S3
 processed_data_dir = os.path.join(data_dir, dataset_name+'_edit.zip')
 with ZipFile(processed_data_dir,'w') as zip:
-    zip.write(processed_data_file, os.path.basename(processed_data_file))
+    for file in processed_data_file:
+        zip.write(file, os.path.basename(file))
 # Upload processed data file to S3
 uploaded = util_cloud.aws_upload(processed_data_dir, aws_bucket, s3_prefix+os.path.basename(processed_data_dir))
@@ -82,11 +82,8 @@ for band_id in band_ids:
     util_files.mask_geotiff(sds_file_dict[band_id], sds_file_dict['mask'], band_masked, nodata=nodata)
     masked_tifs.append(band_masked)
     
-logger.info('Merge masked, single-band GeoTIFFs into single, multiband GeoTIFF.')
-# merge multiple masked single-band tifs as layers in single multiband tif
-multitif = os.path.abspath(os.path.join(data_dir,dataset_name+'.tif'))
-util_files.merge_geotiffs(masked_tifs, multitif)
-processed_data_file = multitif
+# the masked single-band tifs are uploaded as they are and become the bands of one asset on GEE
+processed_data_file = masked_tifs
 
 '''
 Upload processed data to Google Earth Engine
@@ -98,7 +95,7 @@ gcsClient = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT"))
 gcsBucket = gcsClient.bucket(os.environ.get("GEE_STAGING_BUCKET"))
 
 # upload files to Google Cloud Storage
-gcs_uris= util_cloud.gcs_upload(multitif, dataset_name, gcs_bucket=gcsBucket)
+gcs_uris= util_cloud.gcs_upload(masked_tifs, dataset_name, gcs_bucket=gcsBucket)
 
 logger.info('Uploading processed data to Google Earth Engine.')
 # initialize ee and eeUtil modules for uploading to Google Earth Engine
@@ -112,12 +109,12 @@ missing_data_values = [-128.0]
 # set asset name to be used in GEE
 asset_name = f'projects/resource-watch-gee/{dataset_name}'
 
-# name bands according to variable names in original netcdf
-mf_bands = [{'id': band_id, 'tileset_band_index': band_ids.index(band_id), 'tileset_id': dataset_name,
+# name bands according to variable names in original netcdf; each band comes from its own single-band file
+mf_bands = [{'id': band_id, 'tileset_band_index': 0, 'tileset_id': band_id,
              'missing_data': {'values': missing_data_values},
              'pyramidingPolicy': pyramiding_policy} for band_id in band_ids]
-# create manifest for asset upload
-manifest = util_cloud.gee_manifest_complete(asset_name, gcs_uris[0], mf_bands)
+# create manifest for asset upload, with one tileset per band
+manifest = util_cloud.gee_manifest_complete(asset_name, dict(zip(band_ids, gcs_uris)), mf_bands)
 print('manifest: ' + manifest)
 # upload processed data file to GEE
 task_id = util_cloud.gee_ingest(manifest, public=True)
@@ -147,6 +144,7 @@ logger.info('Uploading processed data to S3.')
 # Copy the processed data into a zipped file to upload to S3
 processed_data_dir = os.path.join(data_dir, dataset_name+'_edit.zip')
 with ZipFile(processed_data_dir,'w') as zip:
-    zip.write(processed_data_file, os.path.basename(processed_data_file))
+    for file in processed_data_file:
+        zip.write(file, os.path.basename(file))
 # Upload processed data file to S3
 uploaded = util_cloud.aws_upload(processed_data_dir, aws_bucket, s3_prefix+os.path.basename(processed_data_dir))
@@ -9,8 +9,6 @@ import pandas as pd
 from pandas import DataFrame
 import numpy as np
 from functools import reduce
-import requests
-import json
 import os
 import glob
 import tabula
@@ -164,13 +162,8 @@ for df in merge_list:
     df_processed = pd.merge(df_processed, df, on = ['year', 'country'], how = 'outer')
         
 # read in existing dataframe so we can merge the new data with the old data
-api_key = os.getenv('CARTO_WRI_RW_KEY')
-username = os.getenv('CARTO_WRI_RW_USER')
-q = 'SELECT * FROM soc_026_gender_gap_index_combined_edit'
-url = 'https://wri-rw.carto.com/api/v2/sql'
-r = requests.get(url, params={'api_key': api_key, 'q': q}).text
-df_dict = json.loads(r)
-df_carto = pd.DataFrame(df_dict['rows'])
+# the table is streamed from Carto in chunks instead of being loaded as one json response
+df_carto = util_carto.read_carto_table('soc_026_gender_gap_index_combined_edit')
 
 # Merge new years with old
 frames_carto_upload = [df_carto, df_processed]
@@ -126,6 +126,8 @@ print('Privacy set to public.')
 band_ids = ['b1']
 
 task_id = []
+# manifests of the assets to upload
+manifests = []
 # upload processed data files to GEE
 for uri,year in zip(gcs_uris,range(1992,2020)):
     # filenames for 1992-2015 start with 'ESACCI'
@@ -142,11 +144,12 @@ for uri,year in zip(gcs_uris,range(1992,2020)):
         mf_bands = [{'id': band_id, 'tileset_band_index': band_ids.index(band_id), 'tileset_id': os.path.basename(uri)[:-19],
                  'pyramidingPolicy': pyramiding_policy} for band_id in band_ids]
     # create complete manifest for asset upload
-    manifest = util_cloud.gee_manifest_complete(asset_name, uri, mf_bands)
-    # upload the file from GCS to GEE
-    task = util_cloud.gee_ingest(manifest)
-    print(asset_name + ' uploaded to GEE')
-    task_id.append(task)
+    manifests.append(util_cloud.gee_manifest_complete(asset_name, uri, mf_bands))
+
+# upload the files from GCS to GEE, several at a time
+for result in util_cloud.gee_ingest_many(manifests):
+    print(result['asset'] + ' uploaded to GEE')
+    task_id.append(result['task_id'])
 
 # remove files from Google Cloud Storage
 util_cloud.gcs_remove(gcs_uris, gcs_bucket=gcsBucket)
@@ -145,7 +145,5 @@ uploaded = util_cloud.aws_upload(processed_data_dir, aws_bucket, s3_prefix+os.pa
 '''
 Upload processed data to Carto
 '''
-# Upload processed shdi shapefile to carto
-util_carto.upload_to_carto(processed_shp_dir, 'LINK')
-# Upload processed shdi data to carto
-util_carto.upload_to_carto(processed_data_file, 'LINK')
+# Upload processed shdi shapefile and processed shdi data to carto at the same time
+util_carto.upload_many([processed_shp_dir, processed_data_file], 'LINK')
@@ -0,0 +1,164 @@
+'''
+Benchmark of the util_carto upload paths against the local Carto stand-in (carto_standin.py)
+Synthetic point, line and polygon geodataframes are uploaded with each path and the rows and bytes sent per second
+are reported; the column by column encoder used for INSERT queries is also compared with the row by row one.
+Usage:
+    python bench_util_carto.py --dsn "dbname=carto_standin" --rows 10000 --encode-rows 1000000
+    python bench_util_carto.py --dsn "dbname=carto_standin" --postgis-shim    # on a database without PostGIS
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import Point, LineString, Polygon
+
+# point util_carto to the stand-in before it is imported
+os.environ.setdefault('CARTO_WRI_RW_USER', 'standin')
+os.environ.setdefault('CARTO_WRI_RW_KEY', 'standin')
+os.environ.setdefault('CARTO_JOURNAL_DIR', os.path.join(tempfile.gettempdir(), 'bench_carto_journal'))
+os.environ.setdefault('CARTO_CATALOG_CACHE', os.path.join(tempfile.gettempdir(), 'bench_carto_catalog_{user}.json'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import carto_standin
+import util_carto
+
+def synthetic_gdf(n_rows, geom_type='point', n_vertices=50, seed=0):
+    '''
+    Create a geodataframe of random data with numeric, text and timestamp columns
+    INPUT   n_rows: number of rows to create (integer)
+            geom_type: type of geometries to create, 'point', 'line' or 'polygon' (string)
+            n_vertices: number of vertices of each line or polygon (integer)
+            seed: seed of the random number generator (integer)
+    RETURN  gdf: geodataframe of random data (geodataframe)
+    '''
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(-170, 170, n_rows)
+    y = rng.uniform(-80, 80, n_rows)
+    if geom_type == 'point':
+        geoms = [Point(xy) for xy in zip(x, y)]
+    else:
+        # random walks of n_vertices around each center, closed into rings for polygons
+        angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+        radii = rng.uniform(0.01, 0.5, (n_rows, n_vertices))
+        geoms = []
+        for i in range(n_rows):
+            coords = np.column_stack([x[i] + radii[i] * np.cos(angles), y[i] + radii[i] * np.sin(angles)])
+            geoms.append(LineString(coords) if geom_type == 'line' else Polygon(coords))
+    gdf = gpd.GeoDataFrame({
+        'id': np.arange(n_rows),
+        'value': rng.normal(size=n_rows),
+        'name': ["site's name {}".format(i) for i in range(n_rows)],
+        'date': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 3650, n_rows), unit='D'),
+        'geometry': geoms}, crs='EPSG:4326')
+    return gdf
+
+def schema_for(gdf):
+    '''
+    Create the Carto schema of a synthetic geodataframe
+    INPUT   gdf: geodataframe created by synthetic_gdf (geodataframe)
+    RETURN  schema: dictionary of column names and data types (dictionary)
+    '''
+    schema = util_carto.create_carto_schema(gdf)
+    schema['date'] = 'timestamp'
+    return OrderedDict(schema)
+
+def measure(name, n_rows, func):
+    '''
+    Run one upload path and measure its throughput as seen by the stand-in
+    INPUT   name: name of the path (string)
+            n_rows: number of rows uploaded (integer)
+            func: function running the path (function)
+    RETURN  result: name, rows, seconds, requests, rows per second and bytes received per second (dictionary)
+    '''
+    traffic = dict(carto_standin.traffic)
+    start = time.monotonic()
+    func()
+    seconds = time.monotonic() - start
+    received = carto_standin.traffic['bytes_received'] - traffic['bytes_received']
+    requests = carto_standin.traffic['requests'] - traffic['requests']
+    return {'path': name, 'rows': n_rows, 'seconds': round(seconds, 2), 'requests': requests,
+            'rows/s': round(n_rows / seconds), 'bytes/s': round(received / seconds), 'bytes/row': round(received / max(n_rows, 1))}
+
+def fresh_table(table, schema):
+    '''
+    Drop and create a table on the stand-in
+    INPUT   table: name of the table (string)
+            schema: dictionary of column names and data types (dictionary)
+    '''
+    util_carto.sendSql('DROP TABLE IF EXISTS "{}"'.format(table), util_carto.CARTO_USER, util_carto.CARTO_KEY)
+    util_carto.createTable(table, schema, user=util_carto.CARTO_USER, key=util_carto.CARTO_KEY)
+
+def bench_uploads(n_rows, n_vertices):
+    '''
+    Benchmark the upload paths with point, line and polygon data
+    INPUT   n_rows: number of rows of each synthetic geodataframe (integer)
+            n_vertices: number of vertices of each line or polygon (integer)
+    RETURN  results: one result per path and geometry type (list of dictionaries)
+    '''
+    results = []
+    user, key = util_carto.CARTO_USER, util_carto.CARTO_KEY
+    for geom_type in ('point', 'line', 'polygon'):
+        gdf = synthetic_gdf(n_rows, geom_type, n_vertices)
+        schema = schema_for(gdf)
+        table = 'bench_{}'.format(geom_type)
+        util_carto.sendSql('DROP TABLE IF EXISTS "{}"'.format(table), user, key)
+        paths = [
+            ('createTable', 0, lambda: util_carto.createTable(table, schema, user=user, key=key)),
+            ('shapefile_to_carto', n_rows, lambda: util_carto.shapefile_to_carto(table, schema, gdf, privacy=None, resume=False)),
+            ('createIndex', 0, lambda: util_carto.createIndex(table, 'id', unique=True, user=user, key=key)),
+            ('shapefile_to_carto wkb', n_rows, lambda: (fresh_table(table, schema), util_carto.shapefile_to_carto(
+                table, schema, gdf, privacy=None, resume=False, geometry_encoding='wkb'))),
+            ('copy_to_carto', n_rows, lambda: (fresh_table(table, schema), util_carto.copy_to_carto(table, schema, gdf))),
+            ('replace_carto_table', n_rows, lambda: util_carto.replace_carto_table(table, schema, gdf, id_field='id',
+                                                                                    time_field='date', privacy=None)),
+        ]
+        for name, rows, func in paths:
+            result = measure(name, rows, func)
+            result['geometry'] = geom_type
+            results.append(result)
+    return results
+
+def bench_encoding(n_rows):
+    '''
+    Compare the row by row and the column by column encoding of INSERT values
+    INPUT   n_rows: number of rows to encode (integer)
+    RETURN  results: one result per encoder (list of dictionaries)
+    '''
+    gdf = synthetic_gdf(n_rows, 'point')
+    schema = schema_for(gdf)
+    dtypes = tuple(schema.values())
+    results = []
+    encoders = [
+        ('per-row insert_carto_query', lambda: [util_carto.insert_carto_query(row, schema, 'bench') for index, row in gdf.iterrows()]),
+        ('columnar _dumpFrame geojson', lambda: util_carto._dumpFrame(gdf, dtypes)),
+        ('columnar _dumpFrame wkb', lambda: util_carto._dumpFrame(gdf, dtypes, 'wkb')),
+    ]
+    for name, func in encoders:
+        start = time.monotonic()
+        func()
+        seconds = time.monotonic() - start
+        results.append({'path': name, 'rows': n_rows, 'seconds': round(seconds, 2), 'rows/s': round(n_rows / seconds)})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark util_carto uploads against a local Carto stand-in')
+    parser.add_argument('--dsn', default=os.getenv('CARTO_STANDIN_DSN', 'dbname=carto_standin'),
+                        help='connection string of the PostGIS database backing the stand-in')
+    parser.add_argument('--rows', type=int, default=10000, help='rows of each synthetic layer to upload')
+    parser.add_argument('--vertices', type=int, default=50, help='vertices of each synthetic line or polygon')
+    parser.add_argument('--encode-rows', type=int, default=1000000, help='rows to encode in the encoder comparison; 0 to skip')
+    parser.add_argument('--postgis-shim', action='store_true',
+                        help='stand in for PostGIS where it is not installed; server-side geometry parsing is left out')
+    args = parser.parse_args()
+
+    server = carto_standin.start_standin(args.dsn, postgis_shim=args.postgis_shim)
+    os.environ['CARTO_SQL_URL'] = carto_standin.standin_url(server)
+    pd.set_option('display.width', 200)
+    print(pd.DataFrame(bench_uploads(args.rows, args.vertices)).to_string(index=False))
+    if args.encode_rows:
+        print(pd.DataFrame(bench_encoding(args.encode_rows)).to_string(index=False))
+    server.shutdown()
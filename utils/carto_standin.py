@@ -0,0 +1,293 @@
+'''
+Local stand-in for the Carto SQL API, backed by a PostGIS database
+It implements the parts of the API used by util_carto so that uploads can be tested and benchmarked without
+touching the live Carto account:
+    /api/v2/sql            GET and POST (JSON or gzip compressed JSON body), format json or csv
+    /api/v2/sql/copyfrom   POST, streamed (chunked) CSV body
+    /api/v2/sql/copyto     GET, streamed CSV response
+and creates simplified versions of the CDB_UserTables() and cdb_cartodbfytable() functions in the database.
+Where PostGIS is not installed, --postgis-shim replaces it with a geometry domain over text and pass-through versions of
+the PostGIS functions util_carto calls: geometries are stored as sent, so uploads can be timed but the cost of parsing
+geometries on the server is left out.
+Usage:
+    python carto_standin.py --dsn "dbname=carto_standin" --port 8765
+    export CARTO_SQL_URL=http://localhost:8765/api/v2/sql
+'''
+import os
+import io
+import csv
+import json
+import gzip
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+import logging
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# PostGIS, which provides the geometry type and functions used by util_carto
+POSTGIS = 'CREATE EXTENSION IF NOT EXISTS postgis;'
+# stand-in for PostGIS where it is not installed: geometries are kept as the hex EWKB or GeoJSON text they are sent as
+POSTGIS_SHIM = '''
+DO $$ BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'geometry') THEN
+        CREATE DOMAIN geometry AS text;
+    END IF;
+END $$;
+CREATE OR REPLACE FUNCTION ST_GeomFromGeoJSON(text) RETURNS geometry AS $$ SELECT $1::geometry $$ LANGUAGE sql IMMUTABLE;
+CREATE OR REPLACE FUNCTION ST_GeomFromWKB(bytea, integer) RETURNS geometry AS $$
+    SELECT upper(encode($1, 'hex'))::geometry
+$$ LANGUAGE sql IMMUTABLE;
+CREATE OR REPLACE FUNCTION ST_SetSRID(geometry, integer) RETURNS geometry AS $$ SELECT $1 $$ LANGUAGE sql IMMUTABLE;
+'''
+# simplified versions of the Carto functions called by util_carto
+CARTO_FUNCTIONS = '''
+CREATE OR REPLACE FUNCTION CDB_UserTables() RETURNS SETOF name AS $$
+    SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = current_schema() AND c.relkind = 'r' AND c.relname NOT IN ('spatial_ref_sys')
+$$ LANGUAGE sql STABLE;
+CREATE OR REPLACE FUNCTION cdb_cartodbfytable(user_name text, table_name text) RETURNS void AS $$
+BEGIN
+    EXECUTE format('ALTER TABLE %s ADD COLUMN IF NOT EXISTS cartodb_id bigserial', table_name);
+    EXECUTE format('ALTER TABLE %s ADD COLUMN IF NOT EXISTS the_geom geometry', table_name);
+    EXECUTE format('ALTER TABLE %s ADD COLUMN IF NOT EXISTS the_geom_webmercator geometry', table_name);
+END
+$$ LANGUAGE plpgsql;
+'''
+
+# Carto type of the columns of query results, by PostgreSQL type; other types are strings
+CARTO_TYPES = {'int2': 'number', 'int4': 'number', 'int8': 'number', 'float4': 'number', 'float8': 'number',
+               'numeric': 'number', 'bool': 'boolean', 'date': 'date', 'timestamp': 'date', 'timestamptz': 'date',
+               'geometry': 'geometry', 'geography': 'geometry'}
+
+# number of bytes received in request bodies and sent in responses, used by the benchmark to measure payload sizes
+traffic = {'bytes_received': 0, 'bytes_sent': 0, 'requests': 0}
+_traffic_lock = threading.Lock()
+
+def _count(received=0, sent=0):
+    '''
+    Add to the traffic counters
+    INPUT   received: number of bytes received (integer)
+            sent: number of bytes sent (integer)
+    '''
+    with _traffic_lock:
+        traffic['bytes_received'] += received
+        traffic['bytes_sent'] += sent
+
+class _ChunkedReader(io.RawIOBase):
+    '''
+    File-like object decoding a request body sent with chunked transfer encoding, so that COPY can read it as it arrives
+    INPUT   stream: the socket file of the request (file)
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.remaining = 0
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.done:
+            return 0
+        if self.remaining == 0:
+            # read the size of the next chunk, skipping the line break that ends the previous one
+            line = self.stream.readline()
+            if line in (b'\r\n', b'\n'):
+                line = self.stream.readline()
+            self.remaining = int(line.split(b';')[0].strip() or b'0', 16)
+            if self.remaining == 0:
+                # read the trailer
+                while self.stream.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                self.done = True
+                return 0
+        data = self.stream.read(min(len(buffer), self.remaining))
+        self.remaining -= len(data)
+        buffer[:len(data)] = data
+        _count(received=len(data))
+        return len(data)
+
+class CartoHandler(BaseHTTPRequestHandler):
+    '''
+    Request handler implementing the Carto SQL API endpoints used by util_carto
+    '''
+    pool = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, body, content_type='application/json'):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        _count(sent=len(body))
+        with _traffic_lock:
+            traffic['requests'] += 1
+
+    def _error(self, status, message):
+        self._send(status, json.dumps({'error': [message]}))
+
+    def _body(self):
+        # read the whole body of a regular request, decompressing it if needed
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = _ChunkedReader(self.rfile).read()
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            _count(received=len(body))
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _params(self):
+        # query string parameters
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        return params
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        params = self._params()
+        if path.endswith('/sql/copyto'):
+            return self._copyTo(params['q'])
+        if path.endswith('/sql'):
+            return self._query(params.get('q', ''), params.get('format', ''))
+        self._error(404, 'Not found: ' + path)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        params = self._params()
+        if path.endswith('/sql/copyfrom'):
+            return self._copyFrom(params['q'])
+        if path.endswith('/sql'):
+            body = self._body()
+            if body:
+                params.update(json.loads(body))
+            return self._query(params.get('q', ''), params.get('format', ''))
+        self._error(404, 'Not found: ' + path)
+
+    def _query(self, sql, f=''):
+        start = time.monotonic()
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql)
+                description = cursor.description or []
+                fields = [column.name for column in description]
+                rows = cursor.fetchall() if cursor.description else []
+                total_rows = cursor.rowcount
+                # describe the columns with their Carto and PostgreSQL types, as the SQL API does
+                types = {}
+                if description:
+                    cursor.execute('SELECT oid, typname FROM pg_type WHERE oid = ANY(%s)',
+                                   ([column.type_code for column in description],))
+                    types = dict(cursor.fetchall())
+                pgtypes = [types.get(column.type_code, 'text') for column in description]
+        except psycopg2.Error as e:
+            return self._error(400, str(e).strip())
+        finally:
+            self.pool.putconn(conn)
+        if f == 'csv':
+            output = io.StringIO()
+            writer = csv.writer(output, lineterminator='\n')
+            writer.writerow(fields)
+            writer.writerows(rows)
+            return self._send(200, output.getvalue(), 'text/csv')
+        # the SQL API writes numbers as JavaScript does, without a decimal point for whole numbers
+        rows = [[int(value) if isinstance(value, float) and value.is_integer() else value for value in row] for row in rows]
+        self._send(200, json.dumps({'rows': [dict(zip(fields, row)) for row in rows],
+                                    'time': time.monotonic() - start,
+                                    'fields': {field: {'type': CARTO_TYPES.get(pgtype, 'string'), 'pgtype': pgtype}
+                                               for field, pgtype in zip(fields, pgtypes)},
+                                    'total_rows': total_rows if total_rows >= 0 else len(rows)}, default=str))
+
+    def _copyFrom(self, sql):
+        start = time.monotonic()
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = io.BufferedReader(_ChunkedReader(self.rfile))
+        else:
+            body = io.BytesIO(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            _count(received=len(body.getvalue()))
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(sql, body)
+                total_rows = cursor.rowcount
+        except psycopg2.Error as e:
+            return self._error(400, str(e).strip())
+        finally:
+            self.pool.putconn(conn)
+        self._send(200, json.dumps({'time': time.monotonic() - start, 'total_rows': total_rows}))
+
+    def _copyTo(self, sql):
+        output = io.BytesIO()
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(sql, output)
+        except psycopg2.Error as e:
+            return self._error(400, str(e).strip())
+        finally:
+            self.pool.putconn(conn)
+        # Carto sends the output of COPY TO as binary, without a charset
+        self._send(200, output.getvalue(), 'application/octet-stream')
+
+def start_standin(dsn, host='localhost', port=0, max_connections=64, postgis_shim=False):
+    '''
+    Start the stand-in server in a background thread
+    INPUT   dsn: connection string of the PostGIS database backing the stand-in (string)
+            host: host name to listen on (string)
+            port: port to listen on; 0 picks a free port (integer)
+            max_connections: maximum number of database connections, ie requests handled at the same time (integer)
+            postgis_shim: whether to replace PostGIS with POSTGIS_SHIM, for databases where it is not installed (boolean)
+    RETURN  server, whose server_address holds the host and port it listens on (ThreadingHTTPServer)
+    '''
+    # keep every connection open: the pool closes connections returned beyond minconn, and new ones would not be in
+    # autocommit mode, so their statements would be rolled back
+    pool = ThreadedConnectionPool(max_connections, max_connections, dsn)
+    # create the Carto functions and run every request in its own transaction
+    conn = pool.getconn()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(POSTGIS_SHIM if postgis_shim else POSTGIS)
+        cursor.execute(CARTO_FUNCTIONS)
+    pool.putconn(conn)
+    for conn in [pool.getconn() for i in range(max_connections)]:
+        conn.autocommit = True
+        pool.putconn(conn)
+    handler = type('Handler', (CartoHandler,), {'pool': pool})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Carto stand-in listening on http://{}:{}/api/v2/sql'.format(*server.server_address))
+    return server
+
+def standin_url(server):
+    '''
+    Get the url to set CARTO_SQL_URL to in order to send util_carto requests to a stand-in server
+    INPUT   server: server returned by start_standin (ThreadingHTTPServer)
+    RETURN  url of the stand-in SQL API (string)
+    '''
+    return 'http://{}:{}/api/v2/sql'.format(*server.server_address)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Carto SQL API, backed by PostGIS')
+    parser.add_argument('--dsn', default=os.getenv('CARTO_STANDIN_DSN', 'dbname=carto_standin'),
+                        help='connection string of the PostGIS database')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--postgis-shim', action='store_true', help='stand in for PostGIS where it is not installed')
+    args = parser.parse_args()
+    logger.setLevel(logging.INFO)
+    server = start_standin(args.dsn, args.host, args.port, postgis_shim=args.postgis_shim)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,411 @@
+'''
+Tests of the util_carto upload functions
+The encoders, batching, retry and concurrency helpers are checked offline; the upload paths are run against the local
+Carto stand-in (carto_standin.py), backed by a throwaway PostgreSQL server started with pgserver. PostGIS is not
+needed: the stand-in replaces it with its pass-through shim, so geometries are stored as they are sent.
+Usage:
+    pip install pytest pgserver psycopg2-binary
+    python -m pytest utils/test_util_carto.py
+'''
+import os
+import re
+import sys
+import time
+import email.utils
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import requests
+import pytest
+from shapely import wkb
+from shapely.geometry import Point, Polygon
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import util_carto
+
+SCHEMA = OrderedDict([('id', 'numeric'), ('name', 'text'), ('value', 'numeric'), ('date', 'timestamp'),
+                      ('the_geom', 'geometry')])
+
+def _sampleGdf(n_rows, seed=0):
+    '''
+    Create a geodataframe matching SCHEMA, with quotes, nulls and points
+    INPUT   n_rows: number of rows to create (integer)
+            seed: seed of the random number generator (integer)
+    RETURN  gdf: geodataframe of random data (geodataframe)
+    '''
+    rng = np.random.default_rng(seed)
+    value = rng.normal(size=n_rows).round(3)
+    value[::7] = np.nan
+    return gpd.GeoDataFrame({
+        'id': np.arange(n_rows),
+        'name': [None if i % 5 == 0 else "site's name {}".format(i) for i in range(n_rows)],
+        'value': value,
+        'date': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 3650, n_rows), unit='D'),
+        'geometry': [Point(x, y) for x, y in zip(rng.uniform(-170, 170, n_rows).round(4), rng.uniform(-80, 80, n_rows).round(4))]},
+        crs='EPSG:4326')
+
+def test_dump_frame_matches_row_queries():
+    gdf = gpd.GeoDataFrame({
+        'id': [1, 2, 3],
+        'name': ["site's", None, 'b'],
+        'value': [1.5, np.nan, 2.0],
+        'date': pd.to_datetime(['2020-01-01 00:00', '2020-01-02 10:00', None]),
+        'geometry': [Point(1, 2), Point(3.5, 4), Polygon([(0, 0), (1, 0), (1, 1)])]}, crs='EPSG:4326')
+    values = util_carto._dumpFrame(gdf, tuple(SCHEMA.values()))
+    prefix = 'INSERT INTO "test" ({}) VALUES '.format(', '.join(SCHEMA.keys()))
+    assert [prefix + value for value in values] == [util_carto.insert_carto_query(gdf.iloc[i], SCHEMA, 'test') for i in range(3)]
+    assert "'site''s'" in values[0] and values[1].startswith('(2,NULL,NULL,')
+
+def test_dump_frame_geometries():
+    gdf = gpd.GeoDataFrame({'id': [1, 2], 'geometry': [Point(1, 2), None]}, crs='EPSG:4326')
+    dtypes = ('numeric', 'geometry')
+    assert util_carto._dumpFrame(gdf, dtypes)[1] == '(2,NULL)'
+    hexed = util_carto._dumpFrame(gdf, dtypes, geometry_encoding='wkb')
+    assert hexed == ["(1,ST_GeomFromWKB(decode('{}','hex'),4326))".format(Point(1, 2).wkb_hex), '(2,NULL)']
+    # geometries that are already sql are passed on as they are
+    df = pd.DataFrame({'id': [1, 2], 'geometry': pd.Series(['ST_MakePoint(1, 2)', Point(1, 2)], dtype=object)})
+    assert util_carto._dumpFrame(df, dtypes, geometry_encoding='wkb') == ['(1,ST_MakePoint(1, 2))', hexed[0].replace('(1,', '(2,')]
+    assert util_carto._dumpFrame(gdf.iloc[:0], dtypes) == []
+
+def test_insert_carto_batches_splits_by_rows_and_bytes():
+    gdf = _sampleGdf(50)
+    prefix = 'INSERT INTO "test" ({}) VALUES '.format(', '.join(SCHEMA.keys()))
+    batches = list(util_carto.insert_carto_batches(gdf, SCHEMA, 'test', batch_size=20, max_payload_bytes=None))
+    assert [(n_rows, rows) for query, n_rows, rows in batches] == [(20, (0, 20)), (20, (20, 40)), (10, (40, 50))]
+    values = util_carto._dumpFrame(gdf, tuple(SCHEMA.values()))
+    assert [query for query, n_rows, rows in batches] == [prefix + ','.join(values[i:i + 20]) for i in (0, 20, 40)]
+    # a payload limit splits the batches further, without ever going over the limit
+    max_bytes = len(prefix) + 6 * max(len(value) + 1 for value in values)
+    batches = list(util_carto.insert_carto_batches(gdf, SCHEMA, 'test', batch_size=20, max_payload_bytes=max_bytes))
+    assert all(len(query.encode('utf-8')) <= max_bytes for query, n_rows, rows in batches)
+    assert len(batches) > 3 and sum(n_rows for query, n_rows, rows in batches) == 50
+    ranges = [rows for query, n_rows, rows in batches]
+    assert ranges[0][0] == 0 and ranges[-1][1] == 50 and all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+    # a row larger than the limit is sent on its own
+    batches = list(util_carto.insert_carto_batches(gdf, SCHEMA, 'test', batch_size=20, max_payload_bytes=10))
+    assert len(batches) == 50 and all(n_rows == 1 for query, n_rows, rows in batches)
+
+def test_insert_carto_batches_skip_and_upsert():
+    gdf = _sampleGdf(30)
+    batches = list(util_carto.insert_carto_batches(gdf, SCHEMA, 'test', batch_size=10, max_payload_bytes=None,
+                                                   skip_ranges=[(0, 10), (15, 20)], upsert_field='id'))
+    assert [rows for query, n_rows, rows in batches] == [(10, 15), (20, 30)]
+    assert all(query.endswith(' ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, value = EXCLUDED.value, '
+                              'date = EXCLUDED.date, the_geom = EXCLUDED.the_geom') for query, n_rows, rows in batches)
+
+def test_pending_ranges():
+    assert util_carto._pendingRanges(10) == [(0, 10)]
+    assert util_carto._pendingRanges(10, []) == [(0, 10)]
+    assert util_carto._pendingRanges(10, [(0, 10)]) == []
+    assert util_carto._pendingRanges(10, [(6, 8), (0, 2)]) == [(2, 6), (8, 10)]
+    # overlapping and out of range batches
+    assert util_carto._pendingRanges(10, [(0, 4), (2, 5), (9, 20)]) == [(5, 9)]
+    assert util_carto._pendingRanges(0, [(0, 5)]) == []
+
+def _response(headers):
+    '''
+    Build a response with the given headers
+    INPUT   headers: headers of the response (dictionary)
+    RETURN  response (requests response)
+    '''
+    response = requests.Response()
+    response.status_code = 429
+    response.headers.update(headers)
+    return response
+
+def test_retry_wait():
+    # full jitter, growing exponentially up to max_wait
+    assert all(0 <= util_carto._retryWait(0) <= 1 for i in range(100))
+    assert all(0 <= util_carto._retryWait(3) <= 8 for i in range(100))
+    assert max(util_carto._retryWait(20, max_wait=60) for i in range(100)) <= 60
+    # a Retry-After header takes precedence, in seconds or as an HTTP date, capped at max_wait
+    assert util_carto._retryWait(0, _response({'Retry-After': '7'})) == 7
+    assert util_carto._retryWait(0, _response({'Retry-After': '600'}), max_wait=60) == 60
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= util_carto._retryWait(0, _response({'Retry-After': date})) <= 30
+    assert util_carto._retryWait(0, _response({'Retry-After': email.utils.formatdate(time.time() - 30, usegmt=True)})) == 0
+    assert 0 <= util_carto._retryWait(0, _response({'Retry-After': 'soon'})) <= 1
+
+def test_concurrency_controller_grows_and_backs_off():
+    controller = util_carto.ConcurrencyController(initial=4, minimum=1, maximum=6)
+    # one more request in flight for every round of fast requests
+    for i in range(5):
+        controller.success(0.1)
+    assert controller.level == 5
+    for i in range(20):
+        controller.success(0.1)
+    assert controller.level == 6
+    # throttling halves the level, once per round trip
+    controller.throttled(_response({}))
+    controller.throttled(None)
+    assert controller.level == 3
+    controller.last_decrease -= 1
+    controller.throttled(None)
+    assert controller.level == 1
+    controller.last_decrease -= 1
+    controller.throttled(None)
+    assert controller.level == 1
+    assert [level for seconds, level in controller.history] == [4, 5, 6, 3, 1]
+
+def test_concurrency_controller_backs_off_when_slow():
+    controller = util_carto.ConcurrencyController(initial=8, maximum=8)
+    controller.success(0.1)
+    # the smoothed latency goes over twice the baseline after a few slow requests
+    for i in range(10):
+        controller.success(1)
+        if controller.level < 8:
+            break
+    assert controller.level == 4
+
+def test_copy_rows():
+    gdf = gpd.GeoDataFrame({'id': [1, 2, 3], 'name': ['say "hi"', None, 'a,b'], 'value': [1.5, np.nan, 3.0],
+                            'date': pd.to_datetime(['2020-01-01', None, '2020-01-03']),
+                            'geometry': [Point(1, 2), None, Point(3, 4)]}, crs='EPSG:4326')
+    counter = [0]
+    chunks = list(util_carto._copyRows(gdf, SCHEMA, chunk_rows=2, counter=counter))
+    assert len(chunks) == 2 and counter == [3]
+    lines = b''.join(chunks).decode('utf-8').splitlines()
+    assert lines[0] == '1,"say ""hi""",1.5,"2020-01-01 00:00:00",{}'.format(wkb.dumps(Point(1, 2), hex=True, srid=4326))
+    assert lines[1] == '2,,,,'
+    assert lines[2].startswith('3,"a,b",3.0,')
+    assert wkb.loads(lines[2].split(',')[-1], hex=True).equals(Point(3, 4))
+
+@pytest.fixture(scope='module')
+def standin(tmp_path_factory):
+    '''
+    Start the Carto stand-in on a throwaway PostgreSQL server and point util_carto to it
+    '''
+    pgserver = pytest.importorskip('pgserver')
+    pytest.importorskip('psycopg2')
+    import carto_standin
+    db = pgserver.get_server(str(tmp_path_factory.mktemp('pgdata')), cleanup_mode='stop')
+    server = carto_standin.start_standin(db.get_uri(), max_connections=8, postgis_shim=True)
+    patch = pytest.MonkeyPatch()
+    patch.setenv('CARTO_SQL_URL', carto_standin.standin_url(server))
+    patch.setattr(util_carto, 'CARTO_USER', 'standin')
+    patch.setattr(util_carto, 'CARTO_KEY', 'standin')
+    yield server
+    patch.undo()
+    server.shutdown()
+    db.cleanup()
+
+@pytest.fixture
+def carto(standin, tmp_path, monkeypatch, request):
+    '''
+    Keep the journals and the table catalog of each test apart, and name a table for the test
+    '''
+    monkeypatch.setattr(util_carto, 'CARTO_JOURNAL_DIR', str(tmp_path / 'journal'))
+    monkeypatch.setattr(util_carto, 'CARTO_CATALOG_CACHE', str(tmp_path / 'catalog_{user}.json'))
+    monkeypatch.setattr(util_carto, '_catalog', {})
+    table = re.sub('[^a-z0-9_]', '_', request.node.name.lower())[:50]
+    yield table
+    for name in (table, table + '_staging'):
+        util_carto.sendSql('DROP TABLE IF EXISTS "{}"'.format(name), util_carto.CARTO_USER, util_carto.CARTO_KEY)
+
+def _readTable(table):
+    '''
+    Read the SCHEMA columns of a table back from the stand-in, in the order of their ids
+    INPUT   table: the name of the Carto table (string)
+    RETURN  rows of the table (dataframe)
+    '''
+    return util_carto.read_carto_table('SELECT {} FROM "{}" ORDER BY id'.format(', '.join(SCHEMA.keys()), table))
+
+def _assertContent(table, gdf):
+    '''
+    Check that a table holds the attributes of a geodataframe
+    INPUT   table: the name of the Carto table (string)
+            gdf: geodataframe the table should match (geodataframe)
+    '''
+    df = _readTable(table)
+    assert df['id'].tolist() == gdf['id'].tolist()
+    assert df['name'].fillna('').tolist() == gdf['name'].fillna('').tolist()
+    np.testing.assert_allclose(df['value'].astype(float), gdf['value'])
+    assert df['the_geom'].notnull().all()
+
+def test_sync_to_carto(carto):
+    gdf = _sampleGdf(40)
+    util_carto.checkCreateTable(carto, SCHEMA, id_field='id')
+    counts = util_carto.sync_to_carto(carto, SCHEMA, gdf, 'id', hash_field='row_hash', batch_size=15)
+    assert counts == {'inserted': 40, 'updated': 0, 'unchanged': 0}
+    # change one row and add another
+    gdf.loc[3, 'name'] = 'renamed'
+    gdf = pd.concat([gdf, _sampleGdf(41).iloc[[40]]], ignore_index=True)
+    counts = util_carto.sync_to_carto(carto, SCHEMA, gdf, 'id', hash_field='row_hash', batch_size=15)
+    assert counts == {'inserted': 1, 'updated': 1, 'unchanged': 39}
+    _assertContent(carto, gdf)
+    assert util_carto.sync_to_carto(carto, SCHEMA, gdf, 'id', hash_field='row_hash') == {'inserted': 0, 'updated': 0, 'unchanged': 41}
+
+@pytest.mark.parametrize('method', ['copy', 'insert'])
+def test_replace_carto_table(carto, method):
+    # the table is created by the first replacement
+    util_carto.replace_carto_table(carto, SCHEMA, _sampleGdf(30), id_field='id', privacy=None, method=method)
+    _assertContent(carto, _sampleGdf(30))
+    oid = util_carto._tableOid(carto)
+    # later replacements keep the table and swap its content
+    gdf = _sampleGdf(20, seed=1)
+    assert util_carto.replace_carto_table(carto, SCHEMA, gdf, id_field='id', privacy=None, method=method) == 20
+    _assertContent(carto, gdf)
+    assert util_carto._tableOid(carto) == oid
+    assert not util_carto.tableExists(carto + '_staging')
+
+def _interrupt(monkeypatch, n_requests):
+    '''
+    Make the requests sending rows to Carto fail after the first n_requests
+    INPUT   n_requests: number of requests to let through (integer)
+    '''
+    send = util_carto.insert_carto_send
+    sent = []
+
+    def flaky(*args):
+        if len(sent) >= n_requests:
+            raise requests.ConnectionError('connection reset')
+        sent.append(args)
+        return send(*args)
+
+    monkeypatch.setattr(util_carto, 'insert_carto_send', flaky)
+
+def test_insert_to_carto_resumes(carto, monkeypatch):
+    gdf = _sampleGdf(100)
+    util_carto.checkCreateTable(carto, SCHEMA, id_field='id')
+    with pytest.raises(ValueError):
+        util_carto.insert_to_carto(carto, SCHEMA, gdf, resume=True)
+    with monkeypatch.context() as patch:
+        _interrupt(patch, 5)
+        with pytest.raises(requests.ConnectionError):
+            util_carto.insert_to_carto(carto, SCHEMA, gdf, batch_size=10, max_in_flight=1, resume=True,
+                                       upsert_field='id', adaptive=False)
+    assert len(_readTable(carto)) == 50
+    stats = util_carto.insert_to_carto(carto, SCHEMA, gdf, batch_size=10, max_in_flight=1, resume=True,
+                                       upsert_field='id', adaptive=False)
+    assert (stats['skipped'], stats['rows']) == (50, 50)
+    _assertContent(carto, gdf)
+    # the journal is removed once the upload completes
+    assert os.listdir(util_carto.CARTO_JOURNAL_DIR) == []
+
+def test_frame_hash_covers_content():
+    gdf = _sampleGdf(20)
+    assert util_carto._frameHash(gdf, SCHEMA) == util_carto._frameHash(gdf.copy(), SCHEMA)
+    changed = gdf.copy()
+    changed.loc[5, 'value'] = 100
+    assert util_carto._frameHash(changed, SCHEMA) != util_carto._frameHash(gdf, SCHEMA)
+    moved = gdf.copy()
+    moved.loc[5, 'geometry'] = Point(0, 0)
+    assert util_carto._frameHash(moved, SCHEMA) != util_carto._frameHash(gdf, SCHEMA)
+
+def test_insert_to_carto_does_not_resume_changed_data(carto, monkeypatch):
+    util_carto.checkCreateTable(carto, SCHEMA, id_field='id')
+    with monkeypatch.context() as patch:
+        _interrupt(patch, 5)
+        with pytest.raises(requests.ConnectionError):
+            util_carto.insert_to_carto(carto, SCHEMA, _sampleGdf(100), batch_size=10, max_in_flight=1, resume=True,
+                                       upsert_field='id', adaptive=False)
+    # different data with the same length and index is sent in full
+    gdf = _sampleGdf(100, seed=1)
+    stats = util_carto.insert_to_carto(carto, SCHEMA, gdf, batch_size=10, max_in_flight=1, resume=True,
+                                       upsert_field='id', adaptive=False)
+    assert (stats['skipped'], stats['rows']) == (0, 100)
+    _assertContent(carto, gdf)
+
+def test_fetch_ids_decodes_copy_output(carto):
+    util_carto.sendSql('CREATE TABLE "{}" (id text, row_hash text)'.format(carto), util_carto.CARTO_USER, util_carto.CARTO_KEY)
+    ids = {'São Paulo': 'h1', 'line\nbreak': 'h2', 'say "hi", twice': 'h3', '東京': None}
+    util_carto.sendSql('INSERT INTO "{}" VALUES {}'.format(carto, ','.join(
+        "('{}',{})".format(id, "'{}'".format(row_hash) if row_hash else 'NULL') for id, row_hash in ids.items())),
+        util_carto.CARTO_USER, util_carto.CARTO_KEY)
+    assert util_carto.fetchIds(carto, 'id', 'row_hash') == {id: row_hash or '' for id, row_hash in ids.items()}
+    assert util_carto.fetchIds(carto, 'id') == dict.fromkeys(ids)
+
+def test_table_exists_caches_and_forgets_dropped_tables(carto, monkeypatch):
+    user, key = util_carto.CARTO_USER, util_carto.CARTO_KEY
+    util_carto.sendSql('CREATE TABLE "{}" (id numeric)'.format(carto), user, key)
+    assert util_carto.tableExists(carto, user, key)
+    # the list of tables fetched by the first check answers the next ones
+    requests_sent = []
+    request = util_carto._request
+    monkeypatch.setattr(util_carto, '_request', lambda *args, **kwargs: requests_sent.append(args) or request(*args, **kwargs))
+    assert util_carto.tableExists(carto, user, key)
+    assert requests_sent == []
+    # a dropped table is not reported from the cache
+    util_carto.sendSql('DROP TABLE "{}"'.format(carto), user, key)
+    assert not util_carto.tableExists(carto, user, key)
+    assert util_carto.checkCreateTable(carto, SCHEMA, id_field='id') == []
+    assert util_carto.tableExists(carto, user, key)
+
+class _FakeJob:
+    '''
+    Import job of _FakeImportManager, which fails for files whose name starts with "fail"
+    '''
+    def __init__(self, archive, error):
+        self.archive = archive
+        self.table_name = os.path.splitext(os.path.basename(archive.name))[0]
+        self.error = error
+        self.state = 'pending'
+
+    def run(self, **import_params):
+        assert not self.archive.closed
+        self.content = self.archive.read()
+
+    def refresh(self):
+        if self.table_name.startswith('fail'):
+            self.state, self.error_code, self.get_error_text = 'failure', 1022, self.error
+        else:
+            self.state = 'complete'
+
+class _FakeImportManager:
+    '''
+    Stand-in for the FileImportJobManager of the carto SDK, recording the jobs created
+    '''
+    jobs = []
+    error = ''
+
+    def __init__(self, auth_client):
+        pass
+
+    def create(self, archive):
+        job = _FakeJob(archive, self.error)
+        self.jobs.append(job)
+        return job
+
+class _FakeDataset:
+    def save(self):
+        pass
+
+class _FakeDatasetManager:
+    def __init__(self, auth_client):
+        pass
+
+    def get(self, table_name):
+        return _FakeDataset()
+
+@pytest.fixture
+def fake_import(monkeypatch):
+    '''
+    Replace the carto SDK managers used by upload_many with fakes
+    '''
+    monkeypatch.setattr(_FakeImportManager, 'jobs', [])
+    monkeypatch.setattr(_FakeImportManager, 'error', '')
+    monkeypatch.setattr(util_carto, 'FileImportJobManager', _FakeImportManager)
+    monkeypatch.setattr(util_carto, 'DatasetManager', _FakeDatasetManager)
+    monkeypatch.setattr(util_carto, '_authClient', lambda: None)
+    monkeypatch.setattr(util_carto.time, 'sleep', lambda seconds: None)
+    return _FakeImportManager
+
+def test_upload_many_closes_files_and_reports_errors(fake_import, tmp_path, caplog):
+    files = [tmp_path / 'ok.csv', tmp_path / 'fail.csv']
+    for file in files:
+        file.write_text('id\n1\n')
+    fake_import.error = 'Unable to connect to the database'
+    with pytest.raises(util_carto.CartoUploadError) as error:
+        util_carto.upload_many([str(file) for file in files], 'LINK', collision_strategy='skip')
+    assert error.value.tables == {str(files[0]): 'ok'} and list(error.value.failed) == [str(files[1])]
+    assert all(job.archive.closed and job.content == b'id\n1\n' for job in fake_import.jobs)
+    # the real error is logged, without the collision hint
+    assert 'Unable to connect to the database' in caplog.text
+    assert 'already exist' not in caplog.text
+    # a collision gets the hint
+    caplog.clear()
+    fake_import.error = 'The table already exists'
+    with pytest.raises(util_carto.CartoUploadError):
+        util_carto.upload_many([str(files[1])], 'LINK', collision_strategy='skip')
+    assert 'try setting collision_strategy to overwrite' in caplog.text
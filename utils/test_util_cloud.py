@@ -0,0 +1,233 @@
+'''
+Tests of the util_cloud upload functions against local stand-ins of the cloud services:
+    Google Cloud Storage    gcp-storage-emulator, an in-process fake GCS server reached through STORAGE_EMULATOR_HOST
+    Amazon S3               moto
+Usage:
+    pip install pytest gcp-storage-emulator "moto[s3]"
+    python -m pytest utils/test_util_cloud.py
+'''
+import os
+import sys
+import socket
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import util_cloud
+
+def _freePort():
+    '''
+    Find a free local port for the fake GCS server
+    RETURN  port number (integer)
+    '''
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope='module')
+def gcs_server():
+    '''
+    Start a fake GCS server for the tests of this module
+    '''
+    emulator = pytest.importorskip('gcp_storage_emulator.server')
+    port = _freePort()
+    server = emulator.create_server('localhost', port, in_memory=True)
+    server.start()
+    os.environ['STORAGE_EMULATOR_HOST'] = 'http://localhost:{}'.format(port)
+    yield server
+    server.stop()
+    del os.environ['STORAGE_EMULATOR_HOST']
+
+@pytest.fixture
+def gcs_bucket(gcs_server, request):
+    '''
+    Create an empty bucket on the fake GCS server
+    '''
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import storage
+    client = storage.Client(project='test', credentials=AnonymousCredentials())
+    bucket = client.create_bucket(request.node.name.replace('_', '-').lower()[:60])
+    yield bucket
+    for blob in client.list_blobs(bucket):
+        blob.delete()
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    '''
+    Use parts small enough for composite uploads of small test files
+    '''
+    monkeypatch.setattr(util_cloud, 'GCS_COMPOSITE_PART_SIZE', 1024)
+
+def _writeFile(path, size):
+    '''
+    Write a file of random bytes
+    INPUT   path: file name (pathlib.Path)
+            size: size of the file in bytes (integer)
+    RETURN  content of the file (bytes)
+    '''
+    content = os.urandom(size)
+    path.write_bytes(content)
+    return content
+
+def test_gcs_upload_small_file_single_upload(gcs_bucket, small_parts, tmp_path, monkeypatch):
+    content = _writeFile(tmp_path / 'small.tif', 2000)
+    composed = []
+    monkeypatch.setattr(util_cloud.storage.Blob, 'compose', lambda self, *args, **kwargs: composed.append(self.name))
+    gcs_uris = util_cloud.gcs_upload(str(tmp_path / 'small.tif'), 'test', gcs_bucket=gcs_bucket, composite_threshold=4096)
+    assert gcs_uris == ['gs://{}/test/small.tif'.format(gcs_bucket.name)]
+    assert composed == []
+    assert [blob.name for blob in gcs_bucket.list_blobs()] == ['test/small.tif']
+    assert gcs_bucket.blob('test/small.tif').download_as_bytes() == content
+
+def test_gcs_upload_large_file_composite(gcs_bucket, small_parts, tmp_path, monkeypatch):
+    files = [tmp_path / 'small.tif', tmp_path / 'large.tif']
+    contents = [_writeFile(files[0], 2000), _writeFile(files[1], 10000)]
+    # record the parts each object is composed from
+    composed = {}
+    compose = util_cloud.storage.Blob.compose
+
+    def spy(self, sources, *args, **kwargs):
+        composed[self.name] = [source.name for source in sources]
+        return compose(self, sources, *args, **kwargs)
+
+    monkeypatch.setattr(util_cloud.storage.Blob, 'compose', spy)
+    gcs_uris = util_cloud.gcs_upload([str(f) for f in files], 'test', gcs_bucket=gcs_bucket, composite_threshold=4096)
+    # the URIs keep the order of the files
+    assert gcs_uris == ['gs://{}/test/small.tif'.format(gcs_bucket.name), 'gs://{}/test/large.tif'.format(gcs_bucket.name)]
+    # the large file was composed from its parts, which were removed
+    assert sorted(blob.name for blob in gcs_bucket.list_blobs()) == ['test/large.tif', 'test/small.tif']
+    assert list(composed) == ['test/large.tif'] and len(composed['test/large.tif']) > 1
+    assert gcs_bucket.blob('test/large.tif').download_as_bytes() == contents[1]
+    assert gcs_bucket.blob('test/small.tif').download_as_bytes() == contents[0]
+
+def test_gcs_upload_removes_parts_when_compose_fails(gcs_bucket, small_parts, tmp_path, monkeypatch):
+    _writeFile(tmp_path / 'large.tif', 10000)
+
+    def fail(self, *args, **kwargs):
+        raise RuntimeError('compose failed')
+
+    monkeypatch.setattr(util_cloud.storage.Blob, 'compose', fail)
+    with pytest.raises(RuntimeError):
+        util_cloud.gcs_upload(str(tmp_path / 'large.tif'), 'test', gcs_bucket=gcs_bucket, composite_threshold=4096)
+    assert list(gcs_bucket.list_blobs()) == []
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    '''
+    Create an empty bucket on a moto mock of Amazon S3
+    '''
+    moto = pytest.importorskip('moto')
+    monkeypatch.setenv('aws_access_key_id', 'testing')
+    monkeypatch.setenv('aws_secret_access_key', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    with moto.mock_aws():
+        # clients created before the mock started would send their requests to the real S3
+        util_cloud.clearS3Clients()
+        util_cloud._s3Client().create_bucket(Bucket='test')
+        yield 'test'
+        util_cloud.clearS3Clients()
+
+def test_s3_client_reused(s3_bucket, tmp_path, monkeypatch):
+    s3 = util_cloud._s3Client()
+    created = []
+    client = util_cloud.boto3.client
+    monkeypatch.setattr(util_cloud.boto3, 'client', lambda *args, **kwargs: created.append(args) or client(*args, **kwargs))
+    _writeFile(tmp_path / 'a.tif', 2000)
+    _writeFile(tmp_path / 'b.tif', 2000)
+    assert util_cloud.aws_upload_many([(str(tmp_path / 'a.tif'), 'a.tif'), (str(tmp_path / 'b.tif'), 'b.tif')], s3_bucket) == [True, True]
+    assert util_cloud._s3Client() is s3
+    assert created == []
+
+def test_s3_multipart_etag(s3_bucket, tmp_path):
+    # S3 does not accept parts smaller than 5 MB, except for the last one
+    part_size = 5 * 1024 * 1024
+    _writeFile(tmp_path / 'large.tif', 2 * part_size + 1000)
+    config = util_cloud.TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size)
+    s3 = util_cloud._s3Client()
+    s3.upload_file(str(tmp_path / 'large.tif'), s3_bucket, 'large.tif', Config=config)
+    checksums = util_cloud._fileChecksums(str(tmp_path / 'large.tif'), part_size)
+    etag = s3.head_object(Bucket=s3_bucket, Key='large.tif')['ETag'].strip('"')
+    assert etag == checksums['multipart_etag'] and etag.endswith('-3')
+    # an object uploaded in parts without the MD5 metadata is recognised from its ETag
+    assert util_cloud._s3Unchanged(s3, str(tmp_path / 'large.tif'), s3_bucket, 'large.tif', part_size) == (True, checksums)
+
+def test_s3_upload_skips_unchanged(s3_bucket, tmp_path, monkeypatch):
+    _writeFile(tmp_path / 'a.tif', 2000)
+    stats = {}
+    assert util_cloud.aws_upload(str(tmp_path / 'a.tif'), s3_bucket, 'a.tif', stats=stats)
+    uploads = []
+    monkeypatch.setattr(util_cloud._s3Client(), 'upload_file', lambda *args, **kwargs: uploads.append(args))
+    assert util_cloud.aws_upload(str(tmp_path / 'a.tif'), s3_bucket, 'a.tif', stats=stats)
+    assert uploads == []
+    assert stats == {'uploaded_files': 1, 'uploaded_bytes': 2000, 'skipped_files': 1, 'skipped_bytes': 2000}
+    # a changed file is uploaded again
+    _writeFile(tmp_path / 'a.tif', 2000)
+    assert util_cloud.aws_upload(str(tmp_path / 'a.tif'), s3_bucket, 'a.tif', stats=stats)
+    assert len(uploads) == 1
+
+def test_s3_upload_reads_file_only_to_compare(s3_bucket, tmp_path, monkeypatch):
+    _writeFile(tmp_path / 'a.tif', 2000)
+    hashed = []
+    checksums = util_cloud._fileChecksums
+    monkeypatch.setattr(util_cloud, '_fileChecksums', lambda *args: hashed.append(args[0]) or checksums(*args))
+    # a new object and an upload that does not compare are not hashed
+    assert util_cloud.aws_upload(str(tmp_path / 'a.tif'), s3_bucket, 'a.tif')
+    assert util_cloud.aws_upload(str(tmp_path / 'a.tif'), s3_bucket, 'a.tif', skip_unchanged=False)
+    assert hashed == []
+    # an existing object of the same size is
+    assert util_cloud.aws_upload(str(tmp_path / 'a.tif'), s3_bucket, 'a.tif')
+    assert hashed == [str(tmp_path / 'a.tif')]
+
+def test_s3_upload_zip_multipart(s3_bucket, tmp_path):
+    # three files of about 4 MB, so that the archive is uploaded in several parts of 5 MB
+    files = [tmp_path / '{}.tif'.format(name) for name in 'abc']
+    contents = [_writeFile(f, 4 * 1024 * 1024 + i) for i, f in enumerate(files)]
+    assert util_cloud.aws_upload_zip([str(f) for f in files], s3_bucket, 'archive.zip',
+                                     compression=util_cloud.zipfile.ZIP_STORED, part_size=5 * 1024 * 1024)
+    s3 = util_cloud._s3Client()
+    assert s3.head_object(Bucket=s3_bucket, Key='archive.zip')['ETag'].strip('"').endswith('-3')
+    (tmp_path / 'archive.zip').write_bytes(s3.get_object(Bucket=s3_bucket, Key='archive.zip')['Body'].read())
+    with util_cloud.zipfile.ZipFile(tmp_path / 'archive.zip') as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['a.tif', 'b.tif', 'c.tif']
+        assert [archive.read(f.name) for f in files] == contents
+
+def test_s3_upload_zip_missing_file(s3_bucket, tmp_path):
+    _writeFile(tmp_path / 'a.tif', 2000)
+    assert not util_cloud.aws_upload_zip([str(tmp_path / 'a.tif'), str(tmp_path / 'missing.tif')], s3_bucket, 'archive.zip')
+    # neither the archive nor an unfinished multipart upload is left behind
+    s3 = util_cloud._s3Client()
+    assert s3.list_objects_v2(Bucket=s3_bucket).get('Contents', []) == []
+    assert s3.list_multipart_uploads(Bucket=s3_bucket).get('Uploads', []) == []
+
+def test_gee_ingest_many_fails_unknown_tasks(monkeypatch):
+    ids = iter(['a', 'b'])
+    monkeypatch.setattr(util_cloud.ee.data, 'newTaskId', lambda: [next(ids)])
+    monkeypatch.setattr(util_cloud.ee.data, 'startIngestion', lambda *args: None)
+    monkeypatch.setattr(util_cloud.time, 'sleep', lambda seconds: None)
+    # task a is always UNKNOWN and task b is missing from the response
+    monkeypatch.setattr(util_cloud.ee.data, 'getTaskStatus', lambda task_ids: [{'id': 'a', 'state': 'UNKNOWN'}])
+    results = list(util_cloud.gee_ingest_many([{'name': 'asset_a'}, {'name': 'asset_b'}], max_unknown_polls=3))
+    assert sorted((result['asset'], result['state']) for result in results) == [('asset_a', 'FAILED'), ('asset_b', 'FAILED')]
+
+def test_gcs_resumable_upload_retries_offset_requests(gcs_bucket, tmp_path, monkeypatch):
+    content = _writeFile(tmp_path / 'large.tif', 600 * 1024)
+    monkeypatch.setattr(util_cloud, 'GCS_RESUME_DIR', str(tmp_path / 'resume'))
+    monkeypatch.setattr(util_cloud, 'GCS_CHUNK_SIZE', 256 * 1024)
+    monkeypatch.setattr(util_cloud.time, 'sleep', lambda seconds: None)
+    # the second chunk and the request asking for the offset after it both fail
+    calls = []
+    put = util_cloud.requests.put
+
+    def flaky(*args, **kwargs):
+        calls.append(kwargs['headers']['Content-Range'])
+        if len(calls) in (2, 3):
+            raise util_cloud.requests.ConnectionError('connection reset')
+        return put(*args, **kwargs)
+
+    monkeypatch.setattr(util_cloud.requests, 'put', flaky)
+    blob = gcs_bucket.blob('test/large.tif')
+    util_cloud._gcsResumableUpload(str(tmp_path / 'large.tif'), blob)
+    assert calls[2] == 'bytes */{}'.format(len(content))
+    assert blob.download_as_bytes() == content
+    assert os.listdir(tmp_path / 'resume') == []
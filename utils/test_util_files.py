@@ -0,0 +1,93 @@
+'''
+Tests of the archive builder of util_files
+Usage:
+    pip install pytest
+    python -m pytest utils/test_util_files.py
+'''
+import os
+import sys
+import gzip
+import zipfile
+import threading
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+pytest.importorskip('osgeo')
+import util_files
+
+def _writeFiles(folder):
+    '''
+    Write files of different kinds to archive
+    INPUT   folder: folder in which to write the files (pathlib.Path)
+    RETURN  content of each file, by file name (dictionary)
+    '''
+    contents = {
+        'table.csv': b''.join(b'%d,site %d,%f\n' % (i, i % 50, i / 7) for i in range(50000)),
+        'random.bin': os.urandom(300000),
+        'storms.csv.gz': gzip.compress(b'storm\n' * 10000),
+        'empty.txt': b'',
+        'données.txt': 'été\n'.encode('utf-8') * 1000,
+    }
+    for name, content in contents.items():
+        (folder / name).write_bytes(content)
+    return contents
+
+def _readArchive(archive):
+    '''
+    Check an archive with zipfile and read its members
+    INPUT   archive: file name of the archive (string)
+    RETURN  content and compression method of each member, by name (dictionary)
+    '''
+    with zipfile.ZipFile(archive) as zipped:
+        assert zipped.testzip() is None
+        return {info.filename: (zipped.read(info), info.compress_type) for info in zipped.infolist()}
+
+def test_archive_files_stores_compressed_files(tmp_path):
+    contents = _writeFiles(tmp_path)
+    files = [str(tmp_path / name) for name in contents]
+    archive = util_files.archive_files(files, str(tmp_path / 'archive.zip'), max_workers=2)
+    members = _readArchive(archive)
+    assert list(members) == list(contents)
+    assert {name: content for name, (content, method) in members.items()} == contents
+    assert {name: method for name, (content, method) in members.items()} == {
+        'table.csv': zipfile.ZIP_DEFLATED, 'random.bin': zipfile.ZIP_STORED, 'storms.csv.gz': zipfile.ZIP_STORED,
+        'empty.txt': zipfile.ZIP_STORED, 'données.txt': zipfile.ZIP_DEFLATED}
+    assert os.path.getsize(archive) < sum(len(content) for content in contents.values()) / 2
+
+def test_archive_files_keeps_order(tmp_path):
+    files = []
+    for i in range(25):
+        files.append(str(tmp_path / 'part{:02d}.txt'.format(i)))
+        with open(files[-1], 'w') as f:
+            f.write('part {}\n'.format(i) * (i * 100))
+    archive = util_files.archive_files(files, str(tmp_path / 'archive.zip'), max_workers=2)
+    with zipfile.ZipFile(archive) as zipped:
+        assert zipped.namelist() == [os.path.basename(f) for f in files]
+        assert zipped.read('part07.txt') == b'part 7\n' * 700
+
+def test_archive_files_compresses_members_in_parallel(tmp_path, monkeypatch):
+    contents = _writeFiles(tmp_path)
+    # the first two members only finish compressing once both have started
+    barrier = threading.Barrier(2, timeout=10)
+    deflate = util_files._deflateMember
+    started = []
+
+    def spy(*args):
+        started.append(args[0])
+        if len(started) <= 2:
+            barrier.wait()
+        return deflate(*args)
+
+    monkeypatch.setattr(util_files, '_deflateMember', spy)
+    archive = util_files.archive_files([str(tmp_path / name) for name in contents], str(tmp_path / 'archive.zip'),
+                                       max_workers=2)
+    assert {name: content for name, (content, method) in _readArchive(archive).items()} == contents
+
+def test_archive_files_zip64(tmp_path, monkeypatch):
+    # write ZIP64 sizes, offsets and end records without writing gigabytes
+    monkeypatch.setattr(util_files, 'ZIP64_LIMIT', 1000)
+    contents = _writeFiles(tmp_path)
+    archive = util_files.archive_files([str(tmp_path / name) for name in contents], str(tmp_path / 'archive.zip'))
+    assert {name: content for name, (content, method) in _readArchive(archive).items()} == contents
+    with open(archive, 'rb') as f:
+        assert b'PK\x06\x06' in f.read()
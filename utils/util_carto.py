@@ -1,9 +1,28 @@
 import os
+import io
+import re
 import time
+import csv
 import json
+import glob
+import gzip
+import hashlib
+import random
+import tempfile
+import shutil
+import zipfile
+import threading
+import asyncio
+import email.utils
 import requests
-from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import wkb, wkt
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from carto.datasets import DatasetManager
+from carto.file_import import FileImportJobManager
 from carto.auth import APIKeyAuthClient
 from collections import OrderedDict
 import logging
@@ -15,6 +34,167 @@ logger = logging.getLogger(__name__)
 CARTO_USER = os.getenv('CARTO_WRI_RW_USER')
 CARTO_KEY = os.getenv('CARTO_WRI_RW_KEY')
 
+# default maximum number of rows packed into a single INSERT statement
+INSERT_BATCH_SIZE = 500
+# default maximum size (in bytes) of a single INSERT statement sent to the Carto SQL API
+INSERT_MAX_PAYLOAD_BYTES = 4 * 1024 * 1024
+# default encoding of geometries in INSERT queries, either 'geojson' or the more compact 'wkb'
+GEOMETRY_ENCODING = 'geojson'
+# default number of rows encoded at a time when streaming data to the Carto COPY endpoint
+COPY_CHUNK_ROWS = 10000
+# longest time, in seconds, to wait between two checks of the state of Carto import jobs
+IMPORT_POLL_INTERVAL = 30
+# default number of rows in each part of a large file imported by upload_large_to_carto
+IMPORT_PART_ROWS = 500000
+# default number of rows in each dataframe read from Carto by read_carto
+READ_CHUNK_ROWS = 100000
+# default number of threads sending requests to Carto, also used as the size of the connection pool
+CARTO_MAX_WORKERS = 10
+# highest number of requests an adaptive upload may send to Carto at the same time
+CARTO_MAX_CONCURRENCY = 32
+# default (connect, read) timeouts in seconds for requests to Carto
+CARTO_TIMEOUT = (10, 600)
+# default maximum attempts to make for each request to Carto
+CARTO_N_TRIES = 5
+# how often, in seconds, to log the progress of an upload
+CARTO_PROGRESS_INTERVAL = 30
+# folder where the journals of committed batches are kept, so that interrupted uploads can be resumed
+CARTO_JOURNAL_DIR = os.getenv('CARTO_JOURNAL_DIR', '.carto_journal')
+# how long, in seconds, the list of tables in the Carto account is cached for
+CARTO_CATALOG_TTL = int(os.getenv('CARTO_CATALOG_TTL', 300))
+# location of the on-disk cache of the list of tables in the Carto account, shared between scripts
+CARTO_CATALOG_CACHE = os.getenv('CARTO_CATALOG_CACHE', os.path.join(tempfile.gettempdir(), 'carto_catalog_{user}.json'))
+# request bodies larger than this many bytes are sent gzip compressed
+CARTO_GZIP_MIN_BYTES = 1024
+# HTTP status codes after which a request to Carto is retried
+CARTO_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# shared session used for all requests to Carto, so that connections are kept alive and reused
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+# in-process cache of the list of tables in each Carto account, keyed by username
+_catalog = {}
+_catalog_lock = threading.Lock()
+# statements after which the cached list of tables may no longer match the account
+_TABLE_DDL = re.compile(r'\b(CREATE|DROP|ALTER)\b[^;]*?\bTABLE\b', re.IGNORECASE)
+
+def _sqlUrl(user=None):
+    '''
+    Get the url of the Carto SQL API
+    The url can be pointed to a local stand-in server by setting the environment variable CARTO_SQL_URL,
+    which may contain a {user} placeholder
+    INPUT   user: the username of the Carto account (string)
+    RETURN  url of the Carto SQL API (string)
+    '''
+    return os.getenv('CARTO_SQL_URL', 'https://{user}.carto.com/api/v2/sql').format(user=user or CARTO_USER)
+
+def _getSession(pool_size=CARTO_MAX_WORKERS):
+    '''
+    Get the shared session used for all requests to Carto, creating it or enlarging its connection pool if needed
+    A session replaced by a larger one is not closed, since other threads may still be sending requests through it;
+    its connections are released once the last of them is done with it
+    INPUT   pool_size: number of keep-alive connections the session should be able to hold, usually the number of workers (integer)
+    RETURN  session with a keep-alive connection pool (requests session)
+    '''
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None or _session_pool_size < pool_size:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pool_size = pool_size
+        return _session
+
+def _retryWait(attempt, response=None, base_wait=1, max_wait=60):
+    '''
+    Get the time to wait before retrying a request, using exponential backoff with full jitter
+    A Retry-After header sent by the server (in seconds or as an HTTP date) takes precedence
+    INPUT   attempt: number of attempts made so far, starting from 0 (integer)
+            response: optional, the response of the failed attempt (requests response)
+            base_wait: time in seconds to wait after the first attempt, before jitter (number)
+            max_wait: maximum time in seconds to wait (number)
+    RETURN  time to wait in seconds (number)
+    '''
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), max_wait)
+        except ValueError:
+            try:
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                return min(max(retry_date.timestamp() - time.time(), 0), max_wait)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(max_wait, base_wait * 2 ** attempt))
+
+def _request(method, url, params=None, json_body=None, data=None, headers=None, timeout=CARTO_TIMEOUT,
+             n_tries=CARTO_N_TRIES, compress=True, stream=False, on_retry=None):
+    '''
+    Send a request to Carto through the shared session
+    JSON bodies are gzip compressed when they are large enough; connection errors, timeouts and responses with a status
+    in CARTO_RETRY_STATUS are retried with exponential backoff, other HTTP errors are raised right away
+    INPUT   method: HTTP method of the request (string)
+            url: the url to which the request will be sent (string)
+            params: optional, query string parameters (dictionary)
+            json_body: optional, payload to send as JSON in the body of the request (dictionary)
+            data: optional, raw body of the request; it is not retried if it is a generator (bytes or generator)
+            headers: optional, extra headers of the request (dictionary)
+            timeout: (connect, read) timeouts in seconds (tuple of numbers)
+            n_tries: maximum attempts to make (integer)
+            compress: whether to gzip compress JSON bodies larger than CARTO_GZIP_MIN_BYTES (boolean)
+            stream: whether to read the body of the response lazily, as it is iterated over (boolean)
+            on_retry: optional, function called with the response (None after a connection error or a timeout) each
+                    time an attempt fails and the request is retried (function)
+    RETURN  the response from the API (requests response)
+    '''
+    headers = dict(headers or {})
+    if json_body is not None:
+        data = json.dumps(json_body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+        if compress and len(data) > CARTO_GZIP_MIN_BYTES:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+    # a streamed body can only be read once
+    if data is not None and not isinstance(data, (bytes, str)):
+        n_tries = 1
+    session = _getSession()
+    for i in range(n_tries):
+        response = None
+        try:
+            response = session.request(method, url, params=params, data=data, headers=headers, timeout=timeout,
+                                       stream=stream)
+            response.raise_for_status()
+            return response
+        except (requests.ConnectionError, requests.Timeout) as e:
+            exception = e
+        except requests.HTTPError as e:
+            # errors in the query itself will not go away by trying again
+            if response.status_code not in CARTO_RETRY_STATUS:
+                logging.error('Carto request failed: ' + response.text[:1000])
+                raise
+            exception = e
+        if on_retry is not None:
+            on_retry(response)
+        if i < n_tries - 1:
+            wait = _retryWait(i, response)
+            logging.warning('Attempt #{} to send request to Carto unsuccessful. Trying again after {:.1f} seconds'.format(i, wait))
+            logging.debug('Exception encountered during request attempt: ' + str(exception))
+            time.sleep(wait)
+    logging.error('Request to Carto has failed after {} attempts'.format(n_tries))
+    raise exception
+
+def _authClient():
+    '''
+    Set up carto authentication using local variables for username (CARTO_WRI_RW_USER) and API key (CARTO_WRI_RW_KEY),
+    sharing the keep-alive session used for all other requests to Carto
+    RETURN  carto authentication client (APIKeyAuthClient)
+    '''
+    return APIKeyAuthClient(api_key=CARTO_KEY, base_url="https://{user}.carto.com/".format(user=CARTO_USER),
+                            session=_getSession())
+
 def upload_to_carto(file, privacy, tags=['rw'], collision_strategy='skip'):
     '''
     Upload tables to Carto
@@ -26,7 +206,7 @@ def upload_to_carto(file, privacy, tags=['rw'], collision_strategy='skip'):
             set the parameter to 'overwrite' if you want to overwrite the existing table on Carto
     '''
     # set up carto authentication using local variables for username (CARTO_WRI_RW_USER) and API key (CARTO_WRI_RW_KEY)
-    auth_client = APIKeyAuthClient(api_key=CARTO_KEY, base_url="https://{user}.carto.com/".format(user=CARTO_USER))
+    auth_client = _authClient()
     # set up dataset manager with authentication
     dataset_manager = DatasetManager(auth_client)
     # upload dataset to carto
@@ -46,6 +226,236 @@ def upload_to_carto(file, privacy, tags=['rw'], collision_strategy='skip'):
     dataset.privacy = privacy
     dataset.save()
 
+class CartoUploadError(Exception):
+    '''
+    Raised by upload_many after all the files were tried, when some of them could not be uploaded
+    tables: names of the Carto tables created, keyed by file (dictionary)
+    failed: error of each file that could not be uploaded, keyed by file (dictionary)
+    '''
+    def __init__(self, tables, failed):
+        self.tables = tables
+        self.failed = failed
+        super().__init__('Carto upload of {} of {} files failed: {}'.format(
+            len(failed), len(failed) + len(tables), ', '.join('{} ({})'.format(file, error) for file, error in failed.items())))
+
+def upload_many(files, privacy, tags=['rw'], collision_strategy='skip', max_workers=CARTO_MAX_WORKERS):
+    '''
+    Upload several tables to Carto at the same time
+    All the import jobs are submitted at once and polled together; tags and privacy are applied to each table as soon as
+    its import completes, so the whole upload takes about as long as the largest import. Every file is tried even if
+    some of them fail, and a CartoUploadError listing the tables created and the files that failed is raised at the end.
+    INPUT   files: locations of files on local computer that you want to upload (list of strings)
+            privacy: the privacy setting of the datasets to upload to Carto; set to None to leave it unchanged (string)
+            tags: one or more tags to add to the datasets on Carto; set to None to add none (list of strings)
+            collision_strategy: determines what happens if a table with the same name already exists, see upload_to_carto (string)
+            max_workers: number of files to send to Carto at the same time (integer)
+    RETURN  tables: names of the Carto tables created, keyed by file (dictionary)
+    '''
+    # set up carto authentication using local variables for username (CARTO_WRI_RW_USER) and API key (CARTO_WRI_RW_KEY)
+    auth_client = _authClient()
+    import_manager = FileImportJobManager(auth_client)
+    dataset_manager = DatasetManager(auth_client)
+
+    def submit(file):
+        # send the file to Carto and start the import job without waiting for it to finish
+        with open(file, 'rb') as archive:
+            job = import_manager.create(archive)
+            job.run(collision_strategy=collision_strategy)
+        logger.info('Carto import job submitted for {}'.format(os.path.basename(file)))
+        return job
+
+    pending = {}
+    # error of each file that could not be uploaded
+    failed = {}
+    # submit all the import jobs, keeping track of those that could not be submitted
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(submit, file): file for file in files}
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                pending[file] = future.result()
+            except Exception as e:
+                logger.error('Carto import of {} could not be submitted: {!r}'.format(file, e))
+                failed[file] = e
+    tables = {}
+    # check the state of all jobs, waiting a little longer each time up to IMPORT_POLL_INTERVAL seconds
+    wait = 2
+    while pending:
+        time.sleep(wait)
+        wait = min(wait * 2, IMPORT_POLL_INTERVAL)
+        for file, job in list(pending.items()):
+            try:
+                job.refresh()
+                if job.state == 'complete':
+                    del pending[file]
+                    logger.info('Carto table created: {}'.format(job.table_name))
+                    # add tags and set privacy as soon as the table exists
+                    if tags is not None or privacy is not None:
+                        dataset = dataset_manager.get(job.table_name)
+                        if tags is not None:
+                            dataset.tags = tags
+                            logger.info('Adding the following tags to table: {}'.format(tags))
+                        if privacy is not None:
+                            dataset.privacy = privacy
+                        dataset.save()
+                    tables[file] = job.table_name
+                elif job.state == 'failure':
+                    del pending[file]
+                    error = 'Carto import failed with error code {}: {}'.format(getattr(job, 'error_code', None),
+                                                                              getattr(job, 'get_error_text', None))
+                    logger.error('Carto import of {} failed: {}'.format(file, error))
+                    failed[file] = Exception(error)
+            except Exception as e:
+                pending.pop(file, None)
+                logger.error('Carto import of {} failed: {!r}'.format(file, e))
+                failed[file] = e
+    if failed:
+        if collision_strategy == 'skip' and any('exist' in str(error).lower() for error in failed.values()):
+            logger.error("Some tables probably already exist, try setting collision_strategy to overwrite or using another name")
+        raise CartoUploadError(tables, failed)
+    return tables
+
+def _splitFile(file, rows_per_part, part_dir):
+    '''
+    Split a CSV or vector file into parts of at most rows_per_part rows, without loading the whole file in memory
+    INPUT   file: location of the CSV file, shapefile (can be zipped) or other vector file to split (string)
+            rows_per_part: maximum number of rows in each part (integer)
+            part_dir: folder in which to write the parts (string)
+    RETURN  parts: locations of the parts, CSV files or zipped shapefiles (list of strings)
+    '''
+    base = os.path.splitext(os.path.basename(file))[0]
+    parts = []
+    if file.lower().endswith('.csv'):
+        with open(file, newline='', encoding='utf-8') as source:
+            reader = csv.reader(source)
+            header = next(reader)
+            writer = None
+            for i, row in enumerate(reader):
+                # start a new part every rows_per_part rows, repeating the header
+                if i % rows_per_part == 0:
+                    if writer is not None:
+                        part.close()
+                    parts.append(os.path.join(part_dir, '{}_part{:03d}.csv'.format(base, len(parts))))
+                    part = open(parts[-1], 'w', newline='', encoding='utf-8')
+                    writer = csv.writer(part)
+                    writer.writerow(header)
+                writer.writerow(row)
+            if writer is not None:
+                part.close()
+        return parts
+    path = 'zip://' + file if file.lower().endswith('.zip') else file
+    start = 0
+    while True:
+        # read the next range of rows only
+        gdf = gpd.read_file(path, rows=slice(start, start + rows_per_part))
+        if len(gdf) == 0:
+            break
+        name = '{}_part{:03d}'.format(base, len(parts))
+        shp = os.path.join(part_dir, name + '.shp')
+        gdf.to_file(shp, driver='ESRI Shapefile')
+        # zip the shapefile components so that Carto can import them
+        parts.append(os.path.join(part_dir, name + '.zip'))
+        with zipfile.ZipFile(parts[-1], 'w') as zip:
+            for component in glob.glob(os.path.join(part_dir, name + '.*')):
+                if not component.endswith('.zip'):
+                    zip.write(component, os.path.basename(component))
+        start += rows_per_part
+    return parts
+
+def _columnTypes(table):
+    '''
+    Get the names and types of the columns of a Carto table, in order
+    INPUT   table: the name of the Carto table (string)
+    RETURN  column names and PostgreSQL data types (list of tuples of strings)
+    '''
+    sql = "SELECT column_name, format_type(atttypid, atttypmod) AS data_type FROM information_schema.columns c " \
+          "JOIN pg_attribute a ON a.attrelid = '\"{0}\"'::regclass AND a.attname = c.column_name " \
+          "WHERE c.table_name = '{0}' AND c.table_schema = current_schema() ORDER BY c.ordinal_position".format(table)
+    rows = sendSql(sql, CARTO_USER, CARTO_KEY, post=False).json()['rows']
+    return [(row['column_name'], row['data_type']) for row in rows]
+
+def upload_large_to_carto(file, privacy, tags=['rw'], collision_strategy='skip', rows_per_part=IMPORT_PART_ROWS,
+                          max_workers=CARTO_MAX_WORKERS):
+    '''
+    Upload a file too large to be imported to Carto in one go
+    The file is split into parts of rows_per_part rows, which are imported at the same time into part tables with
+    upload_many; the part tables are then appended into a staging table on the server, which replaces the final table
+    with _swapTable, as in replace_carto_table. The part tables are dropped whether or not the upload succeeds, and tags
+    and privacy are only applied to the final table. Files with a single part are uploaded with upload_to_carto.
+    If the guessed type of a column differs between parts, the column is stored as text.
+    INPUT   file: location of the CSV file, shapefile (can be zipped) or other vector file on local computer (string)
+            privacy: the privacy setting of the dataset to upload to Carto (string)
+            tags: one or more tags to add to the dataset on Carto (list of strings)
+            collision_strategy: determines what happens if a table with the same name already exists, as in
+                    upload_to_carto: 'skip' stops the program and 'overwrite' replaces the content of the table (string)
+            rows_per_part: maximum number of rows in each part (integer)
+            max_workers: number of parts to send to Carto at the same time (integer)
+    RETURN  table: name of the Carto table created (string)
+    '''
+    # name the table the way Carto would name it
+    table = re.sub('[^a-z0-9_]', '_', os.path.splitext(os.path.basename(file))[0].lower())
+    if collision_strategy == 'skip' and tableExists(table, CARTO_USER, CARTO_KEY):
+        logging.error("Table {} already exists, try setting collision_strategy to overwrite or using another name".format(table))
+        # If the table exists terminate program, as upload_to_carto does
+        sys.exit(1)
+    # part tables imported so far, dropped whether or not the upload succeeds
+    part_tables = []
+    staging = '{}_staging'.format(table)
+    try:
+        part_dir = tempfile.mkdtemp(prefix=table + '_')
+        try:
+            parts = _splitFile(file, rows_per_part, part_dir)
+            logger.info('Split {} into {} parts'.format(os.path.basename(file), len(parts)))
+            if len(parts) <= 1:
+                upload_to_carto(file, privacy, tags, collision_strategy=collision_strategy)
+                return table
+            # import all the parts at the same time, without tags or privacy, which only the final table gets
+            try:
+                part_tables = list(upload_many(parts, None, None, collision_strategy='overwrite',
+                                               max_workers=max_workers).values())
+            except CartoUploadError as e:
+                part_tables = list(e.tables.values())
+                raise
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+        # the columns added by Carto are recreated when the staging table is CartoDBfied
+        carto_columns = ('cartodb_id', 'the_geom_webmercator')
+        part_types = [dict(_columnTypes(part)) for part in part_tables]
+        columns = [(name, data_type) for name, data_type in _columnTypes(part_tables[0]) if name not in carto_columns]
+        # use text for columns whose type was guessed differently in some parts
+        columns = [(name, data_type if all(types.get(name) == data_type for types in part_types) else 'text')
+                   for name, data_type in columns]
+        sendSql('DROP TABLE IF EXISTS "{}"'.format(staging), CARTO_USER, CARTO_KEY)
+        createTable(staging, [('"{}"'.format(name), data_type) for name, data_type in columns], user=CARTO_USER, key=CARTO_KEY)
+        fields = ', '.join('"{}"'.format(name) for name, data_type in columns)
+
+        def append(i):
+            # copy the rows of one part table into the staging table, casting columns to the final types
+            casts = ', '.join('"{}"::{}'.format(name, data_type) if name in part_types[i] else 'NULL'
+                              for name, data_type in columns)
+            sendSql('INSERT INTO "{}" ({}) SELECT {} FROM "{}"'.format(staging, fields, casts, part_tables[i]),
+                    CARTO_USER, CARTO_KEY)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(append, range(len(part_tables))))
+        # replace the final table with the staging table
+        _swapTable(table, staging, [name for name, data_type in columns])
+    except Exception:
+        # do not leave a half-loaded staging table behind
+        sendSql('DROP TABLE IF EXISTS "{}"'.format(staging), CARTO_USER, CARTO_KEY)
+        raise
+    finally:
+        for part in part_tables:
+            sendSql('DROP TABLE IF EXISTS "{}"'.format(part), CARTO_USER, CARTO_KEY)
+    logger.info('Carto table created: {}'.format(table))
+    # add tags and set privacy on the final table only
+    dataset = DatasetManager(_authClient()).get(table)
+    dataset.tags = tags
+    logger.info('Adding the following tags to table: {}'.format(tags))
+    dataset.privacy = privacy
+    dataset.save()
+    return table
+
 def create_carto_schema(df):
     '''
     Function to create a dictionary of column names and data types
@@ -82,8 +492,8 @@ def convert_geometry(geom):
     if geom.geom_type == 'Polygon':
         return geom.__geo_interface__
     # if it's a multipoint series containing only one point
-    elif (geom.geom_type == 'MultiPoint') & (len(geom) == 1):
-        return geom[0].__geo_interface__
+    elif (geom.geom_type == 'MultiPoint') and (len(geom.geoms) == 1):
+        return geom.geoms[0].__geo_interface__
     else:
         return geom.__geo_interface__
 
@@ -97,12 +507,15 @@ def checkCreateTable(table, schema, id_field='', time_field=''):
                     source data to the our table each time we run the script so that we only have to pull data we
                     haven't previously uploaded (string)
             time_field:  optional, name of column that will store datetime information (string)
+    RETURN  list of existing IDs in the table, pulled from the id_field column (list of strings)
     '''
 
     # check it the table already exists in Carto
-    if table in getTables(user=CARTO_USER, key=CARTO_KEY):
+    if tableExists(table, user=CARTO_USER, key=CARTO_KEY):
         # if the table does exist, get a list of all the values in the id_field column
         print('Carto table already exists.')
+        if id_field:
+            return list(fetchIds(table, id_field).keys())
     else:
         # if the table does not exist, create it with columns based on the schema input
         print('Table {} does not exist, creating'.format(table))
@@ -115,6 +528,120 @@ def checkCreateTable(table, schema, id_field='', time_field=''):
         # if a time_field is specified, set it as an index in the Carto table; this is not a unique index
         if time_field:
             createIndex(table, time_field, user=CARTO_USER, key=CARTO_KEY)
+    # return an empty list because there are no IDs in the new table yet
+    return []
+
+def fetchIds(table, id_field, hash_field=None, user=None, key=None):
+    '''
+    Get the IDs already in a table, and optionally the content hash stored with each row, in one streamed query
+    INPUT   table: the name of the Carto table (string)
+            id_field: name of the column storing the unique ID of each row (string)
+            hash_field: optional, name of the column storing the content hash of each row, written by sync_to_carto (string)
+            user: optional, the username of the Carto account (string)
+            key: optional, the key for Carto API (string)
+    RETURN  dictionary whose keys are the IDs in the table, as text, and whose values are the content hashes of the rows,
+            or None if no hash_field is given (dictionary)
+    '''
+    fields = '{}::text'.format(id_field) + (', {}'.format(hash_field) if hash_field else '')
+    sql = 'COPY (SELECT {} FROM "{}") TO stdout WITH (FORMAT csv, HEADER false)'.format(fields, table)
+    r = _request('GET', _sqlUrl(user) + '/copyto', params={'api_key': key or CARTO_KEY, 'q': sql}, stream=True)
+    ids = {}
+    # read the rows as they arrive instead of holding the whole response in memory; Carto sends them as
+    # application/octet-stream, so decode them explicitly, and let the csv module split the lines so that quoted
+    # values spanning several lines stay whole
+    r.raw.decode_content = True
+    # keep the response open once it is read to the end, as the text wrapper expects
+    r.raw.auto_close = False
+    for row in csv.reader(io.TextIOWrapper(r.raw, encoding='utf-8', newline='')):
+        if row:
+            ids[row[0]] = row[1] if hash_field else None
+    # the whole response was read, so its connection can be reused
+    r.raw.release_conn()
+    return ids
+
+def _rowHashes(df, schema, exclude=()):
+    '''
+    Compute a hash of the content of each row of a dataframe, used to find the rows that changed since the last upload
+    INPUT   df: dataframe or geodataframe storing the data, with columns in the same order as the schema (dataframe)
+            schema: a dictionary of column names and data types in order to upload data to Carto (dictionary)
+            exclude: optional, names of the schema columns to leave out of the hash (list of strings)
+    RETURN  hex digest of each row (series of strings)
+    '''
+    positions = [i for i, field in enumerate(schema.keys()) if field not in exclude]
+    geometry = [i for i in positions if list(schema.values())[i] == 'geometry']
+    attributes = [i for i in positions if i not in geometry]
+    # hash all attribute columns at once
+    hashes = pd.util.hash_pandas_object(df.iloc[:, attributes], index=False) if attributes else pd.Series(0, index=df.index)
+    hashes = hashes.map('{:016x}'.format)
+    # geometries are hashed through their binary representation
+    for i in geometry:
+        hashes = hashes + pd.Series([
+            hashlib.md5(b'' if geom is None else geom.wkb).hexdigest()[:16] for geom in df.iloc[:, i].tolist()
+            ], index=df.index)
+    return hashes
+
+def sync_to_carto(table_name, schema, gdf, id_field, hash_field=None, batch_size=INSERT_BATCH_SIZE,
+                  max_payload_bytes=INSERT_MAX_PAYLOAD_BYTES, max_in_flight=CARTO_MAX_WORKERS,
+                  geometry_encoding=GEOMETRY_ENCODING, precision=None):
+    '''
+    Send only the new and changed rows of a geodataframe to an existing Carto table, instead of reloading the whole table
+    The IDs (and content hashes) already in the table are fetched in one streamed query and compared to the geodataframe;
+    rows with a new ID are inserted and, if hash_field is given, rows whose content changed are updated in place with
+    batched INSERT ... ON CONFLICT queries. Rows are compared on their ID as text, so IDs should not be floats.
+    The table needs a unique index on id_field, which checkCreateTable creates when it is passed an id_field
+    INPUT   table_name: the name of the Carto table (string)
+            schema: a dictionary of column names and data types, in the same order as the columns of gdf (dictionary)
+            gdf: a geodataframe storing all the current data (geodataframe)
+            id_field: name of the schema column storing the unique ID of each row (string)
+            hash_field: optional, name of a text column in which to store the content hash of each row so that changed
+                    rows can be detected; it is added to the table if it does not exist yet (string)
+            batch_size: maximum number of rows to insert with each request (integer)
+            max_payload_bytes: optional, maximum size in bytes of the sql query sent with each request (integer)
+            max_in_flight: maximum number of requests to send at the same time (integer)
+            geometry_encoding: how to encode geometries, 'geojson' or 'wkb' for hex WKB (string)
+            precision: optional, number of decimal places to round coordinates to (integer)
+    RETURN  number of rows inserted, updated and left unchanged (dictionary)
+    '''
+    if hash_field:
+        # make sure the table has a column to store the content hashes in
+        sendSql('ALTER TABLE "{}" ADD COLUMN IF NOT EXISTS {} text'.format(table_name, hash_field), CARTO_USER, CARTO_KEY)
+        # compute the hash of each row, leaving out any stale hash, and send it along with the data
+        keep = [i for i, field in enumerate(schema.keys()) if field != hash_field]
+        gdf = gdf.iloc[:, keep].copy()
+        schema = OrderedDict((field, dtype) for field, dtype in schema.items() if field != hash_field)
+        gdf[hash_field] = _rowHashes(gdf, schema).values
+        schema[hash_field] = 'text'
+    existing = fetchIds(table_name, id_field, hash_field)
+    ids = gdf.iloc[:, list(schema.keys()).index(id_field)].astype(str)
+    is_new = ~ids.isin(existing.keys()).values
+    is_changed = ~is_new
+    if hash_field:
+        # compare the hash of each existing row with the one stored in the table
+        is_changed &= (gdf[hash_field].values != ids.map(existing).values)
+    else:
+        # without hashes there is no way to tell which existing rows changed
+        is_changed[:] = False
+    counts = {'inserted': int(is_new.sum()), 'updated': int(is_changed.sum()),
+              'unchanged': int(len(gdf) - is_new.sum() - is_changed.sum())}
+    logger.info('Syncing {}: {} new rows, {} changed rows, {} unchanged rows'.format(
+        table_name, counts['inserted'], counts['updated'], counts['unchanged']))
+    delta = gdf[is_new | is_changed]
+    if len(delta):
+        insert_to_carto(table_name, schema, delta, batch_size, max_payload_bytes, max_in_flight, upsert_field=id_field,
+                        geometry_encoding=geometry_encoding, precision=precision)
+    return counts
+
+def _rowValues(row):
+    '''
+    Prepare a row of a geodataframe so that it can be escaped for a sql query
+    INPUT   row: row of data to insert to carto (series)
+    RETURN  values of the row, with null values replaced by None and the geometry converted to geojson (list)
+    '''
+    # replace all null values with None
+    row = row.where(row.notnull(), None)
+    # convert the geometry in the geometry column to geojsons
+    row['geometry'] = convert_geometry(row['geometry'])
+    return row.values.tolist()
 
 def insert_carto_query(row, schema, table_name):
     '''
@@ -124,48 +651,395 @@ def insert_carto_query(row, schema, table_name):
             schema: a dictionary of column names and data types in order to upload data to Carto (dictionary)
     RETURN  sql query that can be included in a post request (string)
     '''
-    # replace all null values with None
-    row = row.where(row.notnull(), None)
-    insert_exception = None
-    # convert the geometry in the geometry column to geojsons
-    row['geometry'] = convert_geometry(row['geometry'])
     # construct the sql query to upload the row to the carto table
     fields = schema.keys()
-    values = _dumpRows([row.values.tolist()], tuple(schema.values()))
+    values = _dumpRows([_rowValues(row)], tuple(schema.values()))
     return 'INSERT INTO "{}" ({}) VALUES {}'.format(table_name, ', '.join(fields), values)
 
-def insert_carto_send(sql):
+def _pendingRanges(n_rows, skip_ranges=None):
+    '''
+    Get the ranges of row positions that still need to be uploaded
+    INPUT   n_rows: number of rows in the data (integer)
+            skip_ranges: optional, ranges [start, stop) of row positions already uploaded (list of tuples of integers)
+    RETURN  ranges [start, stop) of row positions not covered by skip_ranges, in order (list of tuples of integers)
+    '''
+    pending = []
+    position = 0
+    for start, stop in sorted(skip_ranges or []):
+        if start > position:
+            pending.append((position, min(start, n_rows)))
+        position = max(position, stop)
+        if position >= n_rows:
+            break
+    if position < n_rows:
+        pending.append((position, n_rows))
+    return [(start, stop) for start, stop in pending if stop > start]
+
+def insert_carto_batches(gdf, schema, table_name, batch_size=INSERT_BATCH_SIZE, max_payload_bytes=INSERT_MAX_PAYLOAD_BYTES,
+                         skip_ranges=None, upsert_field=None, geometry_encoding=GEOMETRY_ENCODING, precision=None):
+    '''
+    Build sql queries that each insert a batch of rows to carto
+    The values of each chunk of batch_size rows are escaped column by column with _dumpFrame; the chunk is then split
+    further if the query would be larger than max_payload_bytes (a single row larger than max_payload_bytes is sent on its own)
+    INPUT   gdf: a geodataframe storing all the data to upload, with columns in the same order as the schema (geodataframe)
+            schema: a dictionary of column names and data types in order to upload data to Carto (dictionary)
+            table_name: the name of the newly created table on Carto (string)
+            batch_size: maximum number of rows to include in one query (integer)
+            max_payload_bytes: optional, maximum size of one query in bytes; set to None to only limit by batch_size (integer)
+            skip_ranges: optional, ranges [start, stop) of row positions that should not be sent (list of tuples of integers)
+            upsert_field: optional, name of a column with a unique index; rows whose value in this column is already in
+                    the table update the existing row instead of being inserted (string)
+            geometry_encoding: how to encode geometries, 'geojson' or 'wkb' for hex WKB (string)
+            precision: optional, number of decimal places to round coordinates to (integer)
+    RETURN  generator of tuples of the sql query, the number of rows it inserts and the range [start, stop) of
+            row positions it inserts (tuple of string, integer and tuple of integers)
+    '''
+    dtypes = tuple(schema.values())
+    prefix = 'INSERT INTO "{}" ({}) VALUES '.format(table_name, ', '.join(schema.keys()))
+    suffix = ''
+    if upsert_field:
+        # overwrite every other column of the existing row with the new values
+        suffix = ' ON CONFLICT ({}) DO UPDATE SET {}'.format(upsert_field, ', '.join(
+            '{0} = EXCLUDED.{0}'.format(field) for field in schema.keys() if field != upsert_field))
+    prefix_size = len(prefix.encode('utf-8')) + len(suffix.encode('utf-8'))
+    for range_start, range_stop in _pendingRanges(len(gdf), skip_ranges):
+        for start in range(range_start, range_stop, batch_size):
+            stop = min(start + batch_size, range_stop)
+            # escape all the rows of this chunk at once
+            values = _dumpFrame(gdf.iloc[start:stop], dtypes, geometry_encoding, precision)
+            if not max_payload_bytes:
+                yield prefix + ','.join(values) + suffix, len(values), (start, stop)
+                continue
+            # split the chunk so that no query is larger than the payload limit
+            first = 0
+            size = prefix_size
+            for i, value in enumerate(values):
+                value_size = len(value.encode('utf-8')) + 1
+                if i > first and size + value_size > max_payload_bytes:
+                    yield prefix + ','.join(values[first:i]) + suffix, i - first, (start + first, start + i)
+                    first = i
+                    size = prefix_size
+                size += value_size
+            yield prefix + ','.join(values[first:]) + suffix, len(values) - first, (start + first, stop)
+
+def _frameHash(df, schema):
+    '''
+    Compute a hash of the content of a dataframe, used to recognize the same source data across runs
+    Attribute columns are hashed all at once and geometries through their binary representation, so that changed data
+    with the same shape and index is not taken for the data of an interrupted upload
+    INPUT   df: dataframe or geodataframe storing the data, with columns in the same order as the schema (dataframe)
+            schema: a dictionary of column names and data types in order to upload data to Carto (dictionary)
+    RETURN  hex digest of the schema, the number of rows, the index and the content of the dataframe (string)
+    '''
+    digest = hashlib.sha1(json.dumps([list(schema.items()), len(df)]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df.index).values.tobytes())
+    geometry = [i for i, dtype in enumerate(schema.values()) if dtype == 'geometry']
+    attributes = [i for i in range(len(schema)) if i not in geometry]
+    if attributes:
+        digest.update(pd.util.hash_pandas_object(df.iloc[:, attributes], index=False).values.tobytes())
+    for i in geometry:
+        column = df.iloc[:, i]
+        if isinstance(column, gpd.GeoSeries):
+            # geopandas writes the whole column at once
+            values = column.to_wkb().tolist()
+        else:
+            values = [geom.wkb if hasattr(geom, 'wkb') else str(geom).encode('utf-8') for geom in column.tolist()]
+        for value in values:
+            digest.update(value if isinstance(value, bytes) else b'\0')
+    return digest.hexdigest()
+
+def _tableOid(table_name):
+    '''
+    Get the object identifier of a Carto table, which changes whenever the table is dropped and created again
+    INPUT   table_name: the name of the Carto table (string)
+    RETURN  object identifier of the table (integer)
+    '''
+    sql = "SELECT '\"{}\"'::regclass::oid AS oid".format(table_name)
+    return int(sendSql(sql, CARTO_USER, CARTO_KEY, post=False).json()['rows'][0]['oid'])
+
+def _journalPath(table_name, table_oid, content_hash):
+    '''
+    Get the location of the journal of committed batches for an upload
+    INPUT   table_name: the name of the Carto table (string)
+            table_oid: object identifier of the table, from _tableOid (integer)
+            content_hash: hash of the data being uploaded, from _frameHash (string)
+    RETURN  location of the journal on the local computer (string)
+    '''
+    return os.path.join(CARTO_JOURNAL_DIR, '{}_{}o{}.journal'.format(table_name, table_oid, content_hash[:16]))
+
+def _readJournal(path):
+    '''
+    Read the ranges of row positions already committed from a journal
+    INPUT   path: location of the journal (string)
+    RETURN  ranges [start, stop) of committed row positions (list of tuples of integers)
+    '''
+    if not os.path.exists(path):
+        return []
+    committed = []
+    with open(path) as journal:
+        for line in journal:
+            # ignore a partially written last line
+            try:
+                start, stop = (int(x) for x in line.split())
+            except ValueError:
+                continue
+            committed.append((start, stop))
+    return committed
+
+def clearJournal(table_name):
+    '''
+    Delete all journals of committed batches for a table, for example after the table has been (re)created
+    INPUT   table_name: the name of the Carto table (string)
+    '''
+    for path in glob.glob(os.path.join(CARTO_JOURNAL_DIR, '{}_*.journal'.format(glob.escape(table_name)))):
+        # make sure the journal belongs to this table and not to one whose name starts the same way
+        if os.path.basename(path)[len(table_name) + 1:-len('.journal')].isalnum():
+            os.remove(path)
+
+def insert_carto_send(sql, n_rows=1, on_retry=None):
     '''
     Send a request to carto API
     INPUT   sql: sql query that can be included in a post request (string)
-    OUTPUT  index of the row sent (number)
+            n_rows: number of rows inserted by the query (integer)
+            on_retry: optional, function called with the response each time an attempt fails and is retried (function)
+    OUTPUT  number of rows sent (integer)
     '''
-    # maximum attempts to make
-    n_tries = 5
-    # sleep time between each attempt   
-    retry_wait_time = 6
+    try:
+        # send the request, retrying with backoff if Carto is throttling or unavailable
+        _request('POST', _sqlUrl(), json_body={'api_key': CARTO_KEY,'q': sql}, on_retry=on_retry)
+    except Exception:
+        logging.error('Problematic query: '+ sql[:1000])
+        raise
+    return n_rows
 
-    for i in range(n_tries):
+class ConcurrencyController:
+    '''
+    Additive-increase/multiplicative-decrease (AIMD) controller of the number of requests sent to Carto at the same time
+    The level goes up by one for every round of successful requests whose latency stays close to the best latency seen,
+    and is cut by decrease_factor when Carto throttles (429), fails (5xx) or slows down, at most once per round trip
+    INPUT   initial: number of requests to send at the same time at the start (integer)
+            minimum: lowest number of requests to send at the same time (integer)
+            maximum: highest number of requests to send at the same time (integer)
+            latency_factor: how many times slower than the best latency seen a request may be before backing off (number)
+            decrease_factor: factor by which the level is multiplied when backing off (number)
+            name: optional, name used in the log messages, such as the table being uploaded (string)
+    '''
+    def __init__(self, initial=CARTO_MAX_WORKERS, minimum=1, maximum=CARTO_MAX_CONCURRENCY, latency_factor=2.0,
+                 decrease_factor=0.5, name=''):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+        self.name = name
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        # smoothed latency of the recent requests and the best smoothed latency seen
+        self.latency = None
+        self.baseline = None
+        self.start_time = time.monotonic()
+        self.last_decrease = 0
+        # list of (seconds since start, level) every time the level changes
+        self.history = [(0, self.level)]
+        self._lock = threading.Lock()
+
+    @property
+    def level(self):
+        '''
+        Number of requests that may currently be sent at the same time (integer)
+        '''
+        return int(self.limit)
+
+    def success(self, latency):
+        '''
+        Record a successful request
+        INPUT   latency: time in seconds the request took, including any retries (number)
+        '''
+        with self._lock:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            # let the baseline drift up slowly so that a few unusually fast requests do not hold the level down for good
+            self.baseline = self.latency if self.baseline is None else min(self.latency, self.baseline * 1.01)
+            if self.latency > self.latency_factor * self.baseline:
+                self._decrease('latency {:.1f}s'.format(self.latency))
+            else:
+                self._set(self.limit + 1 / self.limit)
+
+    def throttled(self, response=None):
+        '''
+        Record a failed attempt, such as a 429 or 5xx response, a connection error or a timeout
+        INPUT   response: optional, the response of the failed attempt (requests response)
+        '''
+        with self._lock:
+            self._decrease('HTTP {}'.format(response.status_code) if response is not None else 'connection error')
+
+    def _decrease(self, reason):
+        # requests already in flight were sent at the old level, so only back off once per round trip
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0):
+            return
+        self.last_decrease = now
+        self._set(self.limit * self.decrease_factor, reason)
+
+    def _set(self, limit, reason=''):
+        old = self.level
+        self.limit = min(max(limit, self.minimum), self.maximum)
+        if self.level != old:
+            self.history.append((round(time.monotonic() - self.start_time, 1), self.level))
+            logger.info('{}concurrency {} -> {}{}'.format(self.name + ': ' if self.name else '', old, self.level,
+                                                         ' ({})'.format(reason) if reason else ''))
+
+def _uploadProgress(stats, start_time):
+    '''
+    Update the throughput figures of an upload
+    INPUT   stats: progress of the upload, as returned by insert_to_carto (dictionary)
+            start_time: time at which the upload started, from time.monotonic() (number)
+    RETURN  the updated progress of the upload (dictionary)
+    '''
+    stats['seconds'] = time.monotonic() - start_time
+    stats['rows_per_second'] = stats['rows'] / max(stats['seconds'], 1e-9)
+    stats['bytes_per_second'] = stats['bytes'] / max(stats['seconds'], 1e-9)
+    stats['bytes_per_row'] = stats['bytes'] / max(stats['rows'], 1)
+    stats['encode_seconds_per_row'] = stats['encode_seconds'] / max(stats['rows'], 1)
+    return stats
+
+async def _insertToCartoAsync(table_name, schema, gdf, batch_size, max_payload_bytes, controller, progress, resume,
+                              upsert_field=None, geometry_encoding=GEOMETRY_ENCODING, precision=None):
+    '''
+    Upload the rows of a geodataframe to Carto keeping at most controller.level requests in flight
+    The next batch of rows is only encoded once a request slot frees up, so memory use does not grow with the size of the table
+    INPUT   see insert_to_carto; controller sets the number of requests in flight (ConcurrencyController)
+    RETURN  progress of the upload (dictionary)
+    '''
+    loop = asyncio.get_running_loop()
+    slot_freed = asyncio.Condition()
+    stats = {'rows': 0, 'skipped': 0, 'requests': 0, 'bytes': 0, 'in_flight': 0, 'concurrency': controller.level,
+             'seconds': 0, 'encode_seconds': 0, 'rows_per_second': 0, 'bytes_per_second': 0, 'bytes_per_row': 0,
+             'encode_seconds_per_row': 0}
+    start_time = time.monotonic()
+    last_report = [start_time]
+    failures = []
+    tasks = set()
+    journal = None
+    committed = []
+    if resume:
+        # look for batches committed by a previous, interrupted upload of the same data
+        # the journal is tied to this version of the table, so a table dropped and created again starts over
+        journal_path = _journalPath(table_name, _tableOid(table_name), _frameHash(gdf, schema))
+        committed = _readJournal(journal_path)
+        if committed:
+            stats['skipped'] = sum(stop - start for start, stop in committed)
+            logger.info('Resuming upload to {}: skipping {} rows already committed'.format(table_name, stats['skipped']))
+        os.makedirs(CARTO_JOURNAL_DIR, exist_ok=True)
+        journal = open(journal_path, 'a')
+
+    async def send(executor, query, n_rows, rows):
         try:
-            # send the request 
-            r = requests.post('https://{}.carto.com/api/v2/sql'.format(CARTO_USER), json={'api_key': CARTO_KEY,'q': sql})
-            r.raise_for_status()
-        except Exception as e: # if there's an exception do this
-            insert_exception = e
-            logging.warning('Attempt #{} to upload unsuccessful. Trying again after {} seconds'.format(i, retry_wait_time))
-            logging.debug('Exception encountered during upload attempt: '+ str(e))
-            time.sleep(retry_wait_time)
-        else: # if no exception do this
-            return row.index
+            request_start = time.monotonic()
+            await loop.run_in_executor(executor, insert_carto_send, query, n_rows, controller.throttled)
+            controller.success(time.monotonic() - request_start)
+            # record the committed batch so that it is not sent again if the upload is interrupted
+            if journal is not None:
+                journal.write('{} {}\n'.format(*rows))
+                journal.flush()
+            stats['rows'] += n_rows
+            stats['requests'] += 1
+            stats['bytes'] += len(query.encode('utf-8'))
+            stats['concurrency'] = controller.level
+            _uploadProgress(stats, start_time)
+            if progress is not None:
+                progress(dict(stats))
+            # log the throughput every CARTO_PROGRESS_INTERVAL seconds
+            if time.monotonic() - last_report[0] >= CARTO_PROGRESS_INTERVAL:
+                last_report[0] = time.monotonic()
+                logger.info('{}: {} rows uploaded ({:.0f} rows/s, {:.0f} bytes/s, concurrency {})'.format(
+                    table_name, stats['rows'], stats['rows_per_second'], stats['bytes_per_second'], controller.level))
+        except Exception as e:
+            failures.append(e)
+        finally:
+            stats['in_flight'] -= 1
+            async with slot_freed:
+                slot_freed.notify_all()
+
+    with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+        batches = insert_carto_batches(gdf, schema, table_name, batch_size, max_payload_bytes, committed, upsert_field,
+                                       geometry_encoding, precision)
+        while not failures:
+            # wait for a free slot before encoding the next batch
+            async with slot_freed:
+                await slot_freed.wait_for(lambda: stats['in_flight'] < controller.level or failures)
+            if failures:
+                break
+            encode_start = time.monotonic()
+            batch = next(batches, None)
+            stats['encode_seconds'] += time.monotonic() - encode_start
+            if batch is None:
+                break
+            stats['in_flight'] += 1
+            task = loop.create_task(send(executor, *batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # wait for the requests still in flight
+        if tasks:
+            await asyncio.gather(*tasks)
+    if journal is not None:
+        journal.close()
+    if failures:
+        logger.error('Upload to {} interrupted after {} rows; rerun to resume from the last committed batch'.format(
+            table_name, stats['rows']))
+        raise failures[0]
+    # the upload is complete, so there is nothing left to resume
+    if journal is not None:
+        os.remove(journal.name)
+    stats['concurrency_history'] = controller.history
+    return _uploadProgress(stats, start_time)
+
+def insert_to_carto(table_name, schema, gdf, batch_size=INSERT_BATCH_SIZE, max_payload_bytes=INSERT_MAX_PAYLOAD_BYTES,
+                    max_in_flight=CARTO_MAX_WORKERS, progress=None, resume=False, upsert_field=None,
+                    geometry_encoding=GEOMETRY_ENCODING, precision=None, adaptive=True):
+    '''
+    Insert the rows of a geodataframe into an existing Carto table with batched INSERT queries
+    Only the queries in flight are held in memory, so memory stays flat regardless of the size of the table; progress is
+    logged every CARTO_PROGRESS_INTERVAL seconds
+    If adaptive is True, the number of queries sent at the same time starts at max_in_flight and is tuned by a
+    ConcurrencyController between 1 and CARTO_MAX_CONCURRENCY: it goes up while Carto answers quickly and backs off when
+    Carto throttles, fails or slows down; otherwise exactly max_in_flight queries are sent at the same time
+    If resume is True, the row ranges of committed batches are written to a journal in CARTO_JOURNAL_DIR, keyed by the
+    table name and object identifier and a hash of the data, so that rerunning an interrupted upload skips the batches
+    already committed; the journal is deleted once the upload completes and whenever the table is created again with
+    createTable. A batch committed just before the interruption may not be in the journal yet and is sent again, so
+    resuming needs upsert_field, which makes sending a batch twice harmless
+    INPUT   table_name: the name of the Carto table (string)
+            schema: a dictionary of column names and data types in order to upload data to Carto (dictionary)
+            gdf: a geodataframe storing all the data to upload (geodataframe)
+            batch_size: maximum number of rows to insert with each request (integer)
+            max_payload_bytes: optional, maximum size in bytes of the sql query sent with each request (integer)
+            max_in_flight: number of requests to send at the same time, or at the start if adaptive is True (integer)
+            progress: optional, function called with the current progress after each request completes (function)
+            resume: whether to skip batches committed by a previous, interrupted upload of the same data; requires
+                    upsert_field (boolean)
+            upsert_field: optional, name of a column with a unique index; rows whose value in this column is already in
+                    the table update the existing row instead of being inserted (string)
+            geometry_encoding: how to encode geometries, 'geojson' or 'wkb' for hex WKB, which is several times smaller
+                    for detailed polygons (string)
+            precision: optional, number of decimal places to round coordinates to (integer)
+            adaptive: whether to tune the number of requests sent at the same time to how Carto responds (boolean)
+    RETURN  progress of the upload, with the number of rows sent and skipped, the number of requests and bytes sent, the number of requests
+            still in flight, the current concurrency level, the elapsed seconds, the seconds spent encoding rows, the rows and
+            bytes sent per second, the bytes sent and seconds spent encoding per row and the list of (seconds, level)
+            changes of the concurrency level (dictionary)
+    '''
+    if resume and not upsert_field:
+        raise ValueError('Resuming an upload to {} requires an upsert_field with a unique index'.format(table_name))
+    if adaptive:
+        controller = ConcurrencyController(max_in_flight, maximum=max(CARTO_MAX_CONCURRENCY, max_in_flight), name=table_name)
     else:
-        # this happens if the for loop completes, ie if it attempts to insert row n_tries times without succeeding
-        logging.error('Upload has failed after {} attempts'.format(n_tries))
-        logging.error('Problematic row: '+ str(row))
-        logging.error('Raising exception encountered during last upload attempt')
-        logging.error(insert_exception)
-        raise insert_exception
+        controller = ConcurrencyController(max_in_flight, minimum=max_in_flight, maximum=max_in_flight, name=table_name)
+    # make sure there is a keep-alive connection available for each request in flight
+    _getSession(controller.maximum)
+    return asyncio.run(_insertToCartoAsync(table_name, schema, gdf, batch_size, max_payload_bytes, controller, progress,
+                                           resume, upsert_field, geometry_encoding, precision))
 
-def shapefile_to_carto(table_name, schema, gdf, privacy = 'LINK'):
+def shapefile_to_carto(table_name, schema, gdf, privacy = 'LINK', batch_size=INSERT_BATCH_SIZE, max_payload_bytes=INSERT_MAX_PAYLOAD_BYTES,
+                       max_workers=CARTO_MAX_WORKERS, resume=False, id_field=None, geometry_encoding=GEOMETRY_ENCODING,
+                       precision=None, adaptive=True):
     '''
     Function to upload a shapefile to Carto
     Note: Shapefiles can also be zipped and uploaded to Carto through the upload_to_carto function
@@ -175,25 +1049,42 @@ def shapefile_to_carto(table_name, schema, gdf, privacy = 'LINK'):
     INPUT table_name: the name of the newly created table on Carto (string)
           schema: a dictionary of column names and data types in order to upload data to Carto (dictionary)
           gdf: a geodataframe storing all the data to upload (geodataframe)
-          privacy: the privacy setting of the dataset to upload to Carto (string)
-    '''
-    # initiate a ThreadPoolExecutor with 10 workers 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = []
-        # create an empty list to store the index of the rows uploaded
-        all_ids = []
-        for index, row in gdf.iterrows():
-            # build the sql query to send to Carto 
-            query = insert_carto_query(row, schema, table_name)
-            # submit the task to the executor
-            futures.append(executor.submit(insert_carto_send, query))
-        for future in as_completed(futures):
-            all_ids.append(future.result())
-    logging.info('Upload of {} rows complete!'.format(len(all_ids)))
+          privacy: the privacy setting of the dataset to upload to Carto; set to None to leave it unchanged (string)
+          batch_size: maximum number of rows to insert with each request; set to 1 to send one row per request (integer)
+          max_payload_bytes: optional, maximum size in bytes of the sql query sent with each request (integer)
+          max_workers: number of requests to send at the same time, or at the start if adaptive is True (integer)
+          resume: whether to skip batches committed by a previous, interrupted upload of the same data; requires
+                  id_field (boolean)
+          id_field: optional, name of a column with a unique index, which makes sending a batch twice harmless; rows whose
+                  value in this column is already in the table update the existing row (string)
+          geometry_encoding: how to encode geometries, 'geojson' or 'wkb' for hex WKB (string)
+          precision: optional, number of decimal places to round coordinates to (integer)
+          adaptive: whether to tune the number of requests sent at the same time to how Carto responds (boolean)
+    '''
+    # upload the rows, keeping only the batches in flight in memory
+    stats = insert_to_carto(table_name, schema, gdf, batch_size, max_payload_bytes, max_workers, resume=resume,
+                            upsert_field=id_field, geometry_encoding=geometry_encoding, precision=precision, adaptive=adaptive)
+    # report how many rows were packed in each request so the batch size can be tuned
+    logging.info('Upload of {} rows complete in {} requests ({:.1f} rows per request, {:.0f} rows/s)!'.format(
+        stats['rows'], stats['requests'], stats['rows'] / max(stats['requests'], 1), stats['rows_per_second']))
+    # report the payload size and encoding cost of each row so the geometry encoding can be tuned
+    logging.info('{:.0f} bytes and {:.3f} ms of encoding per row'.format(
+        stats['bytes_per_row'], stats['encode_seconds_per_row'] * 1000))
+    # report how the number of requests sent at the same time evolved
+    logging.info('Concurrency over time (seconds, level): {}'.format(stats['concurrency_history']))
 
     # Change privacy of table on Carto
+    if privacy is not None:
+        setPrivacy(table_name, privacy)
+
+def setPrivacy(table_name, privacy):
+    '''
+    Change the privacy of a table on Carto
+    INPUT   table_name: the name of the Carto table (string)
+            privacy: the privacy setting of the dataset on Carto (string)
+    '''
     #set up carto authentication using local variables for username (CARTO_WRI_RW_USER) and API key (CARTO_WRI_RW_KEY)
-    auth_client = APIKeyAuthClient(api_key=CARTO_KEY, base_url="https://{user}.carto.com/".format(user=CARTO_USER))
+    auth_client = _authClient()
     #set up dataset manager with authentication
     dataset_manager = DatasetManager(auth_client)
     #set dataset privacy
@@ -201,9 +1092,176 @@ def shapefile_to_carto(table_name, schema, gdf, privacy = 'LINK'):
     dataset.privacy = privacy
     dataset.save()
     
+def _copyValue(value, dtype):
+    '''
+    Escape value for the CSV format read by the Carto COPY endpoint based on field type
+    INPUT   value: the value to be written to the CSV (can be of different data types as listed below)
+            dtype: the data types of the value (string)
+    RETURN  CSV field ready to be streamed to Carto (string)
+    TYPE         Escaped
+    None/NaN  -> empty unquoted field, read as NULL
+    geometry  -> hex EWKB with SRID 4326
+    text      -> double quoted, double quotes escaped
+    timestamp -> double quoted
+    varchar   -> double quoted, double quotes escaped
+    else      -> as is
+    '''
+    if value is None or (not isinstance(value, (str, list, dict)) and dtype != 'geometry' and pd.isnull(value)):
+        return ''
+    if dtype == 'geometry':
+        if value.is_empty:
+            return ''
+        return wkb.dumps(value, hex=True, srid=4326)
+    elif dtype in ('text', 'timestamp', 'varchar'):
+        return '"{}"'.format(str(value).replace('"', '""'))
+    else:
+        return str(value)
+
+def _copyRows(df, schema, chunk_rows=COPY_CHUNK_ROWS, counter=None):
+    '''
+    Lazily encode the rows of a dataframe as CSV for the Carto COPY endpoint
+    INPUT   df: dataframe or geodataframe storing the data, with columns in the same order as the schema (dataframe)
+            schema: a dictionary of column names and data types in order to upload data to Carto (dictionary)
+            chunk_rows: number of rows to encode in each chunk of the stream (integer)
+            counter: optional, list whose first element is increased by the number of rows encoded (list)
+    RETURN  generator of chunks of the CSV (bytes)
+    '''
+    dtypes = tuple(schema.values())
+    lines = []
+    for row in df.itertuples(index=False, name=None):
+        lines.append(','.join(_copyValue(row[i], dtypes[i]) for i in range(len(dtypes))))
+        if len(lines) >= chunk_rows:
+            if counter is not None:
+                counter[0] += len(lines)
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        if counter is not None:
+            counter[0] += len(lines)
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+def copy_to_carto(table_name, schema, df, user=None, key=None, chunk_rows=COPY_CHUNK_ROWS):
+    '''
+    Stream a dataframe or geodataframe into an existing Carto table through the COPY FROM endpoint of the SQL API
+    Rows are encoded as CSV (geometries as hex EWKB) while the request is being sent, so no intermediate file is
+    written and no per-row sql is built; use this instead of shapefile_to_carto or upload_to_carto for very large layers
+    The table should be created beforehand, for example with checkCreateTable
+    INPUT   table_name: the name of the Carto table (string)
+            schema: a dictionary of column names and data types, in the same order as the columns of df (dictionary)
+            df: a dataframe or geodataframe storing all the data to upload (dataframe)
+            user: optional, the username of the Carto account (string)
+            key: optional, the key for Carto API (string)
+            chunk_rows: number of rows to encode in each chunk of the stream (integer)
+    RETURN  number of rows loaded into the table (integer)
+    '''
+    user = user or CARTO_USER
+    key = key or CARTO_KEY
+    # the COPY statement reads the CSV in the order of the schema columns
+    sql = 'COPY "{}" ({}) FROM STDIN WITH (FORMAT csv, HEADER false)'.format(table_name, ', '.join(schema.keys()))
+    logging.debug(sql)
+    # keep track of the number of rows streamed in case the response does not report it
+    counter = [0]
+    # a generator body makes requests send the data with chunked transfer encoding
+    r = _request('POST', _sqlUrl(user) + '/copyfrom', params={'api_key': key, 'q': sql},
+                 data=_copyRows(df, schema, chunk_rows, counter),
+                 headers={'Content-Type': 'application/octet-stream'})
+    n_rows = r.json().get('total_rows', counter[0])
+    logger.info('Copied {} rows to Carto table {}'.format(n_rows, table_name))
+    return n_rows
+
+def _readQuery(source, where=None, columns=None):
+    '''
+    Build the query that selects the rows to read from Carto
+    INPUT   source: the name of a Carto table or a SELECT query (string)
+            where: optional, condition rows should meet, such as "date > '2020-01-01'" (string)
+            columns: optional, columns to read; all columns are read by default (list of strings)
+    RETURN  sql query (string)
+    '''
+    if source.lstrip().lower().startswith(('select', 'with')):
+        source = '({}) AS source'.format(source)
+    else:
+        source = '"{}"'.format(source)
+    sql = 'SELECT {} FROM {}'.format(', '.join(columns) if columns else '*', source)
+    if where:
+        sql += ' WHERE {}'.format(where)
+    return sql
+
+def read_carto(source, where=None, columns=None, chunksize=READ_CHUNK_ROWS, user=None, key=None, geometries=False):
+    '''
+    Stream a Carto table or query out through the COPY TO endpoint of the SQL API, as typed dataframes of chunksize rows
+    Only one chunk is held in memory at a time; the column types are looked up first with a query returning no rows:
+    integer columns are read as nullable integers, other numbers as floats, dates are parsed and booleans are read as
+    booleans. Geometries are kept as hex EWKB strings, as the SQL API returns them, unless geometries is True
+    INPUT   source: the name of a Carto table or a SELECT query (string)
+            where: optional, condition rows should meet, used to read only the rows added since the last run (string)
+            columns: optional, columns to read; all columns are read by default (list of strings)
+            chunksize: number of rows in each dataframe (integer)
+            user: optional, the username of the Carto account (string)
+            key: optional, the key for Carto API (string)
+            geometries: whether to read geometries into shapely geometries (boolean)
+    RETURN  generator of dataframes of at most chunksize rows (generator of dataframes)
+    '''
+    user = user or CARTO_USER
+    key = key or CARTO_KEY
+    sql = _readQuery(source, where, columns)
+    # look up the column types without reading any row
+    fields = sendSql('SELECT * FROM ({}) AS fields LIMIT 0'.format(sql), user, key, post=False).json()['fields']
+    dtypes = {}
+    dates = []
+    geometry_fields = []
+    for field, info in fields.items():
+        if info['type'] == 'number':
+            # keep integers as integers, even if some of them are null
+            dtypes[field] = 'Int64' if info.get('pgtype') in ('int2', 'int4', 'int8') else 'float64'
+        elif info['type'] == 'boolean':
+            dtypes[field] = 'boolean'
+        elif info['type'] == 'date':
+            dates.append(field)
+        elif info['type'] == 'geometry':
+            geometry_fields.append(field)
+            dtypes[field] = 'object'
+        else:
+            dtypes[field] = 'object'
+    copy = 'COPY ({}) TO stdout WITH (FORMAT csv, HEADER true)'.format(sql)
+    r = _request('GET', _sqlUrl(user) + '/copyto', params={'api_key': key, 'q': copy}, stream=True)
+    # let pandas read the response as it arrives, decompressing it if needed
+    r.raw.decode_content = True
+    for chunk in pd.read_csv(r.raw, dtype=dtypes, parse_dates=dates, chunksize=chunksize, true_values=['t'],
+                             false_values=['f']):
+        if geometries:
+            for field in geometry_fields:
+                # geometries are sent as hex EWKB
+                chunk[field] = [None if pd.isnull(value) else wkb.loads(value, hex=True) for value in chunk[field].tolist()]
+        yield chunk
+
+def read_carto_table(source, where=None, columns=None, user=None, key=None, geometries=False):
+    '''
+    Read a whole Carto table or query into a dataframe, streaming it with read_carto
+    Since Carto imports numbers as double precision, float columns with no null value whose values are all whole numbers
+    are turned into integers, as they are when the rows are read from the JSON response of the SQL API
+    INPUT   source: the name of a Carto table or a SELECT query (string)
+            where: optional, condition rows should meet (string)
+            columns: optional, columns to read; all columns are read by default (list of strings)
+            user: optional, the username of the Carto account (string)
+            key: optional, the key for Carto API (string)
+            geometries: whether to read geometries into shapely geometries (boolean)
+    RETURN  the rows of the table or query (dataframe)
+    '''
+    chunks = list(read_carto(source, where, columns, user=user, key=key, geometries=geometries))
+    if not chunks:
+        return pd.DataFrame()
+    df = pd.concat(chunks, ignore_index=True)
+    for field in df.columns[df.dtypes == 'float64']:
+        values = df[field]
+        # whole numbers beyond 2 ** 53 may not be exact as floats, so leave them as they are
+        if len(values) and not values.isnull().any() and (values.abs() < 2 ** 53).all() and (values == values.round()).all():
+            df[field] = values.astype('int64')
+    return df
+
 def sendSql(sql, user=None, key=None, f='', post=True):
     '''
     Send arbitrary sql and return response object or False
+    The cached list of tables is invalidated whenever the sql creates, drops or alters a table
     INPUT   sql: the sql query that will be included in the body of the request (string)
             user: the username of the Carto account (string)
             key: the key for Carto API (string)
@@ -212,7 +1270,7 @@ def sendSql(sql, user=None, key=None, f='', post=True):
     RETURN  the response from the API
     '''
     # the url to which the request will be sent 
-    url = "https://{}.carto.com/api/v2/sql".format(user)
+    url = _sqlUrl(user)
     payload = {
         'api_key': key,
         'q': sql,
@@ -220,28 +1278,124 @@ def sendSql(sql, user=None, key=None, f='', post=True):
     if len(f):
         payload['format'] = f
     logging.debug((url, payload))
-    if post:
-        r = requests.post(url, json=payload)
-    else:
-        r = requests.get(url, params=payload)
-    r.raise_for_status()
+    try:
+        if post:
+            r = _request('POST', url, json_body=payload)
+        else:
+            r = _request('GET', url, params=payload)
+    finally:
+        # even a failed statement may have changed the tables, for example if it timed out after running
+        if _TABLE_DDL.search(sql):
+            clearTableCache(user)
     return r
 
-def getTables(user=None, key=None, f='csv'):
+def getTables(user=None, key=None, f='csv', use_cache=False):
     '''
     Get the list of tables in the Carto account
     INPUT   user: the username of the Carto account (string)
             key: the key for Carto API (string)
             f： the format parameter included in the payload (string)
+            use_cache: whether to return the cached list of tables if it is less than CARTO_CATALOG_TTL seconds old;
+                    only used if f is 'csv' (boolean)
     RETURN  tables stored on the Carto account (list of strings if f is 'csv' else response object)
     '''
+    if f == 'csv' and use_cache:
+        tables = _cachedTables(user)
+        if tables is not None:
+            return sorted(tables)
     # send the request to Carto API to fetch the tables stored in the Carto account
     r = sendSql('SELECT * FROM CDB_UserTables()', user, key, f, False)
     if f == 'csv':
         # split the response to get a list of tables 
-        return r.text.splitlines()[1:]
+        tables = r.text.splitlines()[1:]
+        _cacheTables(user, tables)
+        return tables
     return r
 
+def _catalogPath(user=None):
+    '''
+    Get the location of the on-disk cache of the list of tables in a Carto account
+    INPUT   user: the username of the Carto account (string)
+    RETURN  location of the cache on the local computer (string)
+    '''
+    return CARTO_CATALOG_CACHE.format(user=user or CARTO_USER)
+
+def _cachedTables(user=None):
+    '''
+    Get the cached list of tables in a Carto account, from memory or else from disk
+    INPUT   user: the username of the Carto account (string)
+    RETURN  tables stored on the Carto account, or None if there is no cached list younger than CARTO_CATALOG_TTL (set of strings)
+    '''
+    user = user or CARTO_USER
+    with _catalog_lock:
+        cached = _catalog.get(user)
+        if cached is None:
+            # another script may have cached the list recently
+            try:
+                with open(_catalogPath(user)) as cache:
+                    cached = json.load(cache)
+                cached = {'time': cached['time'], 'tables': set(cached['tables'])}
+                _catalog[user] = cached
+            except (OSError, ValueError, KeyError):
+                return None
+        if time.time() - cached['time'] > CARTO_CATALOG_TTL:
+            return None
+        return cached['tables']
+
+def _cacheTables(user=None, tables=None):
+    '''
+    Store the list of tables in a Carto account in memory and on disk
+    INPUT   user: the username of the Carto account (string)
+            tables: tables stored on the Carto account (list of strings)
+    '''
+    user = user or CARTO_USER
+    cached = {'time': time.time(), 'tables': set(tables)}
+    with _catalog_lock:
+        _catalog[user] = cached
+        try:
+            with open(_catalogPath(user), 'w') as cache:
+                json.dump({'time': cached['time'], 'tables': sorted(cached['tables'])}, cache)
+        except OSError:
+            logger.debug('Could not write the table catalog cache to ' + _catalogPath(user))
+
+def clearTableCache(user=None):
+    '''
+    Invalidate the cached list of tables in a Carto account, for example after tables were created or dropped other than
+    through sendSql, which invalidates it itself
+    INPUT   user: the username of the Carto account (string)
+    '''
+    user = user or CARTO_USER
+    with _catalog_lock:
+        _catalog.pop(user, None)
+        try:
+            os.remove(_catalogPath(user))
+        except FileNotFoundError:
+            pass
+
+def tableExists(table, user=None, key=None):
+    '''
+    Check whether a table exists in the Carto account
+    The cached list of tables is checked first, and fetched with getTables if there is none; if the table is not in a
+    cached list, a query for this single table is sent in case another script created it since the list was cached
+    INPUT   table: the name of the Carto table (string)
+            user: the username of the Carto account (string)
+            key: the key for Carto API (string)
+    RETURN  whether the table exists (boolean)
+    '''
+    tables = _cachedTables(user)
+    if tables is None:
+        # fetch and cache the list of tables, so that the next checks need no request
+        return table in getTables(user, key)
+    if table in tables:
+        return True
+    # the table may have been created since the list was cached, so ask Carto about this table only
+    sql = "SELECT '{}' IN (SELECT * FROM CDB_UserTables()) AS exists".format(table.replace("'", "''"))
+    exists = bool(sendSql(sql, user, key, post=False).json()['rows'][0]['exists'])
+    if exists:
+        with _catalog_lock:
+            tables.add(table)
+    return exists
+
 def createTable(table, schema, user=None, key=None):
     '''
     Create table with schema and CartoDBfy table
@@ -256,6 +1410,8 @@ def createTable(table, schema, user=None, key=None):
     defslist = ['{} {}'.format(k, v) for k, v in items]
     sql = 'CREATE TABLE "{}" ({})'.format(table, ','.join(defslist))
     if sendSql(sql, user, key):
+        # rows committed to a previous version of the table are gone, so uploads to it cannot be resumed
+        clearJournal(table)
         return _cdbfyTable(table, user, key)
     return False
 
@@ -291,6 +1447,95 @@ def createIndex(table, fields, unique='', using='', user=None,
         unique, table, f_underscore, table, using, f_comma)
     return sendSql(sql, user, key)
 
+def _swapTable(table_name, staging, fields, id_field='', time_field=''):
+    '''
+    Replace a Carto table with a loaded staging table without readers ever seeing a half-loaded table
+    If the table does not exist yet, the indexes are built on the staging table, which is then renamed into place.
+    Otherwise the live table is kept, so that its identity (oid), its registration, tags and privacy on Carto and the
+    views depending on it do not change: it is emptied and refilled from the staging table in a single transaction,
+    during which readers wait and after which they see the new rows
+    INPUT   table_name: the name of the Carto table to replace; it is created if it does not exist (string)
+            staging: the name of the loaded staging table, which is dropped or renamed (string)
+            fields: columns to copy from the staging table (list of strings)
+            id_field: optional, name of column to set as a unique index of the table (string)
+            time_field: optional, name of column storing datetime information to set as an index of the table (string)
+    '''
+    if not tableExists(table_name, CARTO_USER, CARTO_KEY):
+        # build the indexes once all the rows are loaded
+        if id_field:
+            createIndex(staging, id_field, unique=True, user=CARTO_USER, key=CARTO_KEY)
+        if time_field:
+            createIndex(staging, time_field, user=CARTO_USER, key=CARTO_KEY)
+        # update the statistics used by the query planner
+        sendSql('ANALYZE "{}"'.format(staging), CARTO_USER, CARTO_KEY)
+        # there is no live table yet, so the staging table becomes it; its indexes and sequences are renamed as well
+        # so that the next staging table can reuse their names
+        sql = '''BEGIN;
+ALTER TABLE "{staging}" RENAME TO "{table}";
+DO $$
+DECLARE r record;
+BEGIN
+    FOR r IN SELECT c.relname, c.relkind FROM pg_class c JOIN pg_depend d ON d.objid = c.oid
+             WHERE d.refobjid = '"{table}"'::regclass AND c.relkind IN ('i', 'S') AND strpos(c.relname, '{staging}') > 0 LOOP
+        EXECUTE format(CASE WHEN r.relkind = 'i' THEN 'ALTER INDEX %I RENAME TO %I' ELSE 'ALTER SEQUENCE %I RENAME TO %I' END,
+                       r.relname, replace(r.relname, '{staging}', '{table}'));
+    END LOOP;
+END $$;
+COMMIT;'''.format(table=table_name, staging=staging)
+        sendSql(sql, CARTO_USER, CARTO_KEY)
+        # make sure the renamed table is registered by Carto
+        _cdbfyTable(table_name, CARTO_USER, CARTO_KEY)
+        return
+    # swap the content of the live table in one transaction instead of dropping it, so that it keeps its oid and
+    # everything Carto and other tables attach to it; cartodb_id and the_geom_webmercator are filled by the live table
+    fields = ', '.join('"{}"'.format(field) for field in fields)
+    sql = '''BEGIN;
+TRUNCATE "{table}";
+INSERT INTO "{table}" ({fields}) SELECT {fields} FROM "{staging}";
+DROP TABLE "{staging}";
+COMMIT;'''.format(table=table_name, staging=staging, fields=fields)
+    sendSql(sql, CARTO_USER, CARTO_KEY)
+    # create the indexes the live table does not have yet
+    if id_field:
+        sendSql('CREATE UNIQUE INDEX IF NOT EXISTS idx_{0}_{1} ON "{0}" ({1})'.format(table_name, id_field), CARTO_USER, CARTO_KEY)
+    if time_field:
+        sendSql('CREATE INDEX IF NOT EXISTS idx_{0}_{1} ON "{0}" ({1})'.format(table_name, time_field), CARTO_USER, CARTO_KEY)
+    # update the statistics used by the query planner
+    sendSql('ANALYZE "{}"'.format(table_name), CARTO_USER, CARTO_KEY)
+
+def replace_carto_table(table_name, schema, gdf, id_field='', time_field='', privacy='LINK', method='copy'):
+    '''
+    Replace the content of a Carto table without readers ever seeing a half-loaded table
+    The data is loaded into an unindexed staging table first, which is much faster than loading rows into a table whose
+    indexes have to be maintained on every insert, and the staging table then replaces the table with _swapTable: a new
+    table is renamed into place, while an existing table keeps its oid and is refilled in a single transaction
+    INPUT   table_name: the name of the Carto table to replace; it is created if it does not exist (string)
+            schema: a dictionary of column names and data types, in the same order as the columns of gdf (dictionary)
+            gdf: a dataframe or geodataframe storing all the data to upload (dataframe)
+            id_field: optional, name of column to set as a unique index of the table (string)
+            time_field: optional, name of column storing datetime information to set as an index of the table (string)
+            privacy: the privacy setting of the dataset on Carto; set to None to leave it unchanged (string)
+            method: how to load the rows, 'copy' to stream them with copy_to_carto or 'insert' to send batched INSERT
+                    queries with insert_to_carto (string)
+    RETURN  number of rows loaded (integer)
+    '''
+    staging = '{}_staging'.format(table_name)
+    # start from an empty staging table, with no index other than the ones created by Carto
+    sendSql('DROP TABLE IF EXISTS "{}"'.format(staging), CARTO_USER, CARTO_KEY)
+    createTable(staging, schema, user=CARTO_USER, key=CARTO_KEY)
+    # load the rows
+    if method == 'copy':
+        n_rows = copy_to_carto(staging, schema, gdf)
+    elif method == 'insert':
+        n_rows = insert_to_carto(staging, schema, gdf)['rows']
+    else:
+        raise ValueError('Unknown load method: {}'.format(method))
+    _swapTable(table_name, staging, list(schema.keys()), id_field, time_field)
+    logger.info('Replaced Carto table {} with {} rows'.format(table_name, n_rows))
+    if privacy is not None:
+        setPrivacy(table_name, privacy)
+    return n_rows
+
 def _escapeValue(value, dtype):
     '''
     Escape value for SQL based on field type
@@ -336,3 +1581,84 @@ def _dumpRows(rows, dtypes):
         ]
         dumpedRows.append('({})'.format(','.join(escaped)))
     return ','.join(dumpedRows)
+
+def roundGeometries(geometries, precision):
+    '''
+    Round the coordinates of geometries to a number of decimal places
+    INPUT   geometries: geometries to round (geoseries)
+            precision: number of decimal places to keep (integer)
+    RETURN  geometries with rounded coordinates (list of shapely geometries)
+    '''
+    geometries = geometries.tolist()
+    if hasattr(shapely, 'set_precision'):
+        # shapely 2 rounds the whole column at once
+        return list(shapely.set_precision(geometries, 10 ** -precision))
+    return [None if geom is None else wkt.loads(wkt.dumps(geom, rounding_precision=precision)) for geom in geometries]
+
+def _encodeGeometries(column, geometry_encoding=GEOMETRY_ENCODING, precision=None):
+    '''
+    Encode a whole column of geometries as SQL
+    INPUT   column: the geometries to be included in the query, with nulls replaced by None (geoseries)
+            geometry_encoding: how to encode geometries, 'geojson' or 'wkb' for hex WKB (string)
+            precision: optional, number of decimal places to round coordinates to (integer)
+    RETURN  SQL strings ready to be included in the query to Carto API (list of strings)
+    '''
+    # geometries that are already strings are passed on as they are
+    is_sql = [isinstance(geom, str) for geom in column.tolist()]
+    if any(is_sql):
+        encoded = column.tolist()
+        geoms = column[[not x for x in is_sql]]
+        for i, value in zip([i for i, x in enumerate(is_sql) if not x], _encodeGeometries(geoms, geometry_encoding, precision)):
+            encoded[i] = value
+        return encoded
+    geometries = column.tolist() if precision is None else roundGeometries(column, precision)
+    if geometry_encoding == 'wkb':
+        if precision is None and hasattr(column, 'to_wkb'):
+            # geopandas writes the whole column at once
+            hexes = column.to_wkb(hex=True).tolist()
+        else:
+            hexes = [None if geom is None else wkb.dumps(geom, hex=True) for geom in geometries]
+        # geopandas writes missing geometries as NaN rather than None
+        return ["NULL" if pd.isnull(value) else "ST_GeomFromWKB(decode('{}','hex'),4326)".format(value) for value in hexes]
+    elif geometry_encoding == 'geojson':
+        return ["NULL" if geom is None else
+                "ST_SetSRID(ST_GeomFromGeoJSON('{}'),4326)".format(json.dumps(convert_geometry(geom)))
+                for geom in geometries]
+    raise ValueError('Unknown geometry encoding: {}'.format(geometry_encoding))
+
+def _escapeColumn(column, dtype, geometry_encoding=GEOMETRY_ENCODING, precision=None):
+    '''
+    Escape a whole column of values for SQL based on field type, following the same rules as _escapeValue
+    INPUT   column: the values to be included in the query (series)
+            dtype: the data type of the column (string)
+            geometry_encoding: how to encode geometries, 'geojson' or 'wkb' for hex WKB (string)
+            precision: optional, number of decimal places to round coordinates to (integer)
+    RETURN  SQL strings ready to be included in the query to Carto API (series of strings)
+    '''
+    nulls = column.isnull()
+    if dtype == 'geometry':
+        return pd.Series(_encodeGeometries(column.where(~nulls, None), geometry_encoding, precision),
+                         index=column.index, dtype=object)
+    elif dtype in ('text', 'timestamp', 'varchar'):
+        # quote strings and escape quotes
+        escaped = "'" + column.astype(str).str.replace("'", "''", regex=False) + "'"
+    else:
+        escaped = column.astype(str)
+    return escaped.where(~nulls, 'NULL')
+
+def _dumpFrame(df, dtypes, geometry_encoding=GEOMETRY_ENCODING, precision=None):
+    '''
+    Escapes a chunk of a dataframe to SQL strings, column by column
+    INPUT   df: chunk of data to convert to SQL strings, with columns in the same order as dtypes (dataframe)
+            dtypes: the data type of the columns (list of strings)
+            geometry_encoding: how to encode geometries, 'geojson' or 'wkb' for hex WKB (string)
+            precision: optional, number of decimal places to round coordinates to (integer)
+    RETURN  SQL string of each row, ready to be joined into a VALUES block (list of strings)
+    '''
+    if len(df) == 0:
+        return []
+    # drop the index so that the escaped columns line up even if the index has duplicates
+    df = df.reset_index(drop=True)
+    columns = [_escapeColumn(df.iloc[:, i], dtypes[i], geometry_encoding, precision) for i in range(len(dtypes))]
+    rows = columns[0].str.cat(columns[1:], sep=',') if len(columns) > 1 else columns[0]
+    return ('(' + rows + ')').tolist()
@@ -2,20 +2,330 @@ import os
 import dotenv
 dotenv.load_dotenv(os.getenv('RW_ENV'))
 import boto3
-from botocore.exceptions import NoCredentialsError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import NoCredentialsError, ClientError
 import time
+import json
+import datetime
+import base64
+import hashlib
+import queue
+import zipfile
+import threading
+import google_crc32c
+import requests
 import ee
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
 import logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def gcs_upload(files, prefix='', gcs_bucket=None):
+# default number of files, or parts of a file, uploaded to Google Cloud Storage at the same time
+GCS_MAX_WORKERS = 8
+# files larger than this many bytes are uploaded to Google Cloud Storage in parallel parts that are then composed
+GCS_COMPOSITE_THRESHOLD = 256 * 1024 * 1024
+# smallest size in bytes of each part of a parallel composite upload
+GCS_COMPOSITE_PART_SIZE = 64 * 1024 * 1024
+# maximum number of objects Google Cloud Storage can compose in one request
+GCS_MAX_COMPOSE = 32
+# files, or parts of a file, larger than this many bytes are uploaded to Google Cloud Storage in resumable sessions
+GCS_RESUMABLE_THRESHOLD = 32 * 1024 * 1024
+# number of bytes sent in each request of a resumable upload, a multiple of 256 KB
+GCS_CHUNK_SIZE = 32 * 1024 * 1024
+# folder where the session URI and offset of each unfinished resumable upload are kept, so a rerun can continue it
+GCS_RESUME_DIR = os.getenv('GCS_RESUME_DIR', '.gcs_uploads')
+# number of times a chunk of a resumable upload is sent before giving up
+GCS_N_TRIES = 5
+# connect and read timeouts in seconds of the requests of a resumable upload
+GCS_TIMEOUT = (10, 600)
+# number of bytes read at a time when computing the checksums of a local file
+CHECKSUM_BLOCK_SIZE = 8 * 1024 * 1024
+# files larger than this many bytes are uploaded to Amazon S3 in parts
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', 16 * 1024 * 1024))
+# size in bytes of the parts of a multipart upload to Amazon S3, also used to rebuild its ETag
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE', 16 * 1024 * 1024))
+# number of parts of one file uploaded to Amazon S3 at the same time
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', 16))
+# number of files uploaded to Amazon S3 at the same time by aws_upload_many
+S3_MAX_WORKERS = 4
+# maximum number of parts of a streamed zip archive held in memory while they upload to Amazon S3
+S3_STREAM_PARTS_IN_FLIGHT = 4
+# default settings of the transfers to Amazon S3
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD, multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                                    max_concurrency=S3_MAX_CONCURRENCY)
+# S3 clients by credentials and endpoint, shared by all the uploads
+_s3_clients = {}
+_s3_lock = threading.Lock()
+# maximum number of GEE ingestion tasks kept running at the same time
+GEE_MAX_RUNNING = int(os.getenv('GEE_MAX_RUNNING', 10))
+# shortest and longest number of seconds to wait between two checks of the GEE ingestion tasks
+GEE_POLL_MIN = 10
+GEE_POLL_MAX = 200
+# factor the wait between two checks grows by when no task has finished
+GEE_POLL_BACKOFF = 1.5
+# maximum number of files uploaded to the GCS staging bucket and not yet ingested into GEE by gee_ingest_pipeline
+GEE_MAX_STAGED = 4
+# number of archives created and uploaded to Amazon S3 at the same time by gee_ingest_pipeline
+ARCHIVE_MAX_WORKERS = 2
+# states of a GEE task that has finished
+GEE_TASK_DONE = ('COMPLETED', 'SUCCEEDED', 'FAILED', 'CANCELLED')
+# number of checks in a row a GEE task may be reported UNKNOWN or be missing from the response before it is failed
+GEE_MAX_UNKNOWN_POLLS = 10
+# lock protecting the upload statistics updated by several threads
+_stats_lock = threading.Lock()
+
+def _fileChecksums(f, part_size=S3_MULTIPART_CHUNKSIZE):
+    '''
+    Compute the checksums of a local file in one pass, as they are reported by Google Cloud Storage and Amazon S3
+    INPUT   f: location of file on local computer (string)
+            part_size: size in bytes of the parts of a multipart upload to S3 (integer)
+    RETURN  checksums: base64 CRC32C and MD5, hexadecimal MD5 and S3 multipart ETag of the file (dictionary)
+    '''
+    crc32c = google_crc32c.Checksum()
+    md5 = hashlib.md5()
+    # MD5 of each part of a multipart upload, which S3 combines into the ETag
+    part_md5s = []
+    part = hashlib.md5()
+    part_filled = 0
+    with open(f, 'rb') as source:
+        for block in iter(lambda: source.read(CHECKSUM_BLOCK_SIZE), b''):
+            crc32c.update(block)
+            md5.update(block)
+            while block:
+                piece = block[:part_size - part_filled]
+                part.update(piece)
+                part_filled += len(piece)
+                block = block[len(piece):]
+                if part_filled == part_size:
+                    part_md5s.append(part.digest())
+                    part, part_filled = hashlib.md5(), 0
+    if part_filled:
+        part_md5s.append(part.digest())
+    return {'crc32c': base64.b64encode(crc32c.digest()).decode('utf-8'),
+            'md5': base64.b64encode(md5.digest()).decode('utf-8'),
+            'md5_hex': md5.hexdigest(),
+            'multipart_etag': '{}-{}'.format(hashlib.md5(b''.join(part_md5s)).hexdigest(), len(part_md5s))}
+
+def _countUpload(stats, size, skipped):
+    '''
+    Add an uploaded or skipped file to the upload statistics
+    INPUT   stats: statistics to update, or None (dictionary)
+            size: size of the file in bytes (integer)
+            skipped: whether the file was skipped because it was unchanged (boolean)
+    '''
+    if stats is None:
+        return
+    kind = 'skipped' if skipped else 'uploaded'
+    with _stats_lock:
+        stats[kind + '_files'] = stats.get(kind + '_files', 0) + 1
+        stats[kind + '_bytes'] = stats.get(kind + '_bytes', 0) + size
+
+def _gcsUnchanged(f, path, gcs_bucket):
+    '''
+    Check whether a file already exists on Google Cloud Storage with the same content
+    INPUT   f: location of file on local computer (string)
+            path: location of the object within the GCS bucket (string)
+            gcs_bucket: GCS bucket holding the object (google.cloud.storage.bucket.Bucket)
+    RETURN  whether the object exists and its checksum matches the file (boolean)
+    '''
+    blob = gcs_bucket.get_blob(path)
+    if blob is None or blob.size != os.path.getsize(f):
+        return False
+    checksums = _fileChecksums(f)
+    # composite objects have no MD5, but every object has a CRC32C
+    if blob.md5_hash:
+        return blob.md5_hash == checksums['md5']
+    return blob.crc32c == checksums['crc32c']
+
+def _resumePath(blob):
+    '''
+    Get the file keeping the state of the resumable upload of an object
+    INPUT   blob: object being uploaded (google.cloud.storage.blob.Blob)
+    RETURN  file name of the state (string)
+    '''
+    key = '{}/{}'.format(blob.bucket.name, blob.name)
+    return os.path.join(GCS_RESUME_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+def _sessionOffset(session_uri, length):
+    '''
+    Ask Google Cloud Storage how many bytes of a resumable upload it has received
+    INPUT   session_uri: URI of the resumable upload session (string)
+            length: total size in bytes of the upload (integer)
+    RETURN  number of bytes received, or None if the session has expired (integer)
+    '''
+    response = requests.put(session_uri, headers={'Content-Range': 'bytes */{}'.format(length)}, timeout=GCS_TIMEOUT)
+    if response.status_code in (200, 201):
+        return length
+    if response.status_code == 308:
+        received = response.headers.get('Range')
+        return int(received.split('-')[1]) + 1 if received else 0
+    if response.status_code in (404, 410):
+        return None
+    response.raise_for_status()
+
+def _gcsResumableUpload(f, blob, start=0, length=None):
+    '''
+    Upload a file, or a range of bytes of it, to Google Cloud Storage in a resumable session
+    The session URI and offset are saved in GCS_RESUME_DIR after every chunk, so that if the upload is interrupted,
+    running it again continues the session from the last byte GCS received instead of starting over.
+    INPUT   f: location of file on local computer that you want to upload (string)
+            blob: object to upload the file to (google.cloud.storage.blob.Blob)
+            start: position in bytes of the start of the range to upload (integer)
+            length: optional, number of bytes to upload; to the end of the file if None (integer)
+    '''
+    stat = os.stat(f)
+    length = stat.st_size - start if length is None else length
+    # the upload can only continue if the file has not changed since it started
+    source_id = {'file': os.path.abspath(f), 'size': stat.st_size, 'mtime': stat.st_mtime, 'start': start, 'length': length}
+    state_file = _resumePath(blob)
+    state = None
+    try:
+        with open(state_file) as saved:
+            saved_state = json.load(saved)
+        if {key: saved_state.get(key) for key in source_id} == source_id:
+            state = saved_state
+    except (OSError, ValueError):
+        pass
+    # a saved session is continued from the offset GCS reports, which is asked for in the loop below so that a
+    # failed request is retried like a failed chunk
+    resuming = state is not None
+    if not resuming:
+        state = dict(source_id, session_uri=blob.create_resumable_upload_session(
+            content_type='application/octet-stream', size=length, timeout=GCS_TIMEOUT[1]))
+    offset = 0
+    # whether the offset must be asked for before sending the next chunk
+    sync = resuming
+    os.makedirs(GCS_RESUME_DIR, exist_ok=True)
+    tries = 0
+    with open(f, 'rb') as source:
+        while sync or offset < length:
+            try:
+                if sync:
+                    offset = _sessionOffset(state['session_uri'], length)
+                    if offset is None:
+                        if not resuming:
+                            raise Exception('Upload session of {} to {} expired'.format(f, blob.name))
+                        # the saved session has expired, so start a new one
+                        state = dict(source_id, session_uri=blob.create_resumable_upload_session(
+                            content_type='application/octet-stream', size=length, timeout=GCS_TIMEOUT[1]))
+                        offset = 0
+                    elif resuming:
+                        logger.info('Resuming upload of {} to {} at byte {}'.format(f, blob.name, offset))
+                    sync = resuming = False
+                    continue
+                # save the offset before sending the next chunk
+                state['offset'] = offset
+                with open(state_file, 'w') as saved:
+                    json.dump(state, saved)
+                source.seek(start + offset)
+                chunk = source.read(min(GCS_CHUNK_SIZE, length - offset))
+                headers = {'Content-Range': 'bytes {}-{}/{}'.format(offset, offset + len(chunk) - 1, length)}
+                response = requests.put(state['session_uri'], data=chunk, headers=headers, timeout=GCS_TIMEOUT)
+                retry = response.status_code == 429 or response.status_code >= 500
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logger.debug('Upload of {} interrupted: {}'.format(f, e))
+                retry = True
+            except requests.HTTPError as e:
+                # raised by _sessionOffset
+                if e.response is None or not (e.response.status_code == 429 or e.response.status_code >= 500):
+                    raise
+                logger.debug('Upload of {} interrupted: {}'.format(f, e))
+                retry = True
+            if retry:
+                tries += 1
+                if tries >= GCS_N_TRIES:
+                    raise Exception('Upload of {} to {} failed after {} tries; run it again to resume'.format(f, blob.name, tries))
+                time.sleep(2 ** tries)
+                # GCS may have received part of the chunk
+                sync = True
+                continue
+            tries = 0
+            if response.status_code in (200, 201):
+                offset = length
+            elif response.status_code == 308:
+                received = response.headers.get('Range')
+                offset = int(received.split('-')[1]) + 1 if received else 0
+            else:
+                response.raise_for_status()
+    os.remove(state_file)
+
+def _gcsUploadFile(f, path, gcs_bucket, composite_threshold=GCS_COMPOSITE_THRESHOLD, max_workers=GCS_MAX_WORKERS):
+    '''
+    Upload one file to Google Cloud Storage, in parallel parts if it is larger than composite_threshold
+    Large files and parts are uploaded in resumable sessions, and the parts of an interrupted upload are kept on GCS,
+    so that uploading the same file again only sends what is missing. Once all the parts are uploaded they are
+    deleted, even if composing them fails.
+    INPUT   f: location of file on local computer that you want to upload (string)
+            path: location within the GCS bucket where the file should go (string)
+            gcs_bucket: GCS bucket to upload the file to (google.cloud.storage.bucket.Bucket)
+            composite_threshold: optional, size in bytes above which the file is uploaded in parallel parts; None to
+                    always upload the file in one piece (integer)
+            max_workers: number of parts to upload at the same time (integer)
+    '''
+    stat = os.stat(f)
+    size = stat.st_size
+    if composite_threshold is None or size <= composite_threshold or max_workers < 2:
+        if size > GCS_RESUMABLE_THRESHOLD:
+            _gcsResumableUpload(f, gcs_bucket.blob(path))
+        else:
+            gcs_bucket.blob(path).upload_from_filename(f, timeout=600)
+        return
+    # split the file into at most GCS_MAX_COMPOSE parts, each at least GCS_COMPOSITE_PART_SIZE bytes
+    n_parts = int(min(GCS_MAX_COMPOSE, max(2, -(-size // GCS_COMPOSITE_PART_SIZE))))
+    part_size = -(-size // n_parts)
+    ranges = [(start, min(part_size, size - start)) for start in range(0, size, part_size)]
+    # name the parts after the version of the file, so that parts of an earlier version are never reused
+    version = hashlib.sha1('{}-{}'.format(size, stat.st_mtime).encode('utf-8')).hexdigest()[:8]
+    parts = [gcs_bucket.blob('{}.{}.part{:02d}'.format(path, version, i)) for i in range(len(ranges))]
+    logger.debug('Uploading {} in {} parallel parts'.format(f, len(parts)))
+
+    def upload_part(i):
+        # upload the bytes of the file that belong to this part, unless an earlier run already did
+        start, length = ranges[i]
+        uploaded = gcs_bucket.get_blob(parts[i].name)
+        if uploaded is not None and uploaded.size == length:
+            logger.debug('Part {} already uploaded'.format(parts[i].name))
+        elif length > GCS_RESUMABLE_THRESHOLD:
+            _gcsResumableUpload(f, parts[i], start, length)
+        else:
+            with open(f, 'rb') as source:
+                source.seek(start)
+                parts[i].upload_from_file(source, size=length, timeout=600)
+
+    # the parts of an interrupted upload are kept so that it can be resumed
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(upload_part, range(len(parts))))
+    try:
+        # join the parts into the final object on the server
+        blob = gcs_bucket.blob(path)
+        blob.compose(parts, timeout=600)
+    finally:
+        # once all the parts are uploaded, remove them whether or not the compose succeeded
+        for part in parts:
+            try:
+                part.delete()
+            except Exception:
+                logger.debug('Could not delete part {}'.format(part.name))
+
+def gcs_upload(files, prefix='', gcs_bucket=None, max_workers=GCS_MAX_WORKERS, composite_threshold=GCS_COMPOSITE_THRESHOLD,
+               skip_unchanged=True, stats=None):
     '''
     Upload files to Google Cloud Storage
-    INPUT   files: location of file on local computer that you want to upload (string)
+    Several files are uploaded at the same time, and files larger than composite_threshold are uploaded as parallel
+    parts that are composed into one object on the server. To test against a local fake GCS server, set the
+    STORAGE_EMULATOR_HOST environment variable to its address. Files that already exist on GCS with the same checksum
+    are not uploaded again.
+    INPUT   files: location of file on local computer that you want to upload (string or list of strings)
             prefix: optional, folder within GCS bucket where you want to upload the data (string)
-    RETURN  gcs_uris: list of uploaded data file locations on GCS (list of strings)
+            gcs_bucket: optional, GCS bucket to upload the data to (google.cloud.storage.bucket.Bucket)
+            max_workers: number of files, or parts of a large file, to upload at the same time (integer)
+            composite_threshold: optional, size in bytes above which a file is uploaded in parallel parts; None to
+                    upload every file in one piece (integer)
+            skip_unchanged: whether to skip files whose checksum matches the existing object on GCS (boolean)
+            stats: optional, dictionary to add the number of files and bytes uploaded and skipped to (dictionary)
+    RETURN  gcs_uris: list of uploaded data file locations on GCS, in the same order as files (list of strings)
     '''
     # make sure the GCS bucket exists, create it if it does not
     if gcs_bucket is None:
@@ -26,19 +336,31 @@ def gcs_upload(files, prefix='', gcs_bucket=None):
         gcs_bucket.create()
     # make sure files to be uploaded are formatted as a tuple
     files = (files,) if isinstance(files, str) else files
-    # create an empty list to store the list of files we have uploaded to GCS
-    gcs_uris = []
-    # loop through each file and upload
-    for f in files:
-        # define location within GCS bucket where the file should go
-        path = '{}/{}'.format(prefix, os.path.basename(f))
-        # format the full GCS path for the file
-        uri = 'gs://{}/{}'.format(gcs_bucket.name, path)
-        logger.debug('Uploading {} to {}'.format(f, uri))
-        # upload the file to GCS
-        gcs_bucket.blob(path).upload_from_filename(f, timeout=600)
-        # add the file location to our list of uploaded files
-        gcs_uris.append(uri)
+    # define location within GCS bucket where each file should go
+    paths = ['{}/{}'.format(prefix, os.path.basename(f)) for f in files]
+    # format the full GCS path for each file
+    gcs_uris = ['gs://{}/{}'.format(gcs_bucket.name, path) for path in paths]
+
+    # keep track of uploaded and skipped files, even if the caller does not ask for them
+    stats = {} if stats is None else stats
+    skipped_bytes = stats.get('skipped_bytes', 0)
+
+    def upload(i):
+        size = os.path.getsize(files[i])
+        if skip_unchanged and _gcsUnchanged(files[i], paths[i], gcs_bucket):
+            logger.debug('Skipping {}, unchanged on {}'.format(files[i], gcs_uris[i]))
+            _countUpload(stats, size, skipped=True)
+            return
+        logger.debug('Uploading {} to {}'.format(files[i], gcs_uris[i]))
+        # large files are split between the workers left over after the other files
+        _gcsUploadFile(files[i], paths[i], gcs_bucket, composite_threshold, max(1, max_workers // len(files)))
+        _countUpload(stats, size, skipped=False)
+
+    # upload the files at the same time
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files)))) as executor:
+        list(executor.map(upload, range(len(files))))
+    if stats.get('skipped_bytes', 0) > skipped_bytes:
+        logger.info('Skipped {} bytes already on GCS'.format(stats['skipped_bytes'] - skipped_bytes))
     return gcs_uris
 
 def millis_since_epoch(date):
@@ -52,11 +374,12 @@ def millis_since_epoch(date):
     seconds = (date - datetime.datetime.utcfromtimestamp(0)).total_seconds()
     return int(seconds * 1000)
     
-def gee_manifest_bands(bands_dict, dataset_name):
+def gee_manifest_bands(bands_dict, dataset_name, tileset_ids=None):
     '''
     Create bands manifest for image upload to GEE (https://developers.google.com/earth-engine/image_manifest)
     INPUT   bands_dict: dictionary in which keys are band names and values are dictionaries containing a list of no-data values and the pyramiding policy to use in Google Earth Engine (dictionary)
             dataset_name: name of the asset being uploaded to GEE (string)
+            tileset_ids: optional, when each band comes from its own single-band file, the tileset ID of each band, in order (list of strings)
     RETURN  bands_mf: band manifest for asset upload into GEE, in the form of a list of dictionaries, with each dictionary containing parameters for an image band (list of dictionaries)
     '''
     bands_mf = []
@@ -65,8 +388,8 @@ def gee_manifest_bands(bands_dict, dataset_name):
         if 'band_ids' not in val:
             mf_element = {
                 'id': key,
-                'tileset_band_index': i,
-                'tileset_id': dataset_name,
+                'tileset_band_index': i if tileset_ids is None else 0,
+                'tileset_id': dataset_name if tileset_ids is None else tileset_ids[i],
                 'missing_data': {
                     'values': val['missing_data'],
                 },
@@ -78,8 +401,8 @@ def gee_manifest_bands(bands_dict, dataset_name):
             for band_id in val['band_ids']:
                 mf_element = {
                     'id': band_id,
-                    'tileset_band_index': i,
-                    'tileset_id': dataset_name,
+                    'tileset_band_index': i if tileset_ids is None else 0,
+                    'tileset_id': dataset_name if tileset_ids is None else tileset_ids[i],
                     'missing_data': {
                         'values': val['missing_data'],
                     },
@@ -92,22 +415,145 @@ def gee_manifest_bands(bands_dict, dataset_name):
 def gee_manifest_complete(asset, gcs_uri, mf_bands, date=''):
     '''
     Create complete manifest for image upload to GEE (https://developers.google.com/earth-engine/image_manifest)
+    Several files can be ingested into one asset, without merging them locally: the files of a tileset are spatial
+    tiles that GEE mosaics, and each tileset provides the bands it is referred to by in mf_bands, so that single-band
+    files can become the bands of one image.
     INPUT   asset: name of the asset being uploaded to GEE (string)
-            gs_uri: data file location on GCS, should be formatted `gs://<bucket>/<blob>` (string)
-            mf_bands: band manifest, created with gee_manifest_bands function (dictionary)
+            gs_uri: data file location on GCS, should be formatted `gs://<bucket>/<blob>`; or a list of locations of
+                    tiles to mosaic into one tileset, named after the first; or a dictionary in which keys are tileset
+                    IDs and values are the location, or list of locations of the tiles, of each tileset (string, list
+                    of strings or dictionary)
+            mf_bands: band manifest, created with gee_manifest_bands function, or None to use the bands of the tilesets as they are (dictionary)
             date: optional, date tag for asset (datetime.datetime or int ms since epoch)
     RETURN  manifest: complete manifest for asset upload into GEE (dictionary)
     '''
+    # make sure each tileset is formatted as a list of tiles
+    if isinstance(gcs_uri, dict):
+        tilesets = {tileset_id: [uris] if isinstance(uris, str) else list(uris) for tileset_id, uris in gcs_uri.items()}
+    else:
+        uris = [gcs_uri] if isinstance(gcs_uri, str) else list(gcs_uri)
+        tilesets = {os.path.basename(uris[0]).split('.')[0]: uris}
     # set up parameters for image task ingestion
     manifest = {'name': f'projects/earthengine-legacy/assets/{asset}',
-              'tilesets': [{'id': os.path.basename(gcs_uri).split('.')[0], 'sources': [{'uris': gcs_uri}]}]}
+              'tilesets': [{'id': tileset_id, 'sources': [{'uris': [uri]} for uri in uris]}
+                           for tileset_id, uris in tilesets.items()]}
     # if a date was input into the function, add it to the parameters
     if date:
         manifest['properties'] = {'time_start': millis_since_epoch(date),
                                 'time_end': millis_since_epoch(date)}
-    manifest['bands'] = mf_bands
+    # without a band manifest, GEE names the bands of the tilesets itself
+    if mf_bands is not None:
+        manifest['bands'] = mf_bands
     return manifest
 
+def _geeQuotaError(error):
+    '''
+    Check whether an Earth Engine error was caused by too many tasks or requests
+    INPUT   error: error raised by the Earth Engine API (Exception)
+    RETURN  whether the error is a quota or rate limit error (boolean)
+    '''
+    message = str(error).lower()
+    return any(text in message for text in ('quota', 'too many', 'rate limit', '429'))
+
+def gee_ingest_many(manifests, public=False, max_running=GEE_MAX_RUNNING, poll_min=GEE_POLL_MIN, poll_max=GEE_POLL_MAX,
+                    max_unknown_polls=GEE_MAX_UNKNOWN_POLLS):
+    '''
+    Upload many assets from Google Cloud Storage to Google Earth Engine, keeping several ingestion tasks running at once
+    At most max_running tasks run at the same time; a new task is started as soon as one finishes, and fewer are kept
+    running while GEE refuses new tasks because of its quotas. The state of every running task is checked with a
+    single request, more and more rarely while none of them finishes. manifests may be a generator producing None when
+    no manifest is ready yet, in which case the tasks already running are checked before asking it again.
+    INPUT   manifests: image manifests, specifying how each asset should be ingested into GEE (iterable of dictionaries)
+            public: whether the assets should be publicly available on GEE (boolean)
+            max_running: maximum number of ingestion tasks running at the same time (integer)
+            poll_min: shortest number of seconds to wait between two checks of the tasks (number)
+            poll_max: longest number of seconds to wait between two checks of the tasks (number)
+            max_unknown_polls: number of checks in a row a task may be reported UNKNOWN or be missing from the response
+                before it is reported FAILED (integer)
+    RETURN  generator of results, in the order the tasks finish, each with the asset name, task ID, final state and
+            error message of one task (dictionaries)
+    '''
+    manifests = iter(manifests)
+    # manifests waiting for a task, starting with those GEE refused because of its quotas
+    waiting = []
+    # manifest of each running task, by task ID
+    running = {}
+    # number of checks in a row each running task was unknown to GEE, by task ID
+    unknown = {}
+    # number of tasks allowed to run, lowered while GEE refuses new tasks
+    window = max_running
+    interval = poll_min
+    exhausted = False
+    while True:
+        # start tasks until the window is full
+        while len(running) < window and not exhausted:
+            if not waiting:
+                manifest = next(manifests, StopIteration)
+                if manifest is StopIteration:
+                    exhausted = True
+                    break
+                if manifest is None:
+                    # no manifest is ready yet
+                    break
+                waiting.append(manifest)
+            manifest = waiting[0]
+            logger.debug('Submitting asset for upload to GEE using the following manifest: \n' + str(manifest))
+            try:
+                task_id = ee.data.newTaskId()[0]
+                ee.data.startIngestion(task_id, manifest, True)
+            except ee.ee_exception.EEException as e:
+                if not _geeQuotaError(e):
+                    raise
+                # keep the running tasks as the window until one of them finishes
+                logger.info('GEE refused a new task, waiting for running tasks: {}'.format(e))
+                window = max(1, len(running))
+                break
+            waiting.pop(0)
+            running[task_id] = manifest
+        if not running and not waiting and exhausted:
+            return
+        if not running:
+            if waiting:
+                # GEE refused the only task; try again after a longer wait
+                time.sleep(interval)
+                interval = min(poll_max, interval * GEE_POLL_BACKOFF)
+            continue
+        time.sleep(interval)
+        # check the state of all the running tasks at once
+        statuses = {status['id']: status for status in ee.data.getTaskStatus(list(running))}
+        finished = []
+        for task_id in list(running):
+            status = statuses.get(task_id, {'id': task_id, 'state': 'UNKNOWN'})
+            if status['state'] in GEE_TASK_DONE:
+                finished.append(status)
+            elif status['state'] == 'UNKNOWN':
+                # GEE may not know a task it has just started, but one it never reports would be checked forever
+                unknown[task_id] = unknown.get(task_id, 0) + 1
+                if unknown[task_id] >= max_unknown_polls:
+                    finished.append({'id': task_id, 'state': 'FAILED',
+                                     'error_message': 'Task state unknown after {} checks'.format(unknown[task_id])})
+            else:
+                unknown.pop(task_id, None)
+        for status in finished:
+            manifest = running.pop(status['id'])
+            unknown.pop(status['id'], None)
+            if status['state'] in ('COMPLETED', 'SUCCEEDED'):
+                logger.debug('GEE asset created: {}'.format(manifest['name']))
+                if public:
+                    # set dataset privacy to public
+                    ee.data.setAssetAcl(manifest['name'], {"all_users_can_read": True})
+                    logger.info('Privacy set to public.')
+            else:
+                logger.error('GEE ingestion of {} {}: {}'.format(manifest['name'], status['state'], status.get('error_message', '')))
+            yield {'asset': manifest['name'], 'task_id': status['id'], 'state': status['state'],
+                   'error_message': status.get('error_message')}
+        if finished:
+            # tasks finished, so check again soon and allow the full window again
+            window = max_running
+            interval = poll_min
+        else:
+            interval = min(poll_max, interval * GEE_POLL_BACKOFF)
+
 def gee_ingest(manifest, public=False):
     '''
     Upload asset from Google Cloud Storage to Google Earth Engine
@@ -115,37 +561,10 @@ def gee_ingest(manifest, public=False):
             public: whether the asset should be publicly available on GEE (boolean)
     RETURN  task_id: Earth Engine task ID for file upload (string)
     '''
-    # create a new task ID to ingest this asset
-    task_id = ee.data.newTaskId()[0]
-    # start ingestion process
-    uploaded = False
-    logger.debug('Submitting asset for upload to GEE using the following manifest: \n' + str(manifest))
-    task = ee.data.startIngestion(task_id, manifest, True)
-    # set the state to 'RUNNING' because we have started the task
-    state = 'RUNNING'
-    # if process is still running, wait before checking ingestion again
-    while uploaded == False and state != 'FAILED':
-        try:
-            ee.data.getAsset(manifest['name'])
-            uploaded = True
-            logging.info(state)
-            logger.debug('GEE asset created: {}'.format(asset))
-            if public==True:
-                # set dataset privacy to public
-                acl = {"all_users_can_read": True}
-                ee.data.setAssetAcl(manifest['name'], acl)
-                logging.info('Privacy set to public.')
-        except:
-            time.sleep(200)
-            state = ee.data.getTaskStatus(task['id'])[0]['state']
-            # log if the task is running and change the state
-            if state == 'RUNNING':
-                logging.info(state)
-            # log an error if the task fails and change the state
-            elif state == 'FAILED':
-                logging.info(state)
-                logging.error(ee.data.getTaskStatus(task['id'])[0]['error_message'])
-    return task['id']
+    # wait for the single task to finish
+    for result in gee_ingest_many([manifest], public=public):
+        logger.info(result['state'])
+        return result['task_id']
 
 def gcs_remove(gcs_uris, gcs_bucket=None):
     '''
@@ -166,16 +585,83 @@ def gcs_remove(gcs_uris, gcs_bucket=None):
     # delete all files from Google Cloud Storage
     gcs_bucket.delete_blobs(paths, lambda x:x)
     
-def aws_upload(local_file, bucket, s3_file):
+def _s3Unchanged(s3, local_file, bucket, s3_file, part_size=S3_MULTIPART_CHUNKSIZE):
+    '''
+    Check whether a file already exists on Amazon S3 with the same content
+    The file is only read to compute its checksums when an object of the same size exists, so that checking a new
+    object costs a single HEAD request.
+    INPUT   s3: S3 client (botocore.client.S3)
+            local_file: local file (string)
+            bucket: AWS bucket holding the object (string)
+            s3_file: path of the object within the AWS bucket (string)
+            part_size: size in bytes of the parts of a multipart upload to S3 (integer)
+    RETURN  unchanged: whether the object exists and its checksum matches the file (boolean)
+            checksums: checksums of the local file returned by _fileChecksums, or None if they were not computed
+                (dictionary)
+    '''
+    try:
+        head = s3.head_object(Bucket=bucket, Key=s3_file)
+    except ClientError:
+        return False, None
+    if head['ContentLength'] != os.path.getsize(local_file):
+        return False, None
+    checksums = _fileChecksums(local_file, part_size)
+    # the MD5 stored by aws_upload at upload time is exact; otherwise compare the ETag, which is the MD5 of
+    # single part uploads and the MD5 of the MD5s of the parts of multipart uploads
+    if 'md5' in head.get('Metadata', {}):
+        return head['Metadata']['md5'] == checksums['md5_hex'], checksums
+    etag = head['ETag'].strip('"')
+    return etag in (checksums['md5_hex'], checksums['multipart_etag']), checksums
+
+def _s3Client():
+    '''
+    Get the S3 client for the current credentials, creating it on first use
+    Set the AWS_ENDPOINT_URL environment variable to send the requests to a local S3 stand-in, such as a moto server.
+    RETURN  s3: S3 client (botocore.client.S3)
+    '''
+    key = (os.getenv('aws_access_key_id'), os.getenv('aws_secret_access_key'), os.getenv('AWS_ENDPOINT_URL'))
+    # creating clients is not thread safe
+    with _s3_lock:
+        if key not in _s3_clients:
+            _s3_clients[key] = boto3.client('s3', aws_access_key_id=key[0], aws_secret_access_key=key[1], endpoint_url=key[2],
+                                            config=Config(max_pool_connections=S3_MAX_CONCURRENCY * S3_MAX_WORKERS))
+        return _s3_clients[key]
+
+def clearS3Clients():
+    '''
+    Forget the cached S3 clients, for example after starting a moto mock
+    '''
+    with _s3_lock:
+        _s3_clients.clear()
+
+def aws_upload(local_file, bucket, s3_file, skip_unchanged=True, stats=None, config=None):
     '''
     Upload original data and processed data to Amazon S3 storage
+    Files that already exist on S3 with the same checksum are not uploaded again.
     INPUT   local_file: local file to be uploaded to AWS (string)
         bucket: AWS bucket where file should be uploaded (string)
         s3_file: path where file should be uploaded within the input AWS bucket (string)
+        skip_unchanged: whether to skip the file if its checksum matches the existing object on S3 (boolean)
+        stats: optional, dictionary to add the number of files and bytes uploaded and skipped to (dictionary)
+        config: optional, multipart threshold, part size and concurrency of the transfer; S3_TRANSFER_CONFIG if None
+                (boto3.s3.transfer.TransferConfig)
     '''
-    s3 = boto3.client('s3', aws_access_key_id=os.getenv('aws_access_key_id'), aws_secret_access_key=os.getenv('aws_secret_access_key'))
+    s3 = _s3Client()
+    config = config or S3_TRANSFER_CONFIG
     try:
-        s3.upload_file(local_file, bucket, s3_file)
+        # the file is only read when an object of the same size already exists on S3
+        unchanged, checksums = _s3Unchanged(s3, local_file, bucket, s3_file, config.multipart_chunksize) \
+            if skip_unchanged else (False, None)
+        if unchanged:
+            logger.info("AWS upload skipped, {} bytes unchanged: http://{}.s3.amazonaws.com/{}".format(
+                os.path.getsize(local_file), bucket, s3_file))
+            _countUpload(stats, os.path.getsize(local_file), skipped=True)
+            return True
+        # when the checksums were computed, store the MD5 of the file so that later uploads can be compared with it
+        # whatever the ETag is; otherwise later uploads compare the ETag
+        extra_args = {'Metadata': {'md5': checksums['md5_hex']}} if checksums else None
+        s3.upload_file(local_file, bucket, s3_file, ExtraArgs=extra_args, Config=config)
+        _countUpload(stats, os.path.getsize(local_file), skipped=False)
         logger.info("AWS upload successful: http://{}.s3.amazonaws.com/{}".format(bucket, s3_file))
         return True
     except FileNotFoundError:
@@ -184,3 +670,217 @@ def aws_upload(local_file, bucket, s3_file):
     except NoCredentialsError:
         logger.error("aws_upload - credentials not available.")
         return False
+
+def aws_upload_many(uploads, bucket, max_workers=S3_MAX_WORKERS, skip_unchanged=True, stats=None, config=None):
+    '''
+    Upload several files to Amazon S3 storage at the same time
+    INPUT   uploads: local files to be uploaded to AWS and paths where they should be uploaded within the input AWS
+                bucket (list of tuples of strings)
+        bucket: AWS bucket where files should be uploaded (string)
+        max_workers: number of files to upload at the same time (integer)
+        skip_unchanged: whether to skip files whose checksum matches the existing object on S3 (boolean)
+        stats: optional, dictionary to add the number of files and bytes uploaded and skipped to (dictionary)
+        config: optional, multipart threshold, part size and concurrency of each transfer; S3_TRANSFER_CONFIG if None
+                (boto3.s3.transfer.TransferConfig)
+    RETURN  uploaded: whether each file was uploaded, in the same order as uploads (list of booleans)
+    '''
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(uploads)))) as executor:
+        return list(executor.map(lambda upload: aws_upload(upload[0], bucket, upload[1], skip_unchanged, stats, config), uploads))
+
+class _S3PartWriter:
+    '''
+    Write-only file uploading what is written to it as the parts of an Amazon S3 multipart upload
+    At most parts_in_flight parts are uploading at the same time; writes wait for one of them to finish beyond that,
+    so that no more than parts_in_flight + 1 parts are held in memory.
+    INPUT   s3: S3 client (botocore.client.S3)
+            bucket: AWS bucket where the object should be uploaded (string)
+            s3_file: path where the object should be uploaded within the AWS bucket (string)
+            part_size: size in bytes of each part but the last, at least 5 MB (integer)
+            parts_in_flight: maximum number of parts uploading at the same time (integer)
+    '''
+    def __init__(self, s3, bucket, s3_file, part_size=S3_MULTIPART_CHUNKSIZE, parts_in_flight=S3_STREAM_PARTS_IN_FLIGHT):
+        self.s3 = s3
+        self.bucket = bucket
+        self.s3_file = s3_file
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.slots = threading.BoundedSemaphore(parts_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=parts_in_flight)
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=s3_file)['UploadId']
+
+    def _uploadPart(self, number, data):
+        try:
+            return self.s3.upload_part(Bucket=self.bucket, Key=self.s3_file, UploadId=self.upload_id, PartNumber=number,
+                                       Body=bytes(data))['ETag']
+        finally:
+            self.slots.release()
+
+    def _sendPart(self, data):
+        # wait for a free slot before holding another part in memory
+        self.slots.acquire()
+        self.parts.append(self.executor.submit(self._uploadPart, len(self.parts) + 1, data))
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._sendPart(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def complete(self):
+        '''
+        Upload the last part and join the parts into the object
+        '''
+        if self.buffer or not self.parts:
+            self._sendPart(self.buffer)
+            self.buffer = bytearray()
+        parts = [{'PartNumber': i + 1, 'ETag': part.result()} for i, part in enumerate(self.parts)]
+        self.executor.shutdown(wait=True)
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.s3_file, UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        '''
+        Cancel the multipart upload so that its parts are not kept (and billed) by S3
+        '''
+        self.executor.shutdown(wait=True)
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.s3_file, UploadId=self.upload_id)
+
+def aws_upload_zip(files, bucket, s3_file, compression=zipfile.ZIP_DEFLATED, part_size=S3_MULTIPART_CHUNKSIZE,
+                   parts_in_flight=S3_STREAM_PARTS_IN_FLIGHT):
+    '''
+    Zip files directly into Amazon S3 storage, without writing the archive to local disk
+    The archive is uploaded in parts as it is written, so at most (parts_in_flight + 1) * part_size bytes of it are
+    held in memory.
+    INPUT   files: local files to add to the archive, under their base names (string or list of strings)
+        bucket: AWS bucket where the archive should be uploaded (string)
+        s3_file: path where the archive should be uploaded within the input AWS bucket (string)
+        compression: compression method of the archive members (zipfile constant)
+        part_size: size in bytes of each part of the upload, at least 5 MB (integer)
+        parts_in_flight: maximum number of parts uploading at the same time (integer)
+    RETURN  whether the archive was uploaded (boolean)
+    '''
+    files = (files,) if isinstance(files, str) else files
+    try:
+        writer = _S3PartWriter(_s3Client(), bucket, s3_file, part_size, parts_in_flight)
+    except NoCredentialsError:
+        logger.error("aws_upload_zip - credentials not available.")
+        return False
+    try:
+        with zipfile.ZipFile(writer, 'w', compression=compression) as archive:
+            for f in files:
+                archive.write(f, os.path.basename(f))
+        writer.complete()
+    except Exception as e:
+        writer.abort()
+        if isinstance(e, FileNotFoundError):
+            logger.error("aws_upload_zip - file was not found: {}".format(e.filename))
+            return False
+        raise
+    logger.info("AWS upload successful: http://{}.s3.amazonaws.com/{}".format(bucket, s3_file))
+    return True
+
+def _archive(job):
+    '''
+    Zip the files of a gee_ingest_pipeline job and upload the archive to Amazon S3
+    INPUT   job: job whose 'archive' entry holds the zip file, AWS bucket and path within the bucket (dictionary)
+    RETURN  whether the archive was uploaded (boolean)
+    '''
+    zip_file, aws_bucket, s3_file = job['archive']
+    with zipfile.ZipFile(zip_file, 'w') as archive:
+        for f in job['files']:
+            archive.write(f, os.path.basename(f))
+    return aws_upload(zip_file, aws_bucket, s3_file)
+
+def gee_ingest_pipeline(jobs, gcs_bucket=None, public=False, max_staged=GEE_MAX_STAGED, max_running=GEE_MAX_RUNNING,
+                        archive_workers=ARCHIVE_MAX_WORKERS, poll_max=GEE_POLL_MIN * 3):
+    '''
+    Upload files to Google Cloud Storage, ingest them into Google Earth Engine, delete them from GCS and archive them on
+    Amazon S3, overlapping these stages across files
+    The files of the next job upload to GCS while earlier ones ingest, and archives are created and uploaded to S3 in the
+    background. Jobs wait before uploading while max_staged files are on GCS and not yet ingested, so that the staging
+    bucket never holds more than that many files.
+    INPUT   jobs: jobs to run, each a dictionary with the following entries (iterable of dictionaries)
+                files: location of files on local computer to upload for one asset (string or list of strings)
+                prefix: folder within GCS bucket where the files should be uploaded (string)
+                manifest: function creating the GEE manifest of the asset from the list of GCS locations of its
+                        files (function)
+                archive: optional, zip file to create from the files, AWS bucket and path within the bucket where it
+                        should be uploaded (tuple of strings)
+            gcs_bucket: optional, GCS bucket to stage the data in (google.cloud.storage.bucket.Bucket)
+            public: whether the assets should be publicly available on GEE (boolean)
+            max_staged: maximum number of files on GCS waiting to be ingested or deleted (integer)
+            max_running: maximum number of ingestion tasks running at the same time (integer)
+            archive_workers: number of archives created and uploaded to S3 at the same time (integer)
+            poll_max: longest number of seconds to wait between two checks of the ingestion tasks (number)
+    RETURN  generator of the gee_ingest_many results, in the order the tasks finish, each with the job's files and
+            GCS locations added (dictionaries)
+    '''
+    if gcs_bucket is None:
+        gcs_bucket = storage.Client(os.environ.get("CLOUDSDK_CORE_PROJECT")).bucket(os.environ.get("GEE_STAGING_BUCKET"))
+    # files staged on GCS and not yet deleted
+    staging = threading.BoundedSemaphore(max_staged)
+    # jobs whose files are on GCS, waiting to be ingested; None marks the end of the jobs
+    staged = queue.Queue(maxsize=max_staged)
+    # job and GCS locations of each asset being ingested, by asset name
+    ingesting = {}
+    # error raised while uploading, re-raised by the generator
+    errors = []
+    archiver = ThreadPoolExecutor(max_workers=archive_workers)
+    archives = []
+
+    def upload():
+        # upload the files of each job in turn, waiting while the staging bucket is full
+        try:
+            for job in jobs:
+                job = dict(job, files=(job['files'],) if isinstance(job['files'], str) else list(job['files']))
+                if job.get('archive'):
+                    archives.append(archiver.submit(_archive, job))
+                # a job with more files than the staging bucket holds is staged on its own
+                job['staged'] = min(len(job['files']), max_staged)
+                for i in range(job['staged']):
+                    staging.acquire()
+                logger.info('Uploading {} to Google Cloud Storage.'.format(', '.join(job['files'])))
+                staged.put((job, gcs_upload(job['files'], job['prefix'], gcs_bucket=gcs_bucket)))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            staged.put(None)
+
+    def manifests():
+        # hand the staged jobs over to the ingestion, or None while the next upload is not finished
+        while True:
+            try:
+                item = staged.get(timeout=1)
+            except queue.Empty:
+                yield None
+                continue
+            if item is None:
+                return
+            job, gcs_uris = item
+            manifest = job['manifest'](gcs_uris)
+            ingesting[manifest['name']] = (job, gcs_uris)
+            yield manifest
+
+    uploader = threading.Thread(target=upload, daemon=True)
+    uploader.start()
+    try:
+        for result in gee_ingest_many(manifests(), public=public, max_running=max_running, poll_max=poll_max):
+            job, gcs_uris = ingesting.pop(result['asset'])
+            # free the staging bucket for the next uploads
+            gcs_remove(gcs_uris, gcs_bucket=gcs_bucket)
+            for i in range(job['staged']):
+                staging.release()
+            logger.info('Files deleted from Google Cloud Storage.')
+            yield dict(result, files=job['files'], gcs_uris=gcs_uris)
+        if errors:
+            raise errors[0]
+        # wait for the archives to be uploaded
+        for future in archives:
+            future.result()
+    finally:
+        archiver.shutdown(wait=True)
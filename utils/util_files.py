@@ -3,13 +3,48 @@ import sys
 import dotenv
 dotenv.load_dotenv(os.getenv('RW_ENV'))
 import subprocess
+import zlib
+import time
+import struct
+import shutil
+import tarfile
+import tempfile
+import zipfile
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import gdal
 import numpy as np
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 import logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# extensions of file types that are already compressed, so they are stored in archives as they are
+COMPRESSED_EXTENSIONS = ('.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.kmz',
+                         '.png', '.jpg', '.jpeg', '.jp2', '.gif', '.webp')
+# number of bytes read from each of a few places in a file to test whether it is worth compressing
+COMPRESSIBLE_SAMPLE_SIZE = 256 * 1024
+# files whose samples compress to more than this fraction of their size are stored in archives as they are
+COMPRESSIBLE_RATIO = 0.9
+# compression level of deflated archive members
+DEFLATE_LEVEL = 6
+# size in bytes of the blocks in which files are read and compressed
+ARCHIVE_BLOCK_SIZE = 1024 * 1024
+# compressed archive members up to this size in bytes are kept in memory until they are written, larger ones in temporary files
+ARCHIVE_SPOOL_SIZE = 64 * 1024 * 1024
+# sizes and offsets in zip archives above this value are written in ZIP64 fields, as zipfile does
+ZIP64_LIMIT = (1 << 31) - 1
+# compression level of zstd archives
+ZSTD_LEVEL = 9
+# default compression of Cloud-Optimized GeoTIFFs, 'DEFLATE' or 'ZSTD'
+COG_COMPRESSION = 'DEFLATE'
+# width and height in pixels of the tiles of Cloud-Optimized GeoTIFFs
+COG_BLOCKSIZE = 512
+
 def download_file_from_google_drive(id, download_url, destination):
     '''
     Downloads file from google drive that needs permission to donwload large files
@@ -234,4 +269,212 @@ def scale_geotiff(tif, scaledtif=None, scale_factor=None, nodata=None, gdal_type
     geotiff = None
     
     return scaledtif  
-            
\ No newline at end of file
+
+def cog_geotiff(tif, cogtif=None, compression=COG_COMPRESSION, level=None, resampling='AVERAGE', blocksize=COG_BLOCKSIZE):
+    '''
+    Rewrite a geotiff as a Cloud-Optimized GeoTIFF: tiled, with internal overviews, and compressed with a predictor
+    using all cores. Run it on processed rasters before gcs_upload, so that there are fewer bytes to upload and to
+    ingest into GEE, and so that the files can be read by byte ranges.
+    INPUT   tif: file name of geotiff to convert (string)
+            cogtif: optional, file name of output raster; if None, the input file is replaced (string)
+            compression: compression method, 'DEFLATE' or 'ZSTD' (string)
+            level: optional, compression level (integer)
+            resampling: resampling method of the overviews, 'AVERAGE' for continuous data or 'NEAREST' or 'MODE' for
+                    classes (string)
+            blocksize: width and height in pixels of the tiles (integer)
+    RETURN  cogtif: file name of the Cloud-Optimized GeoTIFF (string)
+    '''
+    # write to a new file first when replacing the input
+    dotindex = tif.rindex('.')
+    outtif = cogtif or tif[:dotindex] + '_cog' + tif[dotindex:]
+    options = ['COMPRESS={}'.format(compression), 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+    if level is not None:
+        options.append('LEVEL={}'.format(level))
+    if gdal.GetDriverByName('COG') is not None:
+        # the COG driver (GDAL 3.1 and up) tiles the raster, builds the overviews and picks the predictor
+        outds = gdal.Translate(outtif, tif, format='COG', creationOptions=options + [
+            'BLOCKSIZE={}'.format(blocksize), 'PREDICTOR=YES', 'OVERVIEW_RESAMPLING={}'.format(resampling)])
+    else:
+        # older GDAL: build the overviews on a tiled copy, then copy the raster and its overviews to the output
+        tiledtif = outtif[:outtif.rindex('.')] + '_tiled.tif'
+        tiledds = gdal.Translate(tiledtif, tif, creationOptions=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+        if tiledds is None:
+            raise Exception('Tiling of {} before its conversion to a Cloud-Optimized GeoTIFF failed!'.format(tif))
+        factors = []
+        while max(tiledds.RasterXSize, tiledds.RasterYSize) // 2 ** (len(factors) + 1) >= blocksize:
+            factors.append(2 ** (len(factors) + 1))
+        tiledds.BuildOverviews(resampling, factors)
+        # horizontal differencing for integers, floating point prediction for floats
+        floating = gdal.GetDataTypeName(tiledds.GetRasterBand(1).DataType).startswith(('Float', 'CFloat'))
+        outds = gdal.Translate(outtif, tiledds, creationOptions=options + [
+            'TILED=YES', 'BLOCKXSIZE={}'.format(blocksize), 'BLOCKYSIZE={}'.format(blocksize),
+            'PREDICTOR={}'.format(3 if floating else 2), 'COPY_SRC_OVERVIEWS=YES'])
+        tiledds = None
+        os.remove(tiledtif)
+    if outds is None:
+        raise Exception('Conversion of {} to a Cloud-Optimized GeoTIFF failed!'.format(tif))
+    outds = None
+    if cogtif is None:
+        os.replace(outtif, tif)
+        return tif
+    return outtif
+            
+
+def _isCompressible(f):
+    '''
+    Check whether a file is worth compressing, from its extension and from how well samples of it compress
+    Samples are taken from a few places in the file, since already compressed rasters and netcdfs can start with
+    headers that compress well.
+    INPUT   f: file name (string)
+    RETURN  whether the file should be compressed (boolean)
+    '''
+    if f.lower().endswith(COMPRESSED_EXTENSIONS):
+        return False
+    size = os.path.getsize(f)
+    sampled = 0
+    compressed = 0
+    with open(f, 'rb') as source:
+        for offset in sorted(set([0, size // 2, max(0, size - COMPRESSIBLE_SAMPLE_SIZE)])):
+            source.seek(offset)
+            sample = source.read(COMPRESSIBLE_SAMPLE_SIZE)
+            sampled += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+    return sampled == 0 or compressed < COMPRESSIBLE_RATIO * sampled
+
+def _deflateMember(f, level, spool_dir=None):
+    '''
+    Compress a file into a raw deflate stream, the form in which zip archives store deflated members, unless it is not
+    worth compressing; the CRC-32 of the file is computed on the way
+    INPUT   f: file name (string)
+            level: compression level (integer)
+            spool_dir: optional, folder of the temporary file holding large compressed members (string)
+    RETURN  member: file name, compression method, CRC-32 and size of the file, size of the compressed data and, if the
+            file was deflated, the compressed data in a temporary file (dictionary)
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if _isCompressible(f) else None
+    spool = tempfile.SpooledTemporaryFile(ARCHIVE_SPOOL_SIZE, dir=spool_dir) if compressor else None
+    crc = 0
+    size = 0
+    with open(f, 'rb') as source:
+        for block in iter(lambda: source.read(ARCHIVE_BLOCK_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            if compressor:
+                spool.write(compressor.compress(block))
+    member = {'file': f, 'method': zipfile.ZIP_STORED, 'crc': crc, 'size': size, 'compress_size': size, 'data': None}
+    if compressor:
+        spool.write(compressor.flush())
+        # keep the file as it is if deflating did not make it smaller
+        if spool.tell() < size:
+            member.update(method=zipfile.ZIP_DEFLATED, compress_size=spool.tell(), data=spool)
+            spool.seek(0)
+        else:
+            spool.close()
+    return member
+
+def _zipRecords(name, member, offset):
+    '''
+    Build the local header and the central directory record of a zip archive member, with ZIP64 fields for sizes and
+    offsets above ZIP64_LIMIT
+    INPUT   name: name of the member in the archive (string)
+            member: member returned by _deflateMember (dictionary)
+            offset: position of the local header in the archive (integer)
+    RETURN  local header and central directory record (tuple of bytes)
+    '''
+    stat = os.stat(member['file'])
+    year, month, day, hour, minute, second = time.localtime(stat.st_mtime)[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    encoded = name.encode('utf-8')
+    # flag names that are not plain ASCII as UTF-8
+    flags = 0x800 if len(encoded) != len(name) else 0
+    sizes = (member['compress_size'], member['size'])
+    local_extra = central_extra = b''
+    if max(sizes) > ZIP64_LIMIT:
+        local_extra = struct.pack('<HHQQ', 1, 16, member['size'], member['compress_size'])
+        central_extra = local_extra
+        sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+    central_offset = offset
+    if offset > ZIP64_LIMIT:
+        central_extra = struct.pack('<HH', 1, len(central_extra[4:]) + 8) + central_extra[4:] + struct.pack('<Q', offset)
+        central_offset = 0xFFFFFFFF
+    version = 45 if central_extra else 20
+    local = struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, member['method'], dos_time, dos_date, member['crc'],
+                        sizes[0], sizes[1], len(encoded), len(local_extra)) + encoded + local_extra
+    # made by a unix system, keeping the permissions of the file
+    central = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version, flags, member['method'], dos_time,
+                          dos_date, member['crc'], sizes[0], sizes[1], len(encoded), len(central_extra), 0, 0, 0,
+                          (stat.st_mode & 0xFFFF) << 16, central_offset) + encoded + central_extra
+    return local, central
+
+def _zipEnd(n_members, directory_offset, directory_size):
+    '''
+    Build the records ending a zip archive, with the ZIP64 records if the central directory is too large or too far
+    into the archive for the regular record
+    INPUT   n_members: number of members in the archive (integer)
+            directory_offset: position of the central directory in the archive (integer)
+            directory_size: size of the central directory in bytes (integer)
+    RETURN  end records (bytes)
+    '''
+    end = b''
+    if n_members >= 0xFFFF or directory_offset > ZIP64_LIMIT or directory_size > ZIP64_LIMIT:
+        zip64_offset = directory_offset + directory_size
+        end = struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, n_members, n_members, directory_size,
+                          directory_offset)
+        end += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+        n_members = min(n_members, 0xFFFF)
+        directory_offset = min(directory_offset, 0xFFFFFFFF)
+        directory_size = min(directory_size, 0xFFFFFFFF)
+    return end + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, n_members, n_members, directory_size, directory_offset, 0)
+
+def archive_files(files, archive, max_workers=None, level=DEFLATE_LEVEL, zstd=False):
+    '''
+    Create an archive of files, storing those that are already compressed as they are
+    By default a zip archive is written: files that are already compressed (zip or gz downloads, compressed netcdfs and
+    GeoTIFFs) are stored as they are and the others are deflated. The members are compressed on several threads at the
+    same time, a few files ahead of the one being written; zipfile can only deflate members one after the other, so
+    the finished deflate streams are written to the archive with their own headers. Compressed members larger than
+    ARCHIVE_SPOOL_SIZE wait in temporary files next to the archive. With zstd, a zstd compressed tar archive is written
+    instead, compressed on all cores, including within a single large file.
+    INPUT   files: file names to add to the archive, under their base names (string or list of strings)
+            archive: file name of the archive to create (string)
+            max_workers: optional, number of files to compress at the same time; all cores if None (integer)
+            level: compression level of deflated members (integer)
+            zstd: whether to write a zstd compressed tar archive instead of a zip archive (boolean)
+    RETURN  archive: file name of the archive (string)
+    '''
+    files = [files] if isinstance(files, str) else list(files)
+    if zstd:
+        if zstandard is None:
+            raise ImportError('Writing zstd archives requires the zstandard package')
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+        with open(archive, 'wb') as out, compressor.stream_writer(out) as writer:
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for f in files:
+                    tar.add(f, os.path.basename(f))
+        return archive
+    max_workers = max_workers or os.cpu_count()
+    spool_dir = os.path.dirname(os.path.abspath(archive))
+    directory = []
+    with open(archive, 'wb') as out, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # compress a few files ahead of the one being written, so that few compressed members wait at the same time
+        queued = iter(files)
+        pending = deque(executor.submit(_deflateMember, f, level, spool_dir) for i, f in zip(range(2 * max_workers), queued))
+        while pending:
+            member = pending.popleft().result()
+            for f in queued:
+                pending.append(executor.submit(_deflateMember, f, level, spool_dir))
+                break
+            if member['method'] == zipfile.ZIP_STORED:
+                logger.debug('Storing {} without compression'.format(member['file']))
+            local, central = _zipRecords(os.path.basename(member['file']), member, out.tell())
+            out.write(local)
+            with member['data'] or open(member['file'], 'rb') as data:
+                shutil.copyfileobj(data, out, ARCHIVE_BLOCK_SIZE)
+            directory.append(central)
+        directory_offset = out.tell()
+        out.write(b''.join(directory))
+        out.write(_zipEnd(len(directory), directory_offset, out.tell() - directory_offset))
+    return archive
@@ -80,6 +80,9 @@ Process the data and upload to carto
 # Define object that stores which basin levels will be processed. There are 12 basin levels for each region.
 include_levels = [False, False, True, True, True, True, True, True, False, False, False, False]
 
+# create an empty list to store the zipped shapefiles to upload to Carto
+processed_zips = []
+
 # Read included basin-level shapefiles into Python using a for loop
 for i in range(12):
     
@@ -138,10 +141,13 @@ for i in range(12):
                 zip.write(file, os.path.basename(file))
                 zipfile_list.append(file)
 
-        # Upload zipfile to carto
-        logger.info('Uploading processed data for ' + processed_data_file +' to Carto.')
-        util_carto.upload_to_carto(out_zip_dir, 'LINK', tags=['ow'])
-        
+        # Add the zipfile to the list of files to upload to carto
+        processed_zips.append(out_zip_dir)
+
+# Upload all the zipfiles to carto at the same time
+logger.info('Uploading processed data to Carto.')
+util_carto.upload_many(processed_zips, 'LINK', tags=['ow'])
+
 '''
 Upload original data and processed data to Amazon S3 storage
 '''